@@ -0,0 +1,150 @@
+"""Check and time the segmented direct downloader against a local server.
+
+Usage:
+    python benchmarks/bench_direct_download.py [--size-mb 64] [--conn-mbps 8]
+                                               [--segments 1 2 4 8] [--drop-after-mb 0]
+
+A threaded http.server with Range support serves a random file, capping
+every connection at --conn-mbps to mimic file hosts that throttle per
+connection. With --drop-after-mb, every connection is cut after that many
+megabytes so segments have to resume. Each run is verified by SHA-256.
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import direct  # noqa: E402
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """SimpleHTTPRequestHandler with single byte-range support and a per-connection rate cap"""
+    protocol_version = "HTTP/1.1"
+    rate = 0
+    drop_after = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        header = self.headers.get("Range")
+        if header and header.startswith("bytes="):
+            first, _, last = header[6:].partition("-")
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        f = open(path, "rb")
+        f.seek(start)
+        self.remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        sent = 0
+        started = time.monotonic()
+        while self.remaining > 0:
+            chunk = source.read(min(64 * 1024, self.remaining))
+            if not chunk:
+                break
+            if self.drop_after and sent + len(chunk) > self.drop_after:
+                self.close_connection = True
+                return
+            outputfile.write(chunk)
+            sent += len(chunk)
+            self.remaining -= len(chunk)
+            if self.rate:
+                ahead = sent / self.rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def start_server(directory, rate, drop_after):
+    handler = type("Handler", (RangeHandler,), {"rate": rate, "drop_after": drop_after})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/sample.mp4"
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+async def run(url, segments, output_path):
+    media = await direct.probe_direct(url)
+    assert media and media["ranges"], f"probe failed: {media}"
+
+    original = direct.plan_segments
+    direct.plan_segments = lambda size, ranges: original(size, ranges, segments=segments, min_segment_size=1)
+    try:
+        start = time.perf_counter()
+        await direct.download_direct(media, output_path)
+        return time.perf_counter() - start
+    finally:
+        direct.plan_segments = original
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--conn-mbps", type=float, default=8, help="per-connection cap in MB/s, 0 for none")
+    parser.add_argument("--segments", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--drop-after-mb", type=float, default=0, help="cut every connection after this many MB")
+    args = parser.parse_args()
+
+    serve_dir = tempfile.mkdtemp()
+    output_dir = tempfile.mkdtemp()
+    source = os.path.join(serve_dir, "sample.mp4")
+    with open(source, "wb") as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+    expected = sha256(source)
+
+    server, url = start_server(serve_dir, args.conn_mbps * 1024 * 1024, int(args.drop_after_mb * 1024 * 1024))
+    direct.DIRECT_SEGMENT_RETRIES = 1000
+    try:
+        baseline = None
+        for segments in args.segments:
+            output_path = os.path.join(output_dir, f"out_{segments}.mp4")
+            elapsed = asyncio.run(run(url, segments, output_path))
+            ok = sha256(output_path) == expected
+            os.remove(output_path)
+            baseline = baseline or elapsed
+            print(
+                f"segments {segments:>2}: {elapsed:6.2f} s  {args.size_mb / elapsed:7.2f} MB/s  "
+                f"speedup {baseline / elapsed:.2f}x  sha256 {'ok' if ok else 'MISMATCH'}"
+            )
+    finally:
+        server.shutdown()
+        shutil.rmtree(serve_dir, ignore_errors=True)
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Measure HLS download throughput for different concurrent_fragment_downloads.
+
+Usage:
+    python benchmarks/bench_fragment_concurrency.py [--segments 60] [--segment-kb 256]
+                                                    [--latency-ms 80] [--levels 1 2 4 8]
+                                                    [--adaptive 6]
+
+A local threaded HTTP server serves a generated HLS playlist. Every request
+is delayed by --latency-ms to stand in for the round trip to a CDN, which is
+what serial fragment fetching pays for on every segment. With --adaptive N
+the HostTuner is fed N consecutive downloads to show where it converges.
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from yt_dlp import YoutubeDL  # noqa: E402
+from bot.tuning import TransferMonitor, HostTuner  # noqa: E402
+
+
+class SlowHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def build_stream(directory, segments, segment_kb):
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4", "#EXT-X-MEDIA-SEQUENCE:0"]
+    for i in range(segments):
+        with open(os.path.join(directory, f"seg{i}.ts"), "wb") as f:
+            f.write(os.urandom(segment_kb * 1024))
+        lines += ["#EXTINF:4.0,", f"seg{i}.ts"]
+    lines.append("#EXT-X-ENDLIST")
+    with open(os.path.join(directory, "stream.m3u8"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def start_server(directory, latency):
+    handler = type("Handler", (SlowHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/stream.m3u8"
+
+
+def download(url, fragments, output_dir):
+    monitor = TransferMonitor()
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'logger': monitor,
+        'progress_hooks': [monitor.hook],
+        'outtmpl': os.path.join(output_dir, f"out_{fragments}_{time.monotonic_ns()}.%(ext)s"),
+        'concurrent_fragment_downloads': fragments,
+        'hls_prefer_native': True,
+        'fixup': 'never',
+        'overwrites': True,
+    }
+    start = time.perf_counter()
+    with YoutubeDL(opts) as ydl:
+        ydl.download([url])
+    elapsed = time.perf_counter() - start
+
+    for name in os.listdir(output_dir):
+        os.remove(os.path.join(output_dir, name))
+    return elapsed, monitor.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segments", type=int, default=60)
+    parser.add_argument("--segment-kb", type=int, default=256)
+    parser.add_argument("--latency-ms", type=float, default=80)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--adaptive", type=int, default=0, help="downloads to feed through HostTuner")
+    args = parser.parse_args()
+
+    stream_dir = tempfile.mkdtemp()
+    output_dir = tempfile.mkdtemp()
+    build_stream(stream_dir, args.segments, args.segment_kb)
+    server, url = start_server(stream_dir, args.latency_ms / 1000)
+    total_mb = args.segments * args.segment_kb / 1024
+
+    try:
+        print(f"{args.segments} segments, {total_mb:.1f} MB, {args.latency_ms:.0f} ms per request")
+        baseline = None
+        for fragments in args.levels:
+            elapsed, _ = download(url, fragments, output_dir)
+            baseline = baseline or elapsed
+            print(
+                f"fragments {fragments:>2}: {elapsed:6.2f} s  {total_mb / elapsed:7.2f} MB/s  "
+                f"speedup {baseline / elapsed:.2f}x"
+            )
+
+        if args.adaptive:
+            tuner = HostTuner(initial_fragments=1)
+            print("\nadaptive:")
+            for run in range(args.adaptive):
+                settings = asyncio.run(tuner.settings_for(url))
+                elapsed, transfer = download(url, settings['concurrent_fragment_downloads'], output_dir)
+                asyncio.run(tuner.record(url, transfer))
+                print(
+                    f"run {run + 1}: fragments {settings['concurrent_fragment_downloads']:>2}  "
+                    f"{total_mb / elapsed:7.2f} MB/s"
+                )
+    finally:
+        server.shutdown()
+        shutil.rmtree(stream_dir, ignore_errors=True)
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
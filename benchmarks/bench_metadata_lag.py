@@ -0,0 +1,127 @@
+"""Check that video metadata extraction never stalls the event loop.
+
+Usage:
+    python benchmarks/bench_metadata_lag.py [--size-gb 2] [--container mkv] [--max-lag-ms 100]
+                                            [--modes inline hachoir ffprobe]
+
+A short H.264/AAC clip is encoded with ffmpeg's test sources and repeated
+with the concat demuxer (stream copy) until the file reaches --size-gb.
+While metadata is extracted, a ticker sleeps 1 ms at a time and records how
+late the loop woke it up. Modes:
+
+    inline   the old blocking Hachoir call on the event loop (reference)
+    hachoir  Hachoir through the bounded metadata executor (ffprobe skipped)
+    ffprobe  the shared async ffprobe
+
+Exits non-zero if a non-inline mode lets the loop lag by more than --max-lag-ms.
+This is a manual check that needs ffmpeg and Hachoir installed; nothing runs
+it automatically.
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import probe  # noqa: E402
+
+CLIP_SECONDS = 60
+TICK = 0.001
+
+
+def build_source(directory, size_gb, container):
+    clip = os.path.join(directory, f"clip.{container}")
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={CLIP_SECONDS}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={CLIP_SECONDS}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-b:v", "20M", "-g", "60",
+        "-c:a", "aac", "-shortest", clip
+    ], check=True)
+
+    repeats = max(1, int(size_gb * 1024 ** 3 // os.path.getsize(clip)))
+    playlist = os.path.join(directory, "clips.txt")
+    with open(playlist, "w") as f:
+        f.write(f"file 'clip.{container}'\n" * repeats)
+
+    source = os.path.join(directory, f"source.{container}")
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", playlist, "-c", "copy", source
+    ], check=True)
+    os.remove(clip)
+    return source
+
+
+async def measure_lag(stop):
+    """Largest delay past a 1 ms sleep until stop is set, in seconds"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        worst = max(worst, time.perf_counter() - start - TICK)
+    return worst
+
+
+async def extract(mode, source):
+    if mode == "inline":
+        return probe._hachoir_metadata(source)
+    if mode == "hachoir":
+        original = probe.media_probe.probe
+
+        async def no_probe(path):
+            return None
+
+        probe.media_probe.probe = no_probe
+        try:
+            return await probe.video_metadata(source)
+        finally:
+            probe.media_probe.probe = original
+    return await probe.video_metadata(source)
+
+
+async def run(mode, source):
+    stop = asyncio.Event()
+    ticker = asyncio.ensure_future(measure_lag(stop))
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    metadata = await extract(mode, source)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return metadata, elapsed, await ticker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-gb", type=float, default=2)
+    parser.add_argument("--container", default="mkv", choices=["mkv", "mp4"])
+    parser.add_argument("--max-lag-ms", type=float, default=100)
+    parser.add_argument("--modes", nargs="+", default=["inline", "hachoir", "ffprobe"],
+                        choices=["inline", "hachoir", "ffprobe"])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    failed = False
+    try:
+        source = build_source(directory, args.size_gb, args.container)
+        print(f"source {os.path.getsize(source) / 1024 ** 3:.2f} GB {args.container}")
+
+        for mode in args.modes:
+            metadata, elapsed, lag = asyncio.run(run(mode, source))
+            ok = mode == "inline" or lag * 1000 <= args.max_lag_ms
+            failed = failed or not ok
+            print(
+                f"{mode:>8}: {elapsed:7.2f} s  max loop lag {lag * 1000:8.1f} ms  "
+                f"{metadata}  {'ok' if ok else 'TOO SLOW'}"
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Compare one-run batched screenshots with one ffmpeg run per screenshot.
+
+Usage:
+    python benchmarks/bench_screenshots.py [--size-gb 2] [--count 10] [--bitrate-mbps 20]
+                                           [--modes each batch] [--drop-caches]
+
+A short H.264/AAC clip is encoded with ffmpeg's test sources and repeated
+with the concat demuxer (stream copy) until the file reaches --size-gb.
+Both modes take the same --count timestamps; the screenshots are deleted
+after every run. --drop-caches (root only) empties the page cache before
+each run so the input really comes from disk.
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import yt_helper  # noqa: E402
+
+CLIP_SECONDS = 60
+
+
+def build_source(directory, size_gb, bitrate_mbps):
+    clip = os.path.join(directory, "clip.mp4")
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=30:duration={CLIP_SECONDS}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={CLIP_SECONDS}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-b:v", f"{bitrate_mbps}M", "-g", "60",
+        "-c:a", "aac", "-shortest", clip
+    ], check=True)
+
+    repeats = max(1, int(size_gb * 1024 ** 3 // os.path.getsize(clip)))
+    playlist = os.path.join(directory, "clips.txt")
+    with open(playlist, "w") as f:
+        f.write("file 'clip.mp4'\n" * repeats)
+
+    source = os.path.join(directory, "source.mp4")
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", playlist, "-c", "copy", source
+    ], check=True)
+    os.remove(clip)
+    return source, repeats * CLIP_SECONDS
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def run(mode, source, duration, count):
+    base_name = os.path.splitext(source)[0]
+    times = [duration * (i + 1) / (count + 1) for i in range(count)]
+    paths = [f"{base_name}_screenshot_{i+1}.jpg" for i in range(count)]
+    if mode == "batch":
+        await yt_helper._screenshot_batch(source, times, paths)
+    else:
+        await yt_helper._screenshot_each(source, times, paths)
+
+    made = [path for path in paths if os.path.exists(path)]
+    for path in made:
+        os.remove(path)
+    return len(made)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-gb", type=float, default=2)
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--bitrate-mbps", type=float, default=20)
+    parser.add_argument("--modes", nargs="+", default=["each", "batch"], choices=["each", "batch"])
+    parser.add_argument("--drop-caches", action="store_true")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        source, duration = build_source(directory, args.size_gb, args.bitrate_mbps)
+        print(f"source {os.path.getsize(source) / 1024 ** 3:.2f} GB, {duration} s, {args.count} screenshots")
+
+        for mode in args.modes:
+            if args.drop_caches:
+                drop_caches()
+            cpu = children_cpu()
+            start = time.perf_counter()
+            made = asyncio.run(run(mode, source, duration, args.count))
+            elapsed = time.perf_counter() - start
+            print(
+                f"{mode:>6}: {elapsed:7.2f} s  ffmpeg cpu {children_cpu() - cpu:6.2f} s  "
+                f"{made}/{args.count} screenshots"
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Compare the single-pass segment-muxer split with one seek-and-copy ffmpeg per part.
+
+Usage:
+    python benchmarks/bench_split.py [--size-gb 4] [--part-mb 1792] [--bitrate-mbps 40]
+                                     [--modes seek segment] [--drop-caches]
+
+A short H.264/AAC clip is encoded with ffmpeg's test sources and repeated
+with the concat demuxer (stream copy) until the file reaches --size-gb.
+Both modes split it at the same keyframe plan; every part is deleted as
+soon as it is yielded, like the upload pipeline does. Timings include the
+packet scan. --drop-caches (root only) empties the page cache before each
+run so the input really comes from disk.
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import yt_helper  # noqa: E402
+
+CLIP_SECONDS = 60
+
+
+def build_source(directory, size_gb, bitrate_mbps):
+    clip = os.path.join(directory, "clip.mp4")
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=30:duration={CLIP_SECONDS}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={CLIP_SECONDS}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-b:v", f"{bitrate_mbps}M", "-g", "60",
+        "-c:a", "aac", "-shortest", clip
+    ], check=True)
+
+    repeats = max(1, int(size_gb * 1024 ** 3 // os.path.getsize(clip)))
+    playlist = os.path.join(directory, "clips.txt")
+    with open(playlist, "w") as f:
+        f.write("file 'clip.mp4'\n" * repeats)
+
+    source = os.path.join(directory, "source.mp4")
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", playlist, "-c", "copy", source
+    ], check=True)
+    os.remove(clip)
+    return source
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def run(source, part_size):
+    parts = []
+    async for index, total, path, duration, key in yt_helper.iter_split_parts(source, max_size=part_size):
+        parts.append((os.path.getsize(path), duration))
+        os.remove(path)
+    return parts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-gb", type=float, default=4)
+    parser.add_argument("--part-mb", type=int, default=1792, help="part size limit (MAX_FILE_SIZE by default)")
+    parser.add_argument("--bitrate-mbps", type=float, default=40)
+    parser.add_argument("--modes", nargs="+", default=["seek", "segment"], choices=["seek", "segment"])
+    parser.add_argument("--drop-caches", action="store_true")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        source = build_source(directory, args.size_gb, args.bitrate_mbps)
+        size = os.path.getsize(source)
+        part_size = args.part_mb * 1024 * 1024
+        print(f"source {size / 1024 ** 3:.2f} GB, parts of at most {args.part_mb} MB")
+
+        for mode in args.modes:
+            yt_helper.SPLIT_MODE = mode
+            if args.drop_caches:
+                drop_caches()
+            cpu = children_cpu()
+            start = time.perf_counter()
+            parts = asyncio.run(run(source, part_size))
+            elapsed = time.perf_counter() - start
+            largest = max(part for part, _ in parts)
+            print(
+                f"{mode:>7}: {elapsed:7.2f} s  {size / 1024 ** 2 / elapsed:8.1f} MB/s  "
+                f"ffmpeg cpu {children_cpu() - cpu:6.2f} s  {len(parts)} parts, "
+                f"largest {largest / 1024 ** 2:.1f} MB"
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
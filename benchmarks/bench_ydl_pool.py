@@ -0,0 +1,104 @@
+"""Compare per-request extract_info latency: new YoutubeDL per call vs the pool.
+
+Usage:
+    python benchmarks/bench_ydl_pool.py [--url URL] [--requests 20]
+
+Without --url a local HTTP server with keep-alive serves a dummy .mp4 so the
+benchmark runs offline through the generic extractor.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from yt_dlp import YoutubeDL  # noqa: E402
+from bot.ydl_pool import YDLPool  # noqa: E402
+
+YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'skip_download': True,
+    'format': 'best',
+    'noplaylist': True,
+}
+
+
+class KeepAliveHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+def start_local_server():
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "sample.mp4"), "wb") as f:
+        f.write(os.urandom(256 * 1024))
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(KeepAliveHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/sample.mp4"
+
+
+def construct_per_call(url):
+    with YoutubeDL(YDL_OPTS) as ydl:
+        ydl.extract_info(url, download=False)
+
+
+def pooled(pool, url):
+    with pool.borrow(YDL_OPTS, site="bench") as ydl:
+        ydl.extract_info(url, download=False)
+
+
+def measure(label, fn, requests):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    samples.sort()
+    print(
+        f"{label:<20} mean {statistics.mean(samples):8.1f} ms  "
+        f"p50 {samples[len(samples) // 2]:8.1f} ms  "
+        f"p95 {samples[int(len(samples) * 0.95) - 1]:8.1f} ms  "
+        f"min {samples[0]:8.1f} ms"
+    )
+    return statistics.mean(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="URL to extract (default: local dummy file)")
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        server, url = start_local_server()
+
+    pool = YDLPool()
+    try:
+        # Warm up imports and lazy extractor loading for both variants
+        construct_per_call(url)
+        pooled(pool, url)
+
+        baseline = measure("construct-per-call", partial(construct_per_call, url), args.requests)
+        pooled_mean = measure("pooled", partial(pooled, pool, url), args.requests)
+        print(f"speedup: {baseline / pooled_mean:.2f}x  pool: {pool.stats()}")
+    finally:
+        pool.close()
+        if server:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
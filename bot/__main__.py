@@ -5,8 +5,6 @@ import datetime
 import asyncio
 import uuid
 import ffmpeg
-from hachoir.parser import createParser
-from hachoir.metadata import extractMetadata
 from pyrogram import Client, filters, types
 
 from pyrogram.types import ChatPermissions
@@ -16,10 +14,22 @@ from pyrogram.errors import FloodWait, MessageNotModified
 import time
 from bot.database import Database
 from bot import yt_helper
+from bot.cache import info_cache
+from bot.probe import media_probe, MediaInfo, video_metadata
+from bot.ydl_pool import ydl_pool
+from bot import workers
+from bot.scheduler import scheduler
+from bot.tuning import host_tuner
+from bot.admission import (
+    admission, estimate_footprint, estimate_ranged_footprint, estimate_download_size, staging_estimate,
+    split_reservation
+)
 from bot.config import (
     API_ID, API_HASH, BOT_TOKEN, ADMINS, PAID_USERS,
     DEFAULT_UPLOAD_MODE, DEFAULT_SPLIT_SETTING, DEFAULT_FORMAT,
-    CONTACT_ADMIN, MAX_FILE_SIZE, DOWNLOAD_PATH, TASKS
+    CONTACT_ADMIN, MAX_FILE_SIZE, DOWNLOAD_PATH, TASKS, BATCH_CONCURRENCY,
+    MAX_BATCH_URLS, MAX_BATCH_FILE_SIZE, ACTIVE_JOBS_PER_USER, MAX_STAGED_PARTS, RANGED_PARTS_ENABLED,
+    DOCUMENT_BYTE_SPLIT
 )
 
 # Configure logging
@@ -44,9 +54,21 @@ app = Client(
 
 # Initialize database
 db = Database()
+info_cache.attach(db)
+host_tuner.attach(db)
+
+# What a job waiting for admission is waiting for
+RESOURCE_WAIT_LABELS = {"disk": "free disk space", "memory": "free memory", "load": "the server load to drop"}
 
-# Active downloads tracking
+# Active downloads tracking: url_id -> cancel event, user_id -> set of url_ids
 active_downloads = {}
+user_downloads = {}
+
+# References to running job tasks so they aren't garbage collected
+background_tasks = set()
+
+# Delivery (file_id) cache counters since start
+delivery_stats = {"hits": 0, "misses": 0, "invalidated": 0}
 #download_locks {}
 
 # Command handlers
@@ -699,6 +721,81 @@ async def list_paid_users(client, message):
 
 
 
+# Command to show scheduler queues (for admins)
+@app.on_message(filters.command("queue") & filters.user(ADMINS))
+async def queue_status(client, message):
+    """Show active and waiting jobs per pipeline stage"""
+    response = "📊 **Job Queues**\n\n"
+    for stage, depth in scheduler.queue_depth().items():
+        waiting = depth['waiting']
+        response += f"**{stage.capitalize()}:** {depth['active']}/{depth['limit']} active\n"
+        response += f"   Waiting: {waiting['admin']} admin, {waiting['paid']} paid, {waiting['free']} free\n"
+    response += f"\nRunning jobs: {len(active_downloads)} from {len(user_downloads)} users\n\n"
+    
+    resources = admission.stats()
+    response += "**Admission**\n\n"
+    response += (
+        f"Free disk: {format_size(resources['free'])}, reserved: {format_size(resources['reserved'])} "
+        f"({format_size(resources['outstanding'])} not yet written) by {resources['jobs']} jobs\n"
+    )
+    response += f"Waiting for resources: {resources['waiting']}\n"
+    response += f"Admitted: {resources['admitted']}, rejected: {resources['rejected']}\n"
+    if resources['memory_percent'] is not None:
+        response += f"Memory used: {resources['memory_percent']:.0f}%\n"
+    if resources['load_per_cpu'] is not None:
+        response += f"Load per CPU: {resources['load_per_cpu']:.2f}"
+    
+    await message.reply(response)
+
+# Command to show cache statistics (for admins)
+@app.on_message(filters.command("cachestats") & filters.user(ADMINS))
+async def cache_stats(client, message):
+    """Show video info cache counters"""
+    stats = info_cache.stats()
+
+    response = "📊 **Video Info Cache**\n\n"
+    response += f"Entries in memory: {stats['entries']}\n"
+    response += f"Memory hits: {stats['hits']}\n"
+    response += f"Shared (MongoDB) hits: {stats['remote_hits']}\n"
+    response += f"Misses: {stats['misses']}\n"
+    response += f"Evictions: {stats['evictions']}\n"
+    response += f"Expirations: {stats['expirations']}\n"
+    response += f"Hit rate: {stats['hit_rate'] * 100:.1f}%\n\n"
+    response += "**Extractions**\n\n"
+    response += f"Started: {yt_helper.extraction_stats['started']}\n"
+    response += f"Saved by coalescing: {yt_helper.extraction_stats['coalesced']}\n\n"
+    
+    probe_stats = media_probe.stats()
+    response += "**Media Probes**\n\n"
+    response += f"Entries in memory: {probe_stats['entries']}\n"
+    response += f"ffprobe runs: {probe_stats['probes']}\n"
+    response += f"Served from memory: {probe_stats['hits']}\n\n"
+    
+    delivery_totals = await db.get_delivery_stats()
+    lookups = delivery_stats["hits"] + delivery_stats["misses"]
+    delivery_hit_rate = delivery_stats["hits"] / lookups * 100 if lookups else 0.0
+    response += "**Delivery Cache**\n\n"
+    response += f"Cached deliveries: {delivery_totals['count']}\n"
+    response += f"Hits (all time): {delivery_totals['hits']}\n"
+    response += f"Hits: {delivery_stats['hits']}\n"
+    response += f"Misses: {delivery_stats['misses']}\n"
+    response += f"Invalidated: {delivery_stats['invalidated']}\n"
+    response += f"Hit rate: {delivery_hit_rate:.1f}%"
+    
+    tuning = host_tuner.stats()
+    if tuning:
+        response += "\n\n**Download Tuning**\n\n"
+        for host, settings in list(tuning.items())[:10]:
+            response += (
+                f"{host}: {settings['fragments']} fragments, "
+                f"chunk {format_size(settings['chunk_size'])}, "
+                f"{format_size(settings['throughput'])}/s\n"
+            )
+
+    await message.reply(response)
+
+
+
 @app.on_message(filters.command("unban") & filters.user(ADMINS))
 async def unban_user(client, message):
     if len(message.command) < 2:
@@ -717,6 +814,40 @@ async def unban_user(client, message):
         await message.reply("Please provide a valid user ID.")
         
 
+def get_user_tier(user_id, user_data):
+    """Scheduling tier of a user: admin, paid or free"""
+    if user_id in ADMINS:
+        return "admin"
+    if (user_data and user_data.get("is_paid", False)) or user_id in PAID_USERS:
+        return "paid"
+    return "free"
+
+def has_free_job_slot(user_id, user_data):
+    """Check whether a user may start another job"""
+    return len(user_downloads.get(user_id, ())) < ACTIVE_JOBS_PER_USER[get_user_tier(user_id, user_data)]
+
+def register_download(url_id, user_id):
+    """Track a new job and return its cancel event"""
+    cancel_event = asyncio.Event()
+    active_downloads[url_id] = cancel_event
+    user_downloads.setdefault(user_id, set()).add(url_id)
+    return cancel_event
+
+def unregister_download(url_id, user_id):
+    active_downloads.pop(url_id, None)
+    jobs = user_downloads.get(user_id)
+    if jobs is not None:
+        jobs.discard(url_id)
+        if not jobs:
+            del user_downloads[user_id]
+
+def start_job(coro):
+    """Run a job in the background, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 @app.on_message(filters.regex(yt_helper.URL_PATTERN) & filters.private)
 async def url_handler(client, message):
     user_id = message.from_user.id
@@ -748,26 +879,34 @@ async def url_handler(client, message):
             )
             return
     
-    # Check if URL is valid
-    url = message.text.strip()
-    if not yt_helper.is_valid_url(url):
+    # Collect the URLs in the message
+    urls, duplicates = yt_helper.extract_urls(message.text or message.caption)
+    if not urls:
         await message.reply("❌ Invalid URL. Please send a valid YTDL-supported URL.")
         return
     
-    # Check if there's already an active download for this user
-    if user_id in active_downloads:
+    # Check if the user already runs as many jobs as allowed
+    if not has_free_job_slot(user_id, user_data):
         await message.reply("⚠️ You already have an active download. Please wait for it to complete.")
         return
     
+    # Several links in one message become a single batch job
+    if len(urls) > 1:
+        await start_batch(message, urls, duplicates, user_id, is_paid)
+        return
+    
+    url = urls[0]
+    
     # Create a unique ID for this URL
     url_id = str(uuid.uuid4())
     
     # Store URL in database
     await db.store_url(url_id, url, user_id)
     
-    # If user is not paid and not admin, increment their daily task count
+    # Free users are charged once the URL turns out to be a single video,
+    # playlists are charged per entry when their quality is picked
     if not is_paid and user_id not in ADMINS:
-        task_count = await db.track_daily_task(user_id)
+        task_count = await db.get_daily_task_count(user_id)
         tasks_remaining = TASKS - task_count
         
         # Send processing message with task limit info
@@ -781,19 +920,36 @@ async def url_handler(client, message):
     
     try:
         # Get video info
-        video_info = await yt_helper.get_video_info(url)
+        async with scheduler.slot("extract", user_id, get_user_tier(user_id, user_data)):
+            video_info = await yt_helper.get_video_info(url)
         
         if not video_info:
             await processing_msg.edit("❌ Failed to fetch video information. Make sure the URL is valid and supported.")
             return
         
+        if video_info.get('is_playlist'):
+            await show_playlist_menu(processing_msg, url_id, url, user_id, video_info)
+            return
+        
+        if not is_paid and user_id not in ADMINS:
+            await db.track_daily_task(user_id)
+        
         # Prepare format buttons
         format_buttons = []
+        # The best format expected to fit in one upload, so the split path is avoided
+        auto_format = yt_helper.pick_format_under(video_info)
+        if auto_format and len(f"dl|{url_id}|{auto_format['format_id']}") <= 64:
+            btn_text = f"⚡ Auto: {auto_format['resolution']} ({auto_format['ext']}) | {auto_format['size_str']}"
+            format_buttons.append([InlineKeyboardButton(btn_text, callback_data=f"dl|{url_id}|{auto_format['format_id']}")])
         for fmt in video_info['formats']:
             if fmt.get('format_id') and fmt.get('resolution'):
                 size_info = f" | {fmt['size_str']}" if fmt.get('size_str') else ""
-                btn_text = f"{fmt['resolution']} ({fmt['ext']}){size_info}"
+                fits_badge = " ✅" if fmt.get('fits') else ""
+                btn_text = f"{fmt['resolution']} ({fmt['ext']}){size_info}{fits_badge}"
                 callback_data = f"dl|{url_id}|{fmt['format_id']}"
+                if len(callback_data) > 64:
+                    # Telegram rejects callback data over 64 bytes
+                    continue
                 format_buttons.append([InlineKeyboardButton(btn_text, callback_data=callback_data)])
         
         # Add cancel button
@@ -812,7 +968,8 @@ async def url_handler(client, message):
                 f"👤 **Uploader:** {video_info['uploader']}\n"
                 f"⏱️ **Duration:** {format_duration(video_info['duration'])}\n\n"
                 f"📊 You have used {task_count}/{TASKS} downloads today. {tasks_remaining} remaining.\n\n"
-                f"Please select a format to download:",
+                f"Please select a format to download:\n"
+                f"✅ fits in one upload ({format_size(MAX_FILE_SIZE)}), ~ marks an estimate",
                 reply_markup=format_markup
             )
         else:
@@ -820,7 +977,8 @@ async def url_handler(client, message):
                 f"📹 **{video_info['title']}**\n\n"
                 f"👤 **Uploader:** {video_info['uploader']}\n"
                 f"⏱️ **Duration:** {format_duration(video_info['duration'])}\n\n"
-                f"Please select a format to download:",
+                f"Please select a format to download:\n"
+                f"✅ fits in one upload ({format_size(MAX_FILE_SIZE)}), ~ marks an estimate",
                 reply_markup=format_markup
             )
     except Exception as e:
@@ -829,6 +987,126 @@ async def url_handler(client, message):
 
 
 
+@app.on_message(filters.document & filters.private)
+async def batch_file_handler(client, message):
+    """Import a .txt file of URLs as one batch job"""
+    document = message.document
+    if not (document.file_name or "").lower().endswith(".txt") and document.mime_type != "text/plain":
+        return
+    
+    user_id = message.from_user.id
+    user_data = await db.get_user(user_id)
+    
+    if not user_data:
+        await db.add_user(user_id, message.from_user.username)
+        user_data = await db.get_user(user_id)
+    
+    if user_data.get("banned", False):
+        await message.reply("You are banned from using this bot.")
+        return
+    
+    if not has_free_job_slot(user_id, user_data):
+        await message.reply("⚠️ You already have an active download. Please wait for it to complete.")
+        return
+    
+    if document.file_size and document.file_size > MAX_BATCH_FILE_SIZE:
+        await message.reply(f"❌ The file is too large. Maximum size is {format_size(MAX_BATCH_FILE_SIZE)}.")
+        return
+    
+    try:
+        data = await client.download_media(message, in_memory=True)
+        text = bytes(data.getbuffer()).decode("utf-8", errors="ignore")
+    except Exception as e:
+        logger.error(f"Error reading batch file: {e}")
+        await message.reply("❌ Failed to read the file. Please try again.")
+        return
+    
+    urls, duplicates = yt_helper.extract_urls(text)
+    if not urls:
+        await message.reply("❌ No valid URLs found in the file.")
+        return
+    
+    is_paid = user_data.get("is_paid", False) or user_id in PAID_USERS
+    await start_batch(message, urls, duplicates, user_id, is_paid)
+
+async def start_batch(message, urls, duplicates, user_id, is_paid):
+    """Create a batch job for several URLs and ask for a shared quality"""
+    truncated = max(0, len(urls) - MAX_BATCH_URLS)
+    urls = urls[:MAX_BATCH_URLS]
+    
+    # Free users pay for the whole batch up front, all or nothing
+    quota_text = ""
+    if not is_paid and user_id not in ADMINS:
+        task_count = await db.charge_daily_tasks(user_id, len(urls), TASKS)
+        if task_count is None:
+            tasks_remaining = max(0, TASKS - await db.get_daily_task_count(user_id))
+            await message.reply(
+                f"⚠️ This batch has {len(urls)} links but you only have {tasks_remaining} downloads left today.\n\n"
+                "Send fewer links or upgrade to a paid plan /plans for unlimited downloads.\n\n"
+                f"Contact: {CONTACT_ADMIN}"
+            )
+            return
+        quota_text = f"📊 You have used {task_count}/{TASKS} downloads today. {TASKS - task_count} remaining.\n\n"
+    
+    url_id = str(uuid.uuid4())
+    title = f"Batch of {len(urls)} links"
+    await db.store_url(url_id, "batch", user_id)
+    await db.store_batch(url_id, "batch", [{"url": url, "title": None} for url in urls], title)
+    
+    notes = ""
+    if duplicates:
+        notes += f"♻️ {duplicates} duplicate links skipped.\n"
+    if truncated:
+        notes += f"✂️ {truncated} links over the limit of {MAX_BATCH_URLS} skipped.\n"
+    
+    await message.reply(
+        f"📦 **{title}**\n\n"
+        f"{notes}"
+        f"{quota_text}"
+        f"Please select a quality for all links:",
+        reply_markup=batch_format_markup(url_id)
+    )
+
+def batch_format_markup(url_id):
+    """Quality buttons shared by every entry of a playlist or batch"""
+    format_buttons = [
+        [InlineKeyboardButton(label, callback_data=f"pl|{url_id}|{code}")]
+        for code, (label, _) in yt_helper.PLAYLIST_FORMATS.items()
+    ]
+    format_buttons.append([InlineKeyboardButton("Cancel", callback_data=f"cancel|{url_id}")])
+    return InlineKeyboardMarkup(format_buttons)
+
+async def show_playlist_menu(processing_msg, url_id, url, user_id, playlist_info):
+    """Offer one quality choice for every entry of a playlist"""
+    entries = playlist_info['entries']
+    if not entries:
+        await processing_msg.edit("❌ This playlist has no downloadable entries.")
+        return
+    
+    # Playlists are capped like batches
+    truncated = max(0, len(entries) - MAX_BATCH_URLS)
+    entries = entries[:MAX_BATCH_URLS]
+    notes = f"✂️ {truncated} videos over the limit of {MAX_BATCH_URLS} skipped.\n\n" if truncated else ""
+    
+    # Continue an unfinished job for the same playlist instead of starting over
+    resume_text = ""
+    previous = await db.find_resumable_batch(user_id, url)
+    if previous and previous.get("completed_entries"):
+        url_id = previous["url_id"]
+        resume_text = f"♻️ Resuming: {len(previous['completed_entries'])} videos already delivered.\n\n"
+    else:
+        await db.store_batch(url_id, "playlist", entries, playlist_info['title'])
+    
+    await processing_msg.edit(
+        f"📃 **{playlist_info['title']}**\n\n"
+        f"👤 **Uploader:** {playlist_info['uploader']}\n"
+        f"🎞️ **Videos:** {len(entries)}\n\n"
+        f"{notes}"
+        f"{resume_text}"
+        f"Please select a quality for the whole playlist:",
+        reply_markup=batch_format_markup(url_id)
+    )
+
 # Callback query handler
 @app.on_callback_query()
 async def callback_handler(client, callback_query):
@@ -1204,6 +1482,14 @@ async def callback_handler(client, callback_query):
         # Get the URL
         url = url_data.get("url")
         
+        if url_id in active_downloads:
+            await callback_query.answer("This download is already running")
+            return
+        
+        if not has_free_job_slot(user_id, user_data):
+            await callback_query.answer("⚠️ You already have an active download. Please wait for it to complete.", show_alert=True)
+            return
+        
         # Answer the callback query
         await callback_query.answer("Starting download...")
         
@@ -1212,7 +1498,7 @@ async def callback_handler(client, callback_query):
             f"⏬ **Downloading...**\n\n"
          #   f"Format: {format_id}\n\n"
             f"Please wait, this might take some time.",
-
+            reply_markup=download_cancel_markup(url_id)
         )
         
         # Create a lock for this download
@@ -1220,11 +1506,74 @@ async def callback_handler(client, callback_query):
           #  download_locks[user_id] = asyncio.Lock()
         
         # Create a cancel event
-        cancel_event = asyncio.Event()
-        active_downloads[url_id] = cancel_event
+        cancel_event = register_download(url_id, user_id)
+        await db.save_job(url_id, {
+            "kind": "single",
+            "format_id": format_id,
+            "user_id": user_id,
+            "chat_id": message.chat.id,
+            "message_id": message.id
+        })
         
         # Start download process in background
-        asyncio.create_task(process_download(client, message, url, url_id, format_id, user_id, cancel_event))
+        start_job(process_download(client, message, url, url_id, format_id, user_id, cancel_event))
+        return
+    
+    # Handle playlist and batch downloads
+    if data.startswith("pl|"):
+        parts = data.split("|")
+        if len(parts) != 3:
+            await callback_query.answer("Invalid callback data")
+            return
+        
+        _, url_id, quality = parts
+        url_data = await db.get_url(url_id)
+        
+        if not url_data or not url_data.get("entries"):
+            await callback_query.answer("Playlist not found in database")
+            return
+        
+        if url_id in active_downloads:
+            await callback_query.answer("This playlist is already being downloaded")
+            return
+        
+        if not has_free_job_slot(user_id, user_data):
+            await callback_query.answer("⚠️ You already have an active download. Please wait for it to complete.", show_alert=True)
+            return
+        
+        # Claim the job before the first await so a double tap can't charge or start it twice
+        cancel_event = register_download(url_id, user_id)
+        
+        # Batches were charged when they were created; a playlist is charged
+        # once for every entry it will deliver, all or nothing
+        is_paid = user_data.get("is_paid", False) or user_id in PAID_USERS
+        if url_data.get("kind") == "playlist" and not url_data.get("charged") and not is_paid and user_id not in ADMINS:
+            entries = url_data["entries"][:MAX_BATCH_URLS]
+            done = set(url_data.get("completed_entries", []))
+            count = sum(1 for i in range(len(entries)) if i not in done)
+            task_count = await db.charge_daily_tasks(user_id, count, TASKS)
+            if task_count is None:
+                unregister_download(url_id, user_id)
+                tasks_remaining = max(0, TASKS - await db.get_daily_task_count(user_id))
+                await callback_query.answer(
+                    f"⚠️ This playlist has {count} videos but you only have {tasks_remaining} downloads left today.",
+                    show_alert=True
+                )
+                return
+            await db.update_batch(url_id, {"entries": entries, "charged": True})
+        
+        await callback_query.answer("Starting playlist download...")
+        
+        playlist_format = yt_helper.get_playlist_format(quality)
+        await db.save_job(url_id, {
+            "kind": "batch",
+            "format_id": playlist_format,
+            "user_id": user_id,
+            "chat_id": message.chat.id,
+            "message_id": message.id
+        })
+        
+        start_job(process_batch(client, message, url_id, playlist_format, user_id, cancel_event))
         return
     
     # Handle cancellation
@@ -1238,14 +1587,14 @@ async def callback_handler(client, callback_query):
         url_id = data.split("|")[1]
         
         if url_id in active_downloads:
-            active_downloads[url_id].set()
             await callback_query.answer("Download cancellation requested. Please wait...")
             
-            # Update message
+            # The job reports what was stopped once it has cleaned up
             await message.edit(
-                "⏹️ **Download Cancelled**\n\n"
-                "The download has been cancelled by user."
+                "⏹️ **Cancelling...**\n\n"
+                "Stopping the job and removing partial files."
             )
+            active_downloads[url_id].set()
         else:
             await callback_query.answer("No active download to cancel")
         return
@@ -1363,37 +1712,57 @@ def format_time(seconds):
     else:
         return f"{minutes:02d}:{seconds:02d}"
 
-async def extract_video_metadata(file_path):
-    """Extract video metadata using Hachoir"""
-    width = height = None
-    duration = 0
-    
-    try:
-        parser = createParser(file_path)
-        if parser:
-            metadata = extractMetadata(parser)
-            if metadata:
-                if metadata.has("width"):
-                    width = metadata.get("width")
-                if metadata.has("height"):
-                    height = metadata.get("height")
-                if metadata.has("duration"):
-                    duration = metadata.get("duration").seconds
-            parser.close()
-    except Exception as e:
-        logger.error(f"Error extracting video metadata: {e}")
-    
-    return {
-        "width": width,
-        "height": height,
-        "duration": duration
-    }
+async def extract_video_metadata(file_path, fallback=None):
+    """Extract video metadata off the event loop (ffprobe, then Hachoir), filling gaps from fallback"""
+    return await video_metadata(file_path, fallback)
+
+def download_cancel_markup(url_id):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⏹️ Cancel", callback_data=f"cancel_dl|{url_id}")]])
 
-async def upload_file_with_progress(client, message, file_path, chat_id, caption, upload_mode, thumb=None, duration=None, width=None, height=None):
-    """Upload file with progress updates"""
+def make_download_progress_renderer(message, url_id):
+    """Progress callback for yt_helper.download_video that edits the status message"""
+    async def render(snapshot):
+        downloaded = snapshot["downloaded_bytes"]
+        total = snapshot["total_bytes"]
+        # What is on disk already no longer needs to be held back from other jobs
+        admission.record_written(url_id, yt_helper.job_disk_usage(job_video_id(url_id)))
+        
+        text = "⏬ **Downloading...**\n\n"
+        if total:
+            percentage = min(100.0, downloaded * 100 / total)
+            bar_length = 10
+            filled_length = int(bar_length * percentage // 100)
+            progress_bar = '█' * filled_length + '░' * (bar_length - filled_length)
+            text += f"**Progress:** {percentage:.1f}%\n{progress_bar}\n"
+            text += f"**Downloaded:** {format_size(downloaded)} / {format_size(total)}\n"
+        else:
+            text += f"**Downloaded:** {format_size(downloaded)}\n"
+        if snapshot["fragment_count"]:
+            text += f"**Fragment:** {snapshot['fragment_index'] or 0}/{snapshot['fragment_count']}\n"
+        text += f"**Speed:** {format_size(snapshot['speed'])}/s\n"
+        if snapshot["eta"] is not None:
+            text += f"**ETA:** {format_time(snapshot['eta'])}"
+        if snapshot["status"] == "finished":
+            text = f"⏬ **Downloaded {format_size(downloaded)}**\n\nMerging and preparing the file..."
+        
+        try:
+            await message.edit(text, reply_markup=download_cancel_markup(url_id))
+        except MessageNotModified:
+            pass
+        except FloodWait as e:
+            return e.value
+    return render
+
+async def upload_file_with_progress(client, message, file_path, chat_id, caption, upload_mode, thumb=None, duration=None, width=None, height=None, cancel_event=None):
+    """Upload file with progress updates. Returns None if the upload was cancelled.
+
+    file_path may also be a yt_helper.FileSlice, which is sent as a document.
+    """
     
     # Get file size for progress calculation
-    file_size = os.path.getsize(file_path)
+    is_slice = isinstance(file_path, yt_helper.FileSlice)
+    file_size = file_path.length if is_slice else os.path.getsize(file_path)
+    file_name = file_path.name if is_slice else os.path.basename(file_path)
     uploaded_size = 0
     start_time = time.time()
     last_update_time = start_time
@@ -1402,6 +1771,10 @@ async def upload_file_with_progress(client, message, file_path, chat_id, caption
     async def progress_callback(current, total):
         nonlocal uploaded_size, last_update_time
         
+        # Abort the transfer, Pyrogram then returns None instead of a message
+        if cancel_event is not None and cancel_event.is_set():
+            client.stop_transmission()
+        
         # Calculate progress
         uploaded_size = current
         
@@ -1432,7 +1805,7 @@ async def upload_file_with_progress(client, message, file_path, chat_id, caption
             try:
                 await message.edit(
                     f"📤 **Uploading...**\n\n"
-                    f"**File:** {os.path.basename(file_path)}\n"
+                    f"**File:** {file_name}\n"
                     f"**Progress:** {percentage:.1f}%\n"
                     f"{progress_bar}\n"
                     f"**Speed:** {format_size(speed)}/s\n"
@@ -1444,7 +1817,7 @@ async def upload_file_with_progress(client, message, file_path, chat_id, caption
     
     try:
         # Upload based on mode
-        if upload_mode == "video" and file_path.lower().endswith((".mp4", ".mkv", ".avi", ".webm")):
+        if upload_mode == "video" and not is_slice and file_path.lower().endswith((".mp4", ".mkv", ".avi", ".webm")):
             video_args = {
                 "chat_id": chat_id,
                 "video": file_path,
@@ -1473,6 +1846,10 @@ async def upload_file_with_progress(client, message, file_path, chat_id, caption
                 "progress": progress_callback
             }
             
+            if is_slice:
+                # Upload the range from its start again, also on a retry
+                file_path.seek(0)
+                document_args["file_name"] = file_name
             if thumb:
                 document_args["thumb"] = thumb
                 
@@ -1485,101 +1862,360 @@ async def upload_file_with_progress(client, message, file_path, chat_id, caption
             return await upload_file_with_progress(
                 client, message, file_path, chat_id, 
                 caption + "\n\n(Uploaded without thumbnail due to error)",
-                upload_mode, None, duration, width, height
+                upload_mode, None, duration, width, height, cancel_event
             )
         raise
 
 
+def get_delivery_key(url, format_id, upload_mode, split_enabled):
+    """Key identifying one delivered file: video, format and upload settings"""
+    extractor, video_id = yt_helper.get_url_key(url)
+    return f"{extractor}:{video_id}|{format_id}|{upload_mode}|{'split' if split_enabled else 'whole'}"
+
+async def send_cached_delivery(client, message, key, user_id, custom_caption, want_screenshots, want_sample):
+    """Send a previous delivery again by file_id. Returns True if it was served."""
+    delivery = await db.get_delivery(key)
+    if not delivery or (want_screenshots and not delivery.get("screenshots")) or (want_sample and not delivery.get("sample")):
+        delivery_stats["misses"] += 1
+        return False
+    
+    title = delivery["title"]
+    caption = f"**{title}**"
+    if custom_caption:
+        caption = f"{caption}\n\n{custom_caption}"
+    
+    sent_ids = []
+    try:
+        for part in delivery["parts"]:
+            sent = await client.send_cached_media(user_id, part["file_id"], caption=caption + part["caption_suffix"])
+            sent_ids.append(sent.id)
+        
+        if want_screenshots:
+            media_group = [
+                types.InputMediaPhoto(media=file_id, caption=f"Screenshot {i+1}" if i == 0 else "")
+                for i, file_id in enumerate(delivery["screenshots"])
+            ]
+            sent_group = await client.send_media_group(user_id, media_group)
+            sent_ids.extend(m.id for m in sent_group)
+        
+        if want_sample:
+            await client.send_cached_media(user_id, delivery["sample"], caption=f"📽️ **Sample video of:** {title}")
+    except FloodWait:
+        raise
+    except Exception as e:
+        # Telegram rejected a file_id (expired, deleted, ...): drop the entry
+        # and any partially sent messages, then fall back to a real download
+        logger.warning(f"Cached delivery {key} rejected, invalidating: {e}")
+        delivery_stats["invalidated"] += 1
+        await db.delete_delivery(key)
+        if sent_ids:
+            try:
+                await client.delete_messages(user_id, sent_ids)
+            except Exception as delete_error:
+                logger.error(f"Error deleting partial cached delivery: {delete_error}")
+        return False
+    
+    delivery_stats["hits"] += 1
+    await db.record_delivery_hit(key)
+    
+    await message.edit(
+        f"✅ **Download and upload completed!**\n\n"
+        f"**Title:** {title}\n"
+        f"**Parts:** {len(delivery['parts'])}\n"
+        f"⚡ Delivered instantly from cache"
+    )
+    return True
+    
+def job_video_id(url_id):
+    """File name prefix of a job, stable across restarts so partial downloads resume"""
+    return re.sub(r'[^\w-]', '_', url_id)
+
+class JobCancelled(Exception):
+    """Raised inside a job once the user cancelled it"""
+
+async def run_until_cancelled(awaitable, cancel_event):
+    """Await a job step, cancelling it as soon as the job is cancelled.
+
+    Cancelling the step kills any ffmpeg/ffprobe child it is waiting on.
+    """
+    if cancel_event.is_set():
+        raise JobCancelled()
     
+    step = asyncio.ensure_future(awaitable)
+    waiter = asyncio.ensure_future(cancel_event.wait())
+    try:
+        await asyncio.wait({step, waiter}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        waiter.cancel()
+        if not step.done():
+            step.cancel()
+            await asyncio.gather(step, return_exceptions=True)
+    
+    if step.cancelled():
+        raise JobCancelled()
+    return step.result()
+
+def plan_ranged_download(info, expected_size, split_enabled):
+    """Time ranges to fetch an oversized video in, or None to download it whole"""
+    if not (RANGED_PARTS_ENABLED and split_enabled and info and info.get("duration")):
+        return None
+    if not expected_size or expected_size <= MAX_FILE_SIZE:
+        return None
+    return yt_helper.plan_time_ranges(info["duration"], expected_size)
+
+def describe_cancellation(stage, work):
+    """Summarise the work a cancellation stopped"""
+    text = f"⏹️ **Download Cancelled**\n\nStopped during: {stage}\n"
+    
+    if work["expected_bytes"] > work["downloaded_bytes"]:
+        text += (
+            f"💾 Not downloaded: {format_size(work['expected_bytes'] - work['downloaded_bytes'])} "
+            f"of {format_size(work['expected_bytes'])}\n"
+        )
+    if work["upload_bytes"] > work["uploaded_bytes"]:
+        text += f"📤 Not uploaded: {format_size(work['upload_bytes'] - work['uploaded_bytes'])}\n"
+    if work["pending_steps"]:
+        text += f"⏭️ Skipped: {', '.join(work['pending_steps'])}\n"
+    if work["removed_bytes"]:
+        text += f"🧹 Removed {format_size(work['removed_bytes'])} of partial files\n"
+    return text
+
 async def process_download(client, message, url, url_id, format_id, user_id, cancel_event):
+    """Download, process and upload one URL. Returns True when it was delivered."""
     try:
         user_data = await db.get_user(user_id)
         if not user_data:
             await message.edit("❌ User data not found.")
+            await db.update_url_status(url_id, "failed")
             return
         
-        # Update URL status
-        await db.update_url_status(url_id, "downloading")
+        # Get user preferences
+        upload_mode = user_data.get("upload_mode", DEFAULT_UPLOAD_MODE)
+        split_enabled = user_data.get("split_enabled", DEFAULT_SPLIT_SETTING)
+        caption_enabled = user_data.get("caption_enabled", False)
+        custom_caption = user_data.get("caption") if caption_enabled else None
+        custom_thumbnail_file_id = user_data.get("thumbnail")
+        generate_screenshots = user_data.get("generate_screenshots", False)
+        generate_sample_video = user_data.get("generate_sample_video", False)
+        tier = get_user_tier(user_id, user_data)
+        
+        # What has been done so far, reported if the job gets cancelled
+        stage = "queue"
+        video_id = None
+        generated_thumbnails = []
+        work = {
+            "downloaded_bytes": 0, "expected_bytes": 0,
+            "uploaded_bytes": 0, "upload_bytes": 0,
+            "pending_steps": [], "removed_bytes": 0
+        }
         
         try:
-            download_result = await yt_helper.download_video(
-                url=url,
-                format_id=format_id,
-                cancel_event=cancel_event
-            )
-            if cancel_event.is_set():
-                await message.edit("✖️ Download cancelled by user")
-                return
+            # Pick up where a job interrupted by a restart stopped
+            url_doc = await db.get_url(url_id) or {}
+            job = url_doc.get("job") or {}
+            # Keyed by the part's position in the split plan, which stays the
+            # same across runs even when re-split parts shift the indices
+            uploaded_parts = {tuple(part.get("key") or [part["index"]]): part for part in job.get("uploaded_parts", [])}
+            resumed_file = job.get("file_path") if job.get("stage") == "upload" else None
+            if resumed_file and not os.path.exists(resumed_file):
+                resumed_file = None
+            # Time-ranged parts line up with an earlier run without any file on disk
+            time_ranges = None if resumed_file else job.get("time_ranges")
+            if not resumed_file and not time_ranges and uploaded_parts:
+                # The file is gone, so its parts can't be matched up any more
+                uploaded_parts = {}
+                await db.update_job(url_id, {"uploaded_parts": []})
+            
+            # Serve a previous delivery of the same file by file_id. Deliveries
+            # with a custom thumbnail are never shared since it is baked in.
+            delivery_key = None
+            if not custom_thumbnail_file_id:
+                delivery_key = get_delivery_key(url, format_id, upload_mode, split_enabled)
+            if delivery_key and not uploaded_parts:
+                served = await send_cached_delivery(
+                    client, message, delivery_key, user_id, custom_caption,
+                    generate_screenshots and upload_mode == "video",
+                    generate_sample_video and upload_mode == "video"
+                )
+                if served:
+                    await db.update_url_status(url_id, "completed")
+                    return True
+            
+            if resumed_file:
+                logger.info(f"Resuming upload of {url_id} from {resumed_file}")
+                download_result = {
+                    "success": True,
+                    "file_path": resumed_file,
+                    "title": job.get("title", "Unknown Title"),
+                    "video_id": job.get("video_id")
+                }
+            else:
+                # Only used for estimates, so it doesn't count as a cache lookup
+                cached_info = await info_cache.peek(*yt_helper.get_url_key(url))
+                expected_size = job.get("expected_size") or estimate_download_size(cached_info, format_id)
+                # Oversized videos can be fetched as parts so the full file never hits the disk
+                time_ranges = time_ranges or plan_ranged_download(cached_info, expected_size, split_enabled)
+                
+                # Reserve the job's peak disk usage, waiting while the host is short on resources
+                if time_ranges:
+                    footprint = estimate_ranged_footprint(cached_info, format_id, len(time_ranges))
+                else:
+                    footprint = estimate_footprint(cached_info, format_id)
+                
+                async def announce_wait(reason):
+                    await message.edit(
+                        f"⏳ **Queued...**\n\nWaiting for {RESOURCE_WAIT_LABELS[reason]}.",
+                        reply_markup=download_cancel_markup(url_id)
+                    )
                 
+                admitted = await run_until_cancelled(admission.reserve(url_id, footprint, on_wait=announce_wait), cancel_event)
+                if not admitted:
+                    await message.edit(
+                        f"❌ **Not enough disk space**\n\n"
+                        f"This download needs about {format_size(footprint)}, more than the server can hold."
+                    )
+                    await db.update_url_status(url_id, "failed")
+                    return
+                
+                if time_ranges:
+                    # Each part takes a download slot of its own in the upload pipeline below
+                    await db.update_url_status(url_id, "downloading")
+                    download_result = {
+                        "success": True,
+                        "file_path": None,
+                        "title": cached_info.get("title", "Unknown Title") if cached_info else job.get("title", "Unknown Title"),
+                        "video_id": job_video_id(url_id)
+                    }
+                else:
+                    queued = scheduler.is_full("download")
+                    if queued:
+                        await message.edit(
+                            "⏳ **Queued...**\n\nWaiting for a free download slot.",
+                            reply_markup=download_cancel_markup(url_id)
+                        )
+                
+                    await run_until_cancelled(scheduler.acquire("download", user_id, tier), cancel_event)
+                    try:
+                        stage = "download"
+                        if queued:
+                            await message.edit(
+                                "⏬ **Downloading...**\n\n"
+                                "Please wait, this might take some time.",
+                                reply_markup=download_cancel_markup(url_id)
+                            )
+                    
+                        # Update URL status
+                        await db.update_url_status(url_id, "downloading")
+                    
+                        download_result = await yt_helper.download_video(
+                            url=url,
+                            format_id=format_id,
+                            video_id=job_video_id(url_id),
+                            progress_callback=make_download_progress_renderer(message, url_id),
+                            cancel_event=cancel_event
+                        )
+                    finally:
+                        scheduler.release("download")
+            
+            if download_result.get("cancelled"):
+                work["downloaded_bytes"] = download_result["downloaded_bytes"]
+                work["expected_bytes"] = download_result["total_bytes"]
+                work["removed_bytes"] += download_result["removed_bytes"]
+                raise JobCancelled()
+            
             if not download_result["success"]:
                 await message.edit(f"❌ Download failed: {download_result.get('error', 'Unknown error')}")
+                await db.update_url_status(url_id, "failed")
                 return
             
             file_path = download_result["file_path"]
             title = download_result["title"]
+            video_id = download_result["video_id"]
+            if download_result.get("throughput_samples"):
+                await db.store_throughput_samples(url_id, download_result["throughput_samples"])
+            job_fields = {"stage": "upload", "file_path": file_path, "title": title, "video_id": video_id}
+            if time_ranges:
+                job_fields.update({"time_ranges": time_ranges, "expected_size": expected_size})
+            await db.update_job(url_id, job_fields)
+            stage = "processing"
             
             # Update message to show processing
-            await message.edit(
-                f"✅ **Download Complete!**\n\n"
-                f"**Title:** {title}\n"
-                f"📤 Processing upload..."
-            )
-                        
-            # Get user preferences
-            upload_mode = user_data.get("upload_mode", DEFAULT_UPLOAD_MODE)
-            split_enabled = user_data.get("split_enabled", DEFAULT_SPLIT_SETTING)
-            caption_enabled = user_data.get("caption_enabled", False)
-            custom_caption = user_data.get("caption") if caption_enabled else None
-            custom_thumbnail_file_id = user_data.get("thumbnail")
-            generate_screenshots = user_data.get("generate_screenshots", False)
-            generate_sample_video = user_data.get("generate_sample_video", False)
+            if time_ranges:
+                await message.edit(
+                    f"⏬ **Downloading in {len(time_ranges)} parts...**\n\n"
+                    f"**Title:** {title}\n"
+                    f"Each part is uploaded as soon as it is ready."
+                )
+            else:
+                await message.edit(
+                    f"✅ **Download Complete!**\n\n"
+                    f"**Title:** {title}\n"
+                    f"📤 Processing upload..."
+                )
             
             # Check if file needs to be split
-            file_size = os.path.getsize(file_path)
-            file_paths = [file_path]
+            if time_ranges:
+                # The reservation already covers the staged parts only
+                file_size = expected_size
+            else:
+                file_size = os.path.getsize(file_path)
+                # The download is on disk now, only the split parts are still to come
+                # (byte-range parts of file mode take no disk at all)
+                byte_split = upload_mode != "video" and DOCUMENT_BYTE_SPLIT
+                admission.update(url_id, staging_estimate(file_size) if split_enabled and not byte_split else 0)
+            file_paths = []
+            part_sizes = [part.get("size", 0) for part in uploaded_parts.values()]
+            part_total = max((part["total"] for part in uploaded_parts.values()), default=1)
             
             # Extract original file metadata
             original_metadata = {"width": None, "height": None, "duration": 0}
+            # Work the fast path saved, reported with the result
+            skipped_steps = []
             
-            if upload_mode == "video" and file_path.lower().endswith((".mp4", ".mkv", ".avi", ".webm")):
-                original_metadata = await extract_video_metadata(file_path)
+            # An upload-ready MP4 is described by yt-dlp already and needs no re-probe
+            ready_metadata = yt_helper.upload_ready_metadata(download_result) if upload_mode == "video" else None
+            known_duration = ready_metadata["duration"] if ready_metadata else None
             
-            # Dictionary to store metadata for each part
-            part_metadata = {}
+            if time_ranges:
+                original_metadata["duration"] = int(time_ranges[-1][1])
+            elif ready_metadata:
+                original_metadata = ready_metadata
+                # Later stages (split plan, thumbnail) read it from the probe cache
+                media_probe.remember(file_path, MediaInfo(
+                    duration=download_result['duration'], width=ready_metadata["width"], height=ready_metadata["height"],
+                    vcodec=download_result.get('vcodec'), acodec=None if download_result.get('acodec') == 'none' else download_result.get('acodec'),
+                    size=file_size
+                ))
+                skipped_steps.append("metadata probe")
+            elif upload_mode == "video" and file_path.lower().endswith((".mp4", ".mkv", ".avi", ".webm")):
+                original_metadata = await extract_video_metadata(file_path, fallback=download_result)
             
-            if file_size > MAX_FILE_SIZE and split_enabled:
+            needs_split = bool(time_ranges) or (file_size > MAX_FILE_SIZE and split_enabled)
+            # File mode sends oversized files as byte ranges of the original
+            byte_parts = needs_split and not time_ranges and upload_mode != "video" and DOCUMENT_BYTE_SPLIT
+            # A file uploaded in one piece (or in byte ranges) goes up byte for byte as downloaded
+            bytes_not_rewritten = file_size if not needs_split or byte_parts else 0
+            if byte_parts:
+                skipped_steps.append("split pass")
+            work["upload_bytes"] = file_size
+            work["uploaded_bytes"] = sum(part_sizes)
+            work["pending_steps"] = (
+                (["splitting"] if needs_split else []) +
+                (["screenshots"] if generate_screenshots and upload_mode == "video" else []) +
+                (["sample video"] if generate_sample_video and upload_mode == "video" else [])
+            )
+            if byte_parts:
+                await message.edit(
+                    f"📦 **Uploading in parts...**\n\n"
+                    f"File size: {format_size(file_size)} exceeds Telegram limit.\n"
+                    f"Sending it as byte-range parts to join after download."
+                )
+            elif needs_split and not time_ranges:
                 await message.edit(
                     f"📦 **Splitting file...**\n\n"
                     f"File size: {format_size(file_size)} exceeds Telegram limit.\n"
                     f"Splitting into smaller parts."
                 )
-                
-                file_paths = await yt_helper.split_file(file_path)
-                
-                # Calculate metadata for each part if we're dealing with video
-                if upload_mode == "video" and original_metadata["duration"] > 0:
-                    total_size = sum(os.path.getsize(path) for path in file_paths)
-                    
-                    for i, part_path in enumerate(file_paths):
-                        part_size = os.path.getsize(part_path)
-                        
-                        # First try to get accurate metadata
-                        part_meta = await extract_video_metadata(part_path)
-                        
-                        # If we couldn't get accurate duration, estimate based on size proportion
-                        if part_meta["duration"] == 0:
-                            # Proportion of file size to estimate duration
-                            size_ratio = part_size / file_size
-                            estimated_duration = int(original_metadata["duration"] * size_ratio)
-                            part_meta["duration"] = estimated_duration
-                        
-                        # Store metadata
-                        part_metadata[part_path] = {
-                            "duration": part_meta["duration"],
-                            "width": part_meta["width"] or original_metadata["width"],
-                            "height": part_meta["height"] or original_metadata["height"],
-                            "size": part_size
-                        }
             
             # Prepare base caption
             caption = f"**{title}**"
@@ -1587,8 +2223,12 @@ async def process_download(client, message, url, url_id, format_id, user_id, can
                 caption = f"{caption}\n\n{custom_caption}"
             
             # Upload files
-            uploaded_files = []
-            generated_thumbnails = []
+            uploaded_files = [part["message_id"] for part in uploaded_parts.values()]
+            # part key -> delivered file, including parts sent before a restart
+            delivered_parts = {
+                key: {"file_id": part["file_id"], "caption_suffix": part["caption_suffix"]}
+                for key, part in uploaded_parts.items()
+            }
             
             # Download custom thumbnail if available
             custom_thumbnail_path = None
@@ -1613,102 +2253,275 @@ async def process_download(client, message, url, url_id, format_id, user_id, can
                     logger.error(f"Failed to download custom thumbnail: {e}")
                     custom_thumbnail_path = None
             
-            for i, part_path in enumerate(file_paths):
-                # Get correct metadata for this part
-                width = original_metadata["width"]
-                height = original_metadata["height"]
-                duration = original_metadata["duration"]
-                part_size = os.path.getsize(part_path)
-                
-                # If this is a split part, use its specific metadata
-                if part_path in part_metadata:
-                    width = part_metadata[part_path]["width"]
-                    height = part_metadata[part_path]["height"]
-                    duration = part_metadata[part_path]["duration"]
-                    part_size = part_metadata[part_path]["size"]
-                
-                # Create part-specific caption
-                part_caption = caption
-                if len(file_paths) > 1:
-                    part_duration_str = format_time(duration) if duration else "Unknown"
-                    part_size_str = format_size(part_size)
-                    part_caption = f"{caption}\n\n" \
-                                  f"Part {i+1}/{len(file_paths)}\n" \
-                                  f"Duration: {part_duration_str}\n" \
-                                  f"Size: {part_size_str}"
-                
-                # Determine which thumbnail to use
-                current_thumbnail = None
-                
-                if custom_thumbnail_path and os.path.exists(custom_thumbnail_path):
-                    # Use downloaded custom thumbnail if available
-                    current_thumbnail = custom_thumbnail_path
+            # Parts flow through three concurrent stages: split -> prepare
+            # (metadata and thumbnail) -> upload, so part 1 uploads while part 2
+            # is still being cut. Parts are deleted once uploaded and at most
+            # MAX_STAGED_PARTS of them exist on disk at any time.
+            staged_parts = asyncio.Semaphore(MAX_STAGED_PARTS)
+            prepare_queue = asyncio.Queue()
+            upload_queue = asyncio.Queue()
+            # Without a full file, screenshots and the sample come from the first part
+            keep_media_source = bool(time_ranges) and upload_mode == "video" and (generate_screenshots or generate_sample_video)
+            media_source = None
+            
+            async def single_part():
+                if (0,) not in uploaded_parts:
+                    yield 0, 1, file_path, known_duration, (0,)
+            
+            split_status = {"active": needs_split and not byte_parts}
+            # Bytes of split parts cut so far, and of those still on disk
+            split_disk = {"cut": 0, "staged": 0}
+            tracks_split_disk = needs_split and not byte_parts and not time_ranges
+            source_disk = os.stat(file_path).st_blocks * 512 if tracks_split_disk else 0
+            
+            def refresh_split_reservation():
+                # The staging window is held until the parts left to cut fit inside it
+                if not tracks_split_disk:
+                    return
+                reserve = split_reservation(file_size, split_disk["cut"], split_disk["staged"])
+                # Whatever the job has on disk besides the source is written already,
+                # a part ffmpeg is still writing included
+                written = yt_helper.job_disk_usage(video_id) - source_disk if video_id else split_disk["staged"]
+                admission.update(url_id, reserve, written=min(max(0, written), reserve))
+            
+            async def render_split_progress(done, total):
+                refresh_split_reservation()
+                # Upload progress takes over the status message with the first part
+                if split_status["active"] and total:
                     await message.edit(
-                        f"📤 **Starting Upload...**\n\n"
-                        f"File: {os.path.basename(part_path)}\n"
-                        f"Part: {i+1}/{len(file_paths)}\n"
-                        f"Size: {format_size(part_size)}\n"
-                        f"Using custom thumbnail"
+                        f"📦 **Splitting file...**\n\n"
+                        f"File size: {format_size(file_size)}\n"
+                        f"Progress: {done * 100 / total:.0f}% ({format_time(done)} of {format_time(total)})"
                     )
-                else:
-                    # Generate unique thumbnail for each part
-                    await message.edit(
-                        f"📤 **Preparing Upload...**\n\n"
-                        f"File: {os.path.basename(part_path)}\n"
-                        f"Part: {i+1}/{len(file_paths)}\n"
-                        f"Size: {format_size(part_size)}\n"
-                        f"Generating unique thumbnail..."
+            
+            async def produce_parts():
+                nonlocal part_total, media_source
+                # Parts already sent before a restart are not cut (or fetched) again
+                slot_stage = "postprocess"
+                if time_ranges:
+                    parts = yt_helper.iter_ranged_parts(
+                        url, format_id, video_id, time_ranges,
+                        cancel_event=cancel_event, skip_parts=set(uploaded_parts)
                     )
-                    
-                    if upload_mode == "video":
+                    slot_stage = "download"
+                elif byte_parts:
+                    parts = yt_helper.iter_byte_range_parts(file_path, skip_parts=set(uploaded_parts))
+                elif needs_split:
+                    parts = yt_helper.iter_split_parts(
+                        file_path, skip_parts=set(uploaded_parts), duration=known_duration,
+                        progress_callback=render_split_progress
+                    )
+                else:
+                    parts = single_part()
+                try:
+                    while True:
+                        await staged_parts.acquire()
                         try:
-                            # Generate thumbnail from this specific part
-                            current_thumbnail = await yt_helper.generate_thumbnail(part_path)
-                            if current_thumbnail and os.path.exists(current_thumbnail):
-                                generated_thumbnails.append(current_thumbnail)
-                            else:
-                                logger.warning(f"Failed to generate thumbnail for part {i+1}, proceeding without it")
-                        except Exception as e:
-                            logger.error(f"Error generating thumbnail for part {i+1}: {e}")
-                
-                # Update status to uploading
-                await message.edit(
-                    f"📤 **Starting Upload...**\n\n"
-                    f"File: {os.path.basename(part_path)}\n"
-                    f"Part: {i+1}/{len(file_paths)}\n"
-                    f"Size: {format_size(part_size)}"
-                )
-                
-                # Upload with progress using the current thumbnail
+                            async with scheduler.slot(slot_stage, user_id, tier):
+                                index, total, part_path, part_duration, key = await run_until_cancelled(parts.__anext__(), cancel_event)
+                        except StopAsyncIteration:
+                            staged_parts.release()
+                            break
+                        if not byte_parts:
+                            file_paths.append(part_path)
+                        if tracks_split_disk:
+                            cut_size = os.path.getsize(part_path)
+                            split_disk["cut"] += cut_size
+                            split_disk["staged"] += cut_size
+                            refresh_split_reservation()
+                        part_total = total
+                        if keep_media_source and media_source is None:
+                            media_source = part_path
+                        await prepare_queue.put((index, total, part_path, part_duration, key))
+                finally:
+                    await parts.aclose()
+                    await prepare_queue.put(None)
+            
+            async def prepare_parts():
                 try:
-                    sent_message = await upload_file_with_progress(
-                        client=client,
-                        message=message,
-                        file_path=part_path,
-                        chat_id=user_id,
-                        caption=part_caption,
-                        upload_mode=upload_mode,
-                        thumb=current_thumbnail,
-                        duration=duration,
-                        width=width,
-                        height=height
-                    )
+                    while True:
+                        item = await prepare_queue.get()
+                        if item is None:
+                            break
+                        index, total, part_path, part_duration, key = item
+                        
+                        # Get correct metadata for this part
+                        width = original_metadata["width"]
+                        height = original_metadata["height"]
+                        duration = original_metadata["duration"]
+                        part_size = part_path.length if byte_parts else os.path.getsize(part_path)
+                        part_sizes.append(part_size)
+                        
+                        if total > 1 and part_duration:
+                            # The split plan knows each part's exact duration
+                            duration = int(round(part_duration))
+                            if "part probes" not in skipped_steps:
+                                skipped_steps.append("part probes")
+                        # Calculate metadata for each split part if we're dealing with video
+                        elif total > 1 and upload_mode == "video" and original_metadata["duration"] > 0:
+                            # First try to get accurate metadata
+                            part_meta = await extract_video_metadata(part_path)
+                            
+                            # If we couldn't get accurate duration, estimate based on size proportion
+                            if part_meta["duration"] == 0:
+                                size_ratio = part_size / file_size
+                                part_meta["duration"] = int(original_metadata["duration"] * size_ratio)
+                            
+                            duration = part_meta["duration"]
+                            width = part_meta["width"] or original_metadata["width"]
+                            height = part_meta["height"] or original_metadata["height"]
+                        
+                        # Determine which thumbnail to use
+                        current_thumbnail = None
+                        if custom_thumbnail_path and os.path.exists(custom_thumbnail_path):
+                            # Use downloaded custom thumbnail if available
+                            current_thumbnail = custom_thumbnail_path
+                        elif upload_mode == "video":
+                            try:
+                                # Generate unique thumbnail from this specific part
+                                # The whole upload-ready file's duration is known already
+                                thumb_duration = known_duration if part_path == file_path else part_duration
+                                if thumb_duration and "thumbnail probes" not in skipped_steps:
+                                    skipped_steps.append("thumbnail probes")
+                                async with scheduler.slot("postprocess", user_id, tier):
+                                    current_thumbnail = await run_until_cancelled(
+                                        yt_helper.generate_thumbnail(part_path, duration=thumb_duration), cancel_event
+                                    )
+                                if current_thumbnail and os.path.exists(current_thumbnail):
+                                    generated_thumbnails.append(current_thumbnail)
+                                else:
+                                    logger.warning(f"Failed to generate thumbnail for part {index+1}, proceeding without it")
+                            except JobCancelled:
+                                raise
+                            except Exception as e:
+                                logger.error(f"Error generating thumbnail for part {index+1}: {e}")
+                        
+                        await upload_queue.put((index, total, part_path, part_size, duration, width, height, current_thumbnail, key))
+                finally:
+                    await upload_queue.put(None)
+            
+            producer = asyncio.create_task(produce_parts())
+            preparer = asyncio.create_task(prepare_parts())
+            
+            try:
+                while True:
+                    item = await upload_queue.get()
+                    if item is None:
+                        break
+                    index, total, part_path, part_size, duration, width, height, current_thumbnail, key = item
+                    split_status["active"] = False
+                    stage = f"upload of part {index+1}/{total}" if total > 1 else "upload"
                     
-                    uploaded_files.append(sent_message.id)
+                    # Create part-specific caption
+                    part_caption = caption
+                    part_suffix = ""
+                    if byte_parts:
+                        joined_name = os.path.basename(file_path)
+                        part_suffix = f"\n\n" \
+                                      f"Part {index+1}/{total}\n" \
+                                      f"Size: {format_size(part_size)}\n" \
+                                      f"🧩 Join all parts: `cat {joined_name}.part* > {joined_name}`\n" \
+                                      f"(Windows: `copy /b {joined_name}.part01+{joined_name}.part02+... {joined_name}`)"
+                        part_caption = f"{caption}{part_suffix}"
+                    elif total > 1:
+                        part_duration_str = format_time(duration) if duration else "Unknown"
+                        part_size_str = format_size(part_size)
+                        part_suffix = f"\n\n" \
+                                      f"Part {index+1}/{total}\n" \
+                                      f"Duration: {part_duration_str}\n" \
+                                      f"Size: {part_size_str}"
+                        part_caption = f"{caption}{part_suffix}"
                     
-                except Exception as e:
-                    logger.error(f"Error uploading file: {e}")
-                    await client.send_message(
-                        chat_id=user_id,
-                        text=f"❌ Error uploading part {i+1}: {str(e)}"
+                    # Update status to uploading
+                    await message.edit(
+                        f"📤 **Starting Upload...**\n\n"
+                        f"File: {part_path.name if byte_parts else os.path.basename(part_path)}\n"
+                        f"Part: {index+1}/{total}\n"
+                        f"Size: {format_size(part_size)}" +
+                        ("\nUsing custom thumbnail" if current_thumbnail and current_thumbnail == custom_thumbnail_path else "")
                     )
+                    
+                    # Upload with progress using the current thumbnail
+                    try:
+                        async with scheduler.slot("upload", user_id, tier):
+                            sent_message = await upload_file_with_progress(
+                                client=client,
+                                message=message,
+                                file_path=part_path,
+                                chat_id=user_id,
+                                caption=part_caption,
+                                upload_mode=upload_mode,
+                                thumb=current_thumbnail,
+                                duration=duration,
+                                width=width,
+                                height=height,
+                                cancel_event=cancel_event
+                            )
+                        if sent_message is None or cancel_event.is_set():
+                            raise JobCancelled()
+                        
+                        work["uploaded_bytes"] += part_size
+                        uploaded_files.append(sent_message.id)
+                        
+                        sent_media = sent_message.video or sent_message.document
+                        if sent_media:
+                            delivered_parts[key] = {"file_id": sent_media.file_id, "caption_suffix": part_suffix}
+                            await db.record_uploaded_part(url_id, {
+                                "index": index,
+                                "key": list(key),
+                                "total": total,
+                                "message_id": sent_message.id,
+                                "file_id": sent_media.file_id,
+                                "caption_suffix": part_suffix,
+                                "size": part_size
+                            })
+                        
+                    except JobCancelled:
+                        raise
+                    except Exception as e:
+                        logger.error(f"Error uploading file: {e}")
+                        await client.send_message(
+                            chat_id=user_id,
+                            text=f"❌ Error uploading part {index+1}: {str(e)}"
+                        )
+                    finally:
+                        # Free the staging slot so the next part can be cut
+                        if byte_parts:
+                            part_path.close()
+                        elif part_path != file_path and part_path != media_source:
+                            yt_helper.cleanup_files(part_path)
+                            if tracks_split_disk:
+                                split_disk["staged"] -= part_size
+                                refresh_split_reservation()
+                        staged_parts.release()
+                
+                # Surface errors raised by the split or prepare stage
+                await asyncio.gather(producer, preparer)
+                if "splitting" in work["pending_steps"]:
+                    work["pending_steps"].remove("splitting")
+            finally:
+                producer.cancel()
+                preparer.cancel()
+                # Let the split generator kill ffmpeg before anything cleans up,
+                # or a resumed cutter could write one more part afterwards
+                await asyncio.gather(producer, preparer, return_exceptions=True)
+            
+            # Duration of the source of screenshots and sample, if known without a probe
+            source_duration = None if media_source else known_duration
             
             # Generate and send screenshots if enabled
             screenshots = []
+            screenshot_file_ids = []
             if generate_screenshots and upload_mode == "video":
+                stage = "screenshots"
                 await message.edit("🖼️ **Generating screenshots...**")
                 
-                screenshots = await yt_helper.generate_screenshots(file_path) or []
+                async with scheduler.slot("postprocess", user_id, tier):
+                    screenshots = await run_until_cancelled(
+                        yt_helper.generate_screenshots(media_source or file_path, duration=source_duration), cancel_event
+                    ) or []
+                if source_duration:
+                    skipped_steps.append("screenshot probe")
                 
                 if screenshots:
                     # Send screenshots as a media group
@@ -1723,14 +2536,23 @@ async def process_download(client, message, url, url_id, format_id, user_id, can
                             )
                     
                     if media_group:
-                        await client.send_media_group(user_id, media_group)
+                        sent_group = await run_until_cancelled(client.send_media_group(user_id, media_group), cancel_event)
+                        screenshot_file_ids = [m.photo.file_id for m in sent_group if m.photo]
+                work["pending_steps"].remove("screenshots")
             
             # Generate and send sample video if enabled
             sample_path = None
+            sample_file_id = None
             if generate_sample_video and upload_mode == "video":
+                stage = "sample video"
                 await message.edit("🎬 **Generating sample video...**")
                 
-                sample_path = await yt_helper.generate_sample_video(file_path)
+                async with scheduler.slot("postprocess", user_id, tier):
+                    sample_path = await run_until_cancelled(
+                        yt_helper.generate_sample_video(media_source or file_path, video_duration=source_duration), cancel_event
+                    )
+                if source_duration:
+                    skipped_steps.append("sample probe")
                 
                 if sample_path and os.path.exists(sample_path):
                     # Get sample video metadata
@@ -1752,36 +2574,65 @@ async def process_download(client, message, url, url_id, format_id, user_id, can
                     else:
                         # Generate a new thumbnail for the sample
                         try:
-                            sample_thumbnail = await yt_helper.generate_thumbnail(sample_path)
+                            async with scheduler.slot("postprocess", user_id, tier):
+                                sample_thumbnail = await run_until_cancelled(yt_helper.generate_thumbnail(sample_path), cancel_event)
                             if sample_thumbnail and os.path.exists(sample_thumbnail):
                                 generated_thumbnails.append(sample_thumbnail)
+                        except JobCancelled:
+                            raise
                         except Exception as e:
                             logger.error(f"Error generating thumbnail for sample video: {e}")
                     
-                    await upload_file_with_progress(
-                        client=client,
-                        message=message,
-                        file_path=sample_path,
-                        chat_id=user_id,
-                        caption=f"📽️ **Sample video of:** {title}",
-                        upload_mode="video",
-                        thumb=sample_thumbnail,
-                        duration=sample_metadata["duration"],
-                        width=sample_metadata["width"],
-                        height=sample_metadata["height"]
-                    )
+                    async with scheduler.slot("upload", user_id, tier):
+                        sample_message = await upload_file_with_progress(
+                            client=client,
+                            message=message,
+                            file_path=sample_path,
+                            chat_id=user_id,
+                            caption=f"📽️ **Sample video of:** {title}",
+                            upload_mode="video",
+                            thumb=sample_thumbnail,
+                            duration=sample_metadata["duration"],
+                            width=sample_metadata["width"],
+                            height=sample_metadata["height"],
+                            cancel_event=cancel_event
+                        )
+                    if sample_message is None or cancel_event.is_set():
+                        raise JobCancelled()
+                    if sample_message.video:
+                        sample_file_id = sample_message.video.file_id
+            
+            # Remember the file_ids so repeat requests skip download and upload
+            if delivery_key and delivered_parts and len(delivered_parts) == part_total:
+                await db.store_delivery(delivery_key, {
+                    "title": title,
+                    "parts": [delivered_parts[key] for key in sorted(delivered_parts)],
+                    "screenshots": screenshot_file_ids,
+                    "sample": sample_file_id
+                })
             
             # Final completion message
-            total_size_str = format_size(sum(os.path.getsize(path) for path in file_paths))
+            total_size_str = format_size(sum(part_sizes))
             total_duration_str = format_time(original_metadata["duration"]) if original_metadata["duration"] else "Unknown"
             
+            fast_path_str = ""
+            if skipped_steps or bytes_not_rewritten:
+                logger.info(f"Job {url_id} skipped {skipped_steps or 'nothing'}, {bytes_not_rewritten} bytes not rewritten")
+                await db.update_job(url_id, {"skipped_steps": skipped_steps, "bytes_not_rewritten": bytes_not_rewritten})
+                fast_path_str = "\n"
+                if bytes_not_rewritten:
+                    fast_path_str += f"\n⚡ **Uploaded as downloaded:** {format_size(bytes_not_rewritten)} not rewritten"
+                if skipped_steps:
+                    fast_path_str += f"\n⚡ **Skipped:** {', '.join(skipped_steps)}"
+            
             await message.edit(
                 f"✅ **Download and upload completed!**\n\n"
                 f"**Title:** {title}\n"
                 f"**Format:** {format_id}\n"
                 f"**Total Size:** {total_size_str}\n"
                 f"**Duration:** {total_duration_str}\n"
-                f"**Parts:** {len(file_paths)}"
+                f"**Parts:** {part_total}"
+                f"{fast_path_str}"
             )
             
             # Update URL status
@@ -1807,6 +2658,19 @@ async def process_download(client, message, url, url_id, format_id, user_id, can
             
             # Cleanup
             yt_helper.cleanup_files(cleanup_files)
+            return True
+        
+        except JobCancelled:
+            # Drop everything the job left on disk, including partial parts
+            work["removed_bytes"] += yt_helper.cleanup_job_files(video_id)
+            for thumb in generated_thumbnails:
+                if os.path.exists(thumb):
+                    work["removed_bytes"] += os.path.getsize(thumb)
+                    yt_helper.cleanup_files(thumb)
+            
+            logger.info(f"Job {url_id} cancelled during {stage}: {work}")
+            await db.update_url_status(url_id, "cancelled")
+            await message.edit(describe_cancellation(stage, work))
         
         except Exception as e:
             logger.error(f"Error in process_download: {e}")
@@ -1817,13 +2681,131 @@ async def process_download(client, message, url, url_id, format_id, user_id, can
         
         finally:
             # Clean up
-            if url_id in active_downloads:
-                del active_downloads[url_id]
+            unregister_download(url_id, user_id)
+            admission.release(url_id)
 
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
             
 
+class SilentStatus:
+    """Stand-in for a status message when a job reports progress elsewhere"""
+    
+    def __init__(self):
+        self.text = None
+    
+    async def edit(self, text, *args, **kwargs):
+        self.text = text
+
+def render_batch_progress(title, total, done, failed, in_progress, start_time):
+    """Render the single aggregate progress message of a batch job"""
+    finished = len(done) + len(failed)
+    percentage = (finished / total) * 100 if total else 100
+    bar_length = 10
+    filled_length = int(bar_length * finished // total) if total else bar_length
+    progress_bar = '█' * filled_length + '░' * (bar_length - filled_length)
+    
+    text = f"📃 **{title}**\n\n"
+    text += f"**Progress:** {finished}/{total} ({percentage:.1f}%)\n"
+    text += f"{progress_bar}\n"
+    text += f"✅ Delivered: {len(done)}\n"
+    text += f"❌ Failed: {len(failed)}\n"
+    text += f"⏱️ Elapsed: {format_time(time.time() - start_time)}\n"
+    
+    if in_progress:
+        text += "\n**In progress:**\n"
+        for entry_title in list(in_progress.values())[:5]:
+            text += f"• {entry_title}\n"
+    return text
+
+async def process_batch(client, message, url_id, format_id, user_id, cancel_event):
+    """Feed every entry of a playlist or batch job through process_download"""
+    try:
+        job = await db.get_url(url_id)
+        entries = job.get("entries", [])
+        title = job.get("title") or "Batch download"
+        total = len(entries)
+        
+        done = set(job.get("completed_entries", []))
+        pending = [i for i in range(total) if i not in done]
+        failed = {}
+        in_progress = {}
+        start_time = time.time()
+        
+        await db.update_url_status(url_id, "downloading")
+        await db.update_batch(url_id, {"format_id": format_id})
+        
+        cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⏹️ Cancel", callback_data=f"cancel_dl|{url_id}")]])
+        
+        async def run_entry(index):
+            entry = entries[index]
+            entry_url_id = f"{url_id}:{index}"
+            status = SilentStatus()
+            in_progress[index] = entry.get("title") or entry["url"]
+            
+            try:
+                await db.store_url(entry_url_id, entry["url"], user_id)
+                delivered = await process_download(client, status, entry["url"], entry_url_id, format_id, user_id, cancel_event)
+            except Exception as e:
+                logger.error(f"Error processing batch entry {index}: {e}")
+                delivered = False
+            finally:
+                in_progress.pop(index, None)
+            
+            if delivered:
+                done.add(index)
+                await db.mark_batch_entry_done(url_id, index)
+            elif not cancel_event.is_set():
+                failed[index] = status.text
+        
+        async def worker():
+            while pending and not cancel_event.is_set():
+                await run_entry(pending.pop(0))
+        
+        async def report_progress():
+            while True:
+                try:
+                    await message.edit(
+                        render_batch_progress(title, total, done, failed, in_progress, start_time),
+                        reply_markup=cancel_markup
+                    )
+                except MessageNotModified:
+                    pass
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+                except Exception as e:
+                    logger.error(f"Error updating batch progress: {e}")
+                await asyncio.sleep(5)
+        
+        reporter = asyncio.create_task(report_progress())
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, min(BATCH_CONCURRENCY, len(pending))))))
+        finally:
+            reporter.cancel()
+        
+        if cancel_event.is_set():
+            await db.update_url_status(url_id, "cancelled")
+            status_line = "⏹️ **Cancelled**"
+        elif failed:
+            await db.update_url_status(url_id, "partial")
+            status_line = "⚠️ **Completed with errors**"
+        else:
+            await db.update_url_status(url_id, "completed")
+            status_line = "✅ **All videos delivered!**"
+        
+        await message.edit(
+            f"{status_line}\n\n" + render_batch_progress(title, total, done, failed, {}, start_time)
+        )
+    except Exception as e:
+        logger.error(f"Error in process_batch: {e}")
+        await db.update_url_status(url_id, "failed")
+        try:
+            await message.edit(f"❌ An error occurred: {str(e)}")
+        except Exception:
+            pass
+    finally:
+        unregister_download(url_id, user_id)
+
 # Cleanup function to remove temporary files
 def cleanup_files(file_paths):
     for file_path in file_paths if isinstance(file_paths, list) else [file_paths]:
@@ -1834,16 +2816,56 @@ def cleanup_files(file_paths):
         except Exception as e:
             logger.error(f"Error removing file {file_path}: {e}")
 
+async def restore_jobs(client):
+    """Restart the jobs that were queued or running when the bot stopped"""
+    jobs = await db.get_unfinished_jobs()
+    for url_doc in jobs:
+        url_id = url_doc["url_id"]
+        job = url_doc["job"]
+        user_id = job["user_id"]
+        
+        try:
+            message = await client.get_messages(job["chat_id"], job["message_id"])
+            if not message or message.empty:
+                raise ValueError("status message is gone")
+            await message.edit(
+                "♻️ **Resuming after restart...**",
+                reply_markup=download_cancel_markup(url_id)
+            )
+        except Exception as e:
+            logger.warning(f"Could not reuse the status message of job {url_id}: {e}")
+            try:
+                message = await client.send_message(
+                    job["chat_id"], "♻️ **Resuming after restart...**",
+                    reply_markup=download_cancel_markup(url_id)
+                )
+            except Exception as e:
+                logger.error(f"Could not resume job {url_id}: {e}")
+                continue
+        
+        cancel_event = register_download(url_id, user_id)
+        if job["kind"] == "batch":
+            start_job(process_batch(client, message, url_id, job["format_id"], user_id, cancel_event))
+        else:
+            start_job(process_download(client, message, url_doc["url"], url_id, job["format_id"], user_id, cancel_event))
+    
+    if jobs:
+        logger.info(f"Resumed {len(jobs)} interrupted jobs")
+
 # Main function
 async def main():
+    await db.initialize()
     await app.start()
     logger.info("Bot started")
+    await restore_jobs(app)
     
     try:
         # Keep the bot running
         await idle()
     finally:
         await app.stop()
+        ydl_pool.close()
+        workers.shutdown()
         db.close()
         logger.info("Bot stopped")
 
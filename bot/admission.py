@@ -0,0 +1,238 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+from bot.config import (
+    DOWNLOAD_PATH, MAX_FILE_SIZE, MAX_STAGED_PARTS, ADMISSION_MIN_FREE_DISK, ADMISSION_MAX_MEMORY_PERCENT,
+    ADMISSION_MAX_LOAD, ADMISSION_DEFAULT_JOB_SIZE, ADMISSION_POLL_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+# Headroom on top of every estimate (container overhead, bitrate peaks)
+ESTIMATE_MARGIN = 1.1
+
+
+def format_size_estimate(fmt, duration):
+    """Expected size of one format: exact, approximate, or bitrate x duration"""
+    if fmt.get('filesize'):
+        return fmt['filesize']
+    if fmt.get('filesize_approx'):
+        return fmt['filesize_approx']
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+
+def estimate_download_size(info, format_id):
+    """Expected size of downloading format_id, or None if unknown"""
+    if not info:
+        return None
+
+    duration = info.get('duration')
+    formats = {f['format_id']: f for f in info.get('formats', []) if f.get('format_id')}
+    chosen = formats.get(format_id)
+    if chosen is not None:
+        return format_size_estimate(chosen, duration)
+
+    # A format selector such as bestvideo+bestaudio/best: assume the largest
+    sizes = [format_size_estimate(f, duration) for f in formats.values()]
+    return max((s for s in sizes if s), default=None)
+
+
+def is_merged_format(info, format_id):
+    formats = {f['format_id'] for f in (info or {}).get('formats', [])}
+    return format_id not in formats or '+' in format_id
+
+
+def estimate_footprint(info, format_id):
+    """Peak disk usage of a job downloading format_id, in bytes.
+
+    Merged formats keep the video and audio streams next to the merged
+    output until the merge finishes, and oversized files add up to
+    MAX_STAGED_PARTS split parts on top of the original.
+    """
+    size = estimate_download_size(info, format_id)
+    if not size:
+        return ADMISSION_DEFAULT_JOB_SIZE
+
+    merged = is_merged_format(info, format_id)
+    peak = size * 2 if merged else size
+    if size > MAX_FILE_SIZE:
+        peak += min(size, MAX_STAGED_PARTS * MAX_FILE_SIZE)
+    return int(peak * ESTIMATE_MARGIN)
+
+
+def estimate_ranged_footprint(info, format_id, part_count):
+    """Peak disk usage of a job fetched as time-ranged parts: only the staged parts exist at once"""
+    size = estimate_download_size(info, format_id) or ADMISSION_DEFAULT_JOB_SIZE
+    part_size = size / part_count
+    # A range that comes out oversized stays on disk while its pieces are cut
+    peak = part_size * (min(part_count, MAX_STAGED_PARTS) + 1)
+    if is_merged_format(info, format_id):
+        peak += part_size
+    return int(peak * ESTIMATE_MARGIN)
+
+
+def staging_estimate(file_size):
+    """Disk a downloaded file still needs for split parts"""
+    if file_size <= MAX_FILE_SIZE:
+        return 0
+    return int(min(file_size, MAX_STAGED_PARTS * MAX_FILE_SIZE) * ESTIMATE_MARGIN)
+
+
+def split_reservation(file_size, cut_bytes, staged_bytes):
+    """Disk a splitting job still needs: the staging window, until the parts left to cut fit inside it"""
+    remaining = max(0, file_size - cut_bytes) + staged_bytes
+    return min(staging_estimate(file_size), int(remaining * ESTIMATE_MARGIN))
+
+
+def memory_used_percent():
+    """Used memory from /proc/meminfo, or None where it isn't available"""
+    try:
+        values = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                values[name] = int(value.split()[0])
+        return 100.0 * (1 - values['MemAvailable'] / values['MemTotal'])
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+def load_per_cpu():
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (OSError, AttributeError):
+        return None
+
+
+class AdmissionController:
+    """Admits downloads only while the host has room for them.
+
+    Every job reserves its estimated peak disk usage against the free space
+    of DOWNLOAD_PATH, and waits while the reservation would leave less than
+    the minimum free disk or while memory or load are above their
+    watermarks. Reservations shrink as the job's artifacts are removed.
+    What a running job has already written is gone from the free space, so
+    only the rest of its reservation is held against new jobs.
+    """
+
+    def __init__(self, path=DOWNLOAD_PATH, min_free_disk=ADMISSION_MIN_FREE_DISK,
+                 max_memory_percent=ADMISSION_MAX_MEMORY_PERCENT, max_load=ADMISSION_MAX_LOAD,
+                 poll_interval=ADMISSION_POLL_INTERVAL):
+        self.path = path
+        self.min_free_disk = min_free_disk
+        self.max_memory_percent = max_memory_percent
+        self.max_load = max_load
+        self.poll_interval = poll_interval
+        self.reservations = {}
+        # Bytes each job has on disk towards its current reservation
+        self.written = {}
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._changed = asyncio.Event()
+
+    def reserved(self):
+        return sum(self.reservations.values())
+
+    def outstanding(self):
+        """Reserved bytes not yet written, i.e. not yet missing from the free space"""
+        return sum(max(0, size - self.written.get(job_id, 0)) for job_id, size in self.reservations.items())
+
+    def blocker(self, size):
+        """Why a job of the given size can't start now, or None if it can"""
+        usage = shutil.disk_usage(self.path)
+        if usage.free - self.outstanding() - size < self.min_free_disk:
+            return "disk"
+
+        memory = memory_used_percent()
+        if memory is not None and memory > self.max_memory_percent:
+            return "memory"
+
+        load = load_per_cpu()
+        if load is not None and load > self.max_load:
+            return "load"
+        return None
+
+    def fits_at_all(self, size):
+        """Whether the job could ever fit, even with no other reservations"""
+        return shutil.disk_usage(self.path).total - self.min_free_disk >= size
+
+    async def reserve(self, job_id, size, on_wait=None):
+        """Wait until the job fits, then reserve size bytes for it.
+
+        on_wait is awaited once with the blocking resource when the job has to
+        wait. Returns False if the job can never fit on this volume.
+        """
+        if not self.fits_at_all(size):
+            self.rejected += 1
+            return False
+
+        notified = False
+        started = time.time()
+        self.waiting += 1
+        try:
+            while True:
+                reason = self.blocker(size)
+                if reason is None:
+                    break
+                if not notified and on_wait:
+                    notified = True
+                    await on_wait(reason)
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiting -= 1
+
+        self.reservations[job_id] = size
+        self.admitted += 1
+        if notified:
+            logger.info(f"Job {job_id} admitted after waiting {time.time() - started:.0f}s for {size} bytes")
+        return True
+
+    def record_written(self, job_id, size):
+        """Report how many bytes of its reservation a job has written so far"""
+        if job_id in self.reservations:
+            self.written[job_id] = size
+            self._changed.set()
+
+    def update(self, job_id, size, written=0):
+        """Replace a job's reservation by what it still needs, written bytes of which are on disk already"""
+        if job_id in self.reservations:
+            self.reservations[job_id] = max(0, size)
+            self.written[job_id] = written
+            self._changed.set()
+
+    def release(self, job_id, size=None):
+        """Release size bytes of a job's reservation, or all of it"""
+        if job_id not in self.reservations:
+            return
+        if size is None or size >= self.reservations[job_id]:
+            del self.reservations[job_id]
+            self.written.pop(job_id, None)
+        else:
+            self.reservations[job_id] -= size
+        self._changed.set()
+
+    def stats(self):
+        usage = shutil.disk_usage(self.path)
+        return {
+            'free': usage.free,
+            'reserved': self.reserved(),
+            'outstanding': self.outstanding(),
+            'jobs': len(self.reservations),
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'memory_percent': memory_used_percent(),
+            'load_per_cpu': load_per_cpu()
+        }
+
+
+admission = AdmissionController()
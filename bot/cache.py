@@ -0,0 +1,152 @@
+import json
+import time
+import zlib
+import logging
+import datetime
+from collections import OrderedDict
+from bot.config import INFO_CACHE_SIZE, INFO_CACHE_TTL, INFO_CACHE_EXTRACTOR_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class InfoCache:
+    """Two-tier cache for compacted get_video_info results.
+
+    The first tier is an in-process LRU with per-entry expiry, the second tier
+    is a MongoDB collection shared by every node talking to the same database.
+    """
+
+    def __init__(self, max_entries=INFO_CACHE_SIZE, default_ttl=INFO_CACHE_TTL, extractor_ttl=None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.extractor_ttl = dict(extractor_ttl or {})
+        self.store = None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def attach(self, store):
+        """Use a Database instance as the shared second tier"""
+        self.store = store
+
+    def ttl_for(self, extractor):
+        """Get cache lifetime in seconds for an extractor"""
+        return self.extractor_ttl.get(extractor, self.default_ttl)
+
+    @staticmethod
+    def make_key(extractor, video_id):
+        return f"{extractor}:{video_id}"
+
+    def _get_local(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _put_local(self, key, value, expires_at):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, extractor, video_id):
+        """Look up a cached info dict, checking memory first and then MongoDB"""
+        value, tier = await self._lookup(self.make_key(extractor, video_id))
+        if tier == "memory":
+            self.hits += 1
+        elif tier == "shared":
+            self.remote_hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    async def peek(self, extractor, video_id):
+        """Like get, but without counting towards the hit/miss statistics"""
+        value, _ = await self._lookup(self.make_key(extractor, video_id))
+        return value
+
+    async def _lookup(self, key):
+        """Find an info dict in either tier. Returns (value, "memory" | "shared" | None)."""
+        value = self._get_local(key)
+        if value is not None:
+            return value, "memory"
+
+        if self.store is not None:
+            try:
+                doc = await self.store.get_cached_video_info(key)
+            except Exception as e:
+                logger.error(f"Error reading shared info cache: {e}")
+                doc = None
+
+            if doc and doc["expires_at"] > datetime.datetime.utcnow():
+                value = unpack_info(doc)
+                expires_at = time.time() + (doc["expires_at"] - datetime.datetime.utcnow()).total_seconds()
+                self._put_local(key, value, expires_at)
+                return value, "shared"
+
+        return None, None
+
+    async def put(self, extractor, video_id, value):
+        """Store an info dict in both tiers"""
+        key = self.make_key(extractor, video_id)
+        ttl = self.ttl_for(extractor)
+        if ttl <= 0:
+            return
+
+        self._put_local(key, value, time.time() + ttl)
+
+        if self.store is not None:
+            try:
+                await self.store.store_cached_video_info(
+                    key,
+                    pack_info(value),
+                    datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+                )
+            except Exception as e:
+                logger.error(f"Error writing shared info cache: {e}")
+
+    def invalidate(self, extractor, video_id):
+        self._entries.pop(self.make_key(extractor, video_id), None)
+
+    def stats(self):
+        """Return cache counters"""
+        lookups = self.hits + self.remote_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'remote_hits': self.remote_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': (self.hits + self.remote_hits) / lookups if lookups else 0.0
+        }
+
+
+def pack_info(info):
+    """Convert a compacted info dict into a MongoDB document with compressed formats"""
+    doc = {k: v for k, v in info.items() if k not in ('formats', 'video_id')}
+    doc['formats_z'] = zlib.compress(json.dumps(info.get('formats', []), separators=(',', ':')).encode())
+    return doc
+
+
+def unpack_info(doc):
+    """Inverse of pack_info"""
+    info = {k: v for k, v in doc.items() if k not in ('_id', 'key', 'formats_z', 'expires_at')}
+    info['formats'] = json.loads(zlib.decompress(doc['formats_z']).decode())
+    return info
+
+
+info_cache = InfoCache(extractor_ttl=INFO_CACHE_EXTRACTOR_TTL)
@@ -45,3 +45,100 @@ TASKS = 20
 
 # Temporary Download Path
 DOWNLOAD_PATH = "./downloads/"
+
+# Video info cache
+INFO_CACHE_SIZE = int(os.getenv("INFO_CACHE_SIZE", "512"))  # Entries kept in memory
+INFO_CACHE_TTL = int(os.getenv("INFO_CACHE_TTL", "1800"))  # Seconds
+# Per-extractor TTL overrides, e.g. "Youtube:3600 Generic:300"
+INFO_CACHE_EXTRACTOR_TTL = {
+    name: int(ttl)
+    for name, ttl in (
+        item.split(":", 1) for item in os.getenv("INFO_CACHE_EXTRACTOR_TTL", "Youtube:3600 Generic:300").split()
+    )
+}
+
+# YoutubeDL instance pool
+YDL_POOL_IDLE_PER_KEY = int(os.getenv("YDL_POOL_IDLE_PER_KEY", "4"))  # Idle instances kept per site/options
+YDL_POOL_MAX_KEYS = int(os.getenv("YDL_POOL_MAX_KEYS", "32"))  # Distinct site/options combinations kept
+
+# yt-dlp execution backend: 'thread' (default executor) or 'process' (worker processes)
+YTDL_EXECUTOR = os.getenv("YTDL_EXECUTOR", "thread")
+YTDL_PROCESS_WORKERS = int(os.getenv("YTDL_PROCESS_WORKERS", str(os.cpu_count() or 2)))
+YTDL_WORKER_MAX_TASKS = int(os.getenv("YTDL_WORKER_MAX_TASKS", "50"))  # Recycle a worker after N tasks
+
+# Playlist and batch jobs
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "2"))  # Entries processed at the same time
+MAX_BATCH_URLS = int(os.getenv("MAX_BATCH_URLS", "500"))  # Links accepted in one batch
+MAX_BATCH_FILE_SIZE = 1024 * 1024  # 1MB .txt batch files
+
+# Job scheduling
+# Jobs allowed to run at once in each pipeline stage. STAGE_LIMITS overrides
+# some of them, e.g. "download:2 upload:4"; stages left out keep the default
+DEFAULT_STAGE_LIMITS = {"extract": 8, "download": 3, "postprocess": 2, "upload": 3}
+
+
+def _parse_stage_limits(value):
+    """Stage limits from "stage:limit ..." laid over the defaults, so unset stages keep theirs"""
+    limits = dict(DEFAULT_STAGE_LIMITS)
+    for item in value.split():
+        name, _, limit = item.partition(":")
+        if name not in DEFAULT_STAGE_LIMITS:
+            raise ValueError(f"STAGE_LIMITS: unknown stage {name!r}, expected one of {', '.join(DEFAULT_STAGE_LIMITS)}")
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError(f"STAGE_LIMITS: {item!r} needs a positive limit, e.g. {name}:2")
+        limits[name] = int(limit)
+    return limits
+
+
+STAGE_LIMITS = _parse_stage_limits(os.getenv("STAGE_LIMITS", ""))
+
+# Relative share of freed slots given to each tier when jobs are waiting
+TIER_WEIGHTS = {"admin": 4, "paid": 2, "free": 1}
+# Jobs (single downloads, playlists or batches) a user can run at once, per tier
+ACTIVE_JOBS_PER_USER = {"admin": 5, "paid": 3, "free": 1}
+MAX_STAGED_PARTS = int(os.getenv("MAX_STAGED_PARTS", "2"))  # Split parts allowed on disk while uploading
+
+# Live download progress
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "2"))  # Seconds between progress edits of one job
+PROGRESS_MAX_INTERVAL = float(os.getenv("PROGRESS_MAX_INTERVAL", "15"))
+PROGRESS_EDITS_PER_SECOND = float(os.getenv("PROGRESS_EDITS_PER_SECOND", "5"))  # Progress edits shared by all jobs
+PROGRESS_MAX_SAMPLES = 500  # Throughput samples stored per job
+
+# Per-host download tuning (concurrent HLS/DASH fragments and HTTP chunk size)
+TUNING_INITIAL_FRAGMENTS = int(os.getenv("TUNING_INITIAL_FRAGMENTS", "4"))
+TUNING_MAX_FRAGMENTS = int(os.getenv("TUNING_MAX_FRAGMENTS", "16"))
+TUNING_INITIAL_CHUNK_SIZE = 10 * 1024 * 1024  # 10MB
+TUNING_MIN_CHUNK_SIZE = 1024 * 1024  # 1MB
+TUNING_MAX_CHUNK_SIZE = 64 * 1024 * 1024  # 64MB
+
+# Segmented downloader for direct file links
+DIRECT_DOWNLOAD_ENABLED = os.getenv("DIRECT_DOWNLOAD_ENABLED", "True").lower() in ("true", "1", "yes")
+DIRECT_DOWNLOAD_SEGMENTS = int(os.getenv("DIRECT_DOWNLOAD_SEGMENTS", "4"))  # Concurrent Range requests per file
+DIRECT_MIN_SEGMENT_SIZE = 8 * 1024 * 1024  # 8MB
+DIRECT_SEGMENT_RETRIES = 5
+DIRECT_TIMEOUT = 30  # Seconds without data before a connection is retried
+
+# Admission control: downloads wait while the host is short on resources
+ADMISSION_MIN_FREE_DISK = int(os.getenv("ADMISSION_MIN_FREE_DISK", str(2 * 1024 * 1024 * 1024)))  # Bytes kept free in DOWNLOAD_PATH
+ADMISSION_MAX_MEMORY_PERCENT = float(os.getenv("ADMISSION_MAX_MEMORY_PERCENT", "90"))
+ADMISSION_MAX_LOAD = float(os.getenv("ADMISSION_MAX_LOAD", "2.0"))  # 1-minute load average per CPU
+ADMISSION_DEFAULT_JOB_SIZE = 1024 * 1024 * 1024  # 1GB, assumed when the size can't be estimated
+ADMISSION_POLL_INTERVAL = 5  # Seconds between resource checks of a waiting job
+
+# Oversized videos can be fetched as time-ranged parts instead of one file
+# that is split afterwards (needs a known duration and size estimate)
+RANGED_PARTS_ENABLED = os.getenv("RANGED_PARTS_ENABLED", "False").lower() in ("true", "1", "yes")
+RANGED_PART_MARGIN = 1.15  # Bitrate headroom when sizing the time ranges
+
+# How oversized files are cut: "segment" writes all parts in one sequential
+# ffmpeg pass, "seek" runs one seek-and-copy ffmpeg per part
+SPLIT_MODE = os.getenv("SPLIT_MODE", "segment").lower()
+
+# Oversized uploads in file mode are sent as byte ranges of the original
+# (name.part01, name.part02, ...) instead of being cut with ffmpeg
+DOCUMENT_BYTE_SPLIT = os.getenv("DOCUMENT_BYTE_SPLIT", "True").lower() in ("true", "1", "yes")
+
+# Hachoir metadata parsing runs in its own small thread pool, never on the
+# event loop; slower parses fall back to the values yt-dlp reported
+METADATA_TIMEOUT = int(os.getenv("METADATA_TIMEOUT", "20"))  # Seconds
+METADATA_WORKERS = 2
@@ -1,4 +1,6 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bot.config import MONGODB_URI, DB_NAME, DEFAULT_UPLOAD_MODE, DEFAULT_SPLIT_SETTING
 from bot.config import DEFAULT_CAPTION_ENABLED, DEFAULT_THUMBNAIL_GENERATION, DEFAULT_GENERATE_SCREENSHOTS, DEFAULT_SAMPLE_VIDEO
 import datetime
@@ -13,6 +15,9 @@ class Database:
         self.users = self.db["users"]
         self.urls = self.db["urls"]
         self.daily_tasks = self.db["daily_tasks"]
+        self.video_info = self.db["video_info"]
+        self.deliveries = self.db["deliveries"]
+        self.host_tuning = self.db["host_tuning"]
         logger.info("Database connection established")
         
     async def initialize(self):
@@ -24,6 +29,10 @@ class Database:
         await self.users.create_index("user_id", unique=True)
         await self.urls.create_index("url_id", unique=True)  
         await self.daily_tasks.create_index([("user_id", 1), ("date", 1)], unique=True)
+        await self.video_info.create_index("key", unique=True)
+        await self.video_info.create_index("expires_at", expireAfterSeconds=0)
+        await self.deliveries.create_index("key", unique=True)
+        await self.host_tuning.create_index("host", unique=True)
 
     async def add_user(self, user_id, username=None):
         """Add new user to database or update existing user"""
@@ -255,6 +264,135 @@ class Database:
             logger.error(f"Error updating URL status: {e}")
             return False
 
+    async def store_batch(self, url_id, kind, entries, title=None):
+        """Attach the entry list of a playlist or batch job to a stored URL"""
+        try:
+            await self.urls.update_one(
+                {"url_id": url_id},
+                {"$set": {"kind": kind, "entries": entries, "title": title, "completed_entries": []}}
+            )
+            logger.info(f"{kind.capitalize()} {url_id} stored with {len(entries)} entries")
+            return True
+        except Exception as e:
+            logger.error(f"Error storing batch: {e}")
+            return False
+
+    async def store_throughput_samples(self, url_id, samples):
+        """Store (seconds, downloaded bytes, speed) samples of a finished download"""
+        speeds = [speed for _, _, speed in samples if speed]
+        try:
+            await self.urls.update_one(
+                {"url_id": url_id},
+                {"$set": {
+                    "throughput": {
+                        "samples": [list(sample) for sample in samples],
+                        "avg_speed": sum(speeds) / len(speeds) if speeds else 0,
+                        "peak_speed": max(speeds, default=0)
+                    }
+                }}
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error storing throughput samples: {e}")
+            return False
+
+    async def get_host_tuning(self, host):
+        """Get the learned download settings of a host"""
+        try:
+            return await self.host_tuning.find_one({"host": host})
+        except Exception as e:
+            logger.error(f"Error getting host tuning: {e}")
+            return None
+
+    async def store_host_tuning(self, host, settings):
+        """Store the learned download settings of a host"""
+        try:
+            await self.host_tuning.update_one(
+                {"host": host},
+                {"$set": {**settings, "updated_at": datetime.datetime.now()}},
+                upsert=True
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error storing host tuning: {e}")
+            return False
+
+    async def save_job(self, url_id, job):
+        """Persist the state needed to restart a job after a restart of the bot"""
+        try:
+            await self.urls.update_one(
+                {"url_id": url_id},
+                {"$set": {"job": job, "status": "queued"}}
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error saving job: {e}")
+            return False
+
+    async def update_job(self, url_id, fields):
+        """Update fields of a job's persisted state"""
+        try:
+            await self.urls.update_one(
+                {"url_id": url_id},
+                {"$set": {f"job.{name}": value for name, value in fields.items()}}
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error updating job: {e}")
+            return False
+
+    async def record_uploaded_part(self, url_id, part):
+        """Remember a part that reached the user so a resumed job skips it"""
+        try:
+            await self.urls.update_one(
+                {"url_id": url_id},
+                {"$push": {"job.uploaded_parts": part}}
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error recording uploaded part: {e}")
+            return False
+
+    async def get_unfinished_jobs(self):
+        """Get single and batch jobs that were queued or running when the bot stopped"""
+        try:
+            cursor = self.urls.find({
+                "job.kind": {"$in": ["single", "batch"]},
+                "status": {"$in": ["queued", "downloading"]}
+            })
+            return await cursor.to_list(length=None)
+        except Exception as e:
+            logger.error(f"Error getting unfinished jobs: {e}")
+            return []
+
+    async def update_batch(self, url_id, fields):
+        """Update fields of a playlist or batch job"""
+        try:
+            await self.urls.update_one({"url_id": url_id}, {"$set": fields})
+            return True
+        except Exception as e:
+            logger.error(f"Error updating batch: {e}")
+            return False
+
+    async def mark_batch_entry_done(self, url_id, index):
+        """Record a delivered entry of a playlist or batch job"""
+        try:
+            await self.urls.update_one(
+                {"url_id": url_id},
+                {"$addToSet": {"completed_entries": index}}
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error marking batch entry done: {e}")
+            return False
+
+    async def find_resumable_batch(self, user_id, url):
+        """Get the latest unfinished playlist job of a user for a URL"""
+        return await self.urls.find_one(
+            {"user_id": user_id, "url": url, "kind": "playlist", "status": {"$ne": "completed"}},
+            sort=[("timestamp", -1)]
+        )
+
     async def track_daily_task(self, user_id):
         """Track a task for daily limit purposes"""
         today = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -281,6 +419,36 @@ class Database:
             logger.error(f"Error tracking daily task: {e}")
             return -1  # Error code
     
+    async def charge_daily_tasks(self, user_id, count, limit):
+        """Atomically charge count tasks if the user stays within limit.
+
+        Returns the new daily count, or None if the whole batch doesn't fit.
+        """
+        if count > limit:
+            return None
+        
+        today = datetime.datetime.now().strftime("%Y-%m-%d")
+        for _ in range(2):
+            try:
+                # The count condition makes the check and the increment a single
+                # operation. If today's record exists without enough room the
+                # upsert collides with the unique index instead of charging.
+                task_data = await self.daily_tasks.find_one_and_update(
+                    {"user_id": user_id, "date": today, "count": {"$lte": limit - count}},
+                    {"$inc": {"count": count}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                logger.info(f"User {user_id} charged {count} tasks, {task_data['count']} used today")
+                return task_data["count"]
+            except DuplicateKeyError:
+                # Either no room left, or a concurrent first insert won the race: retry once
+                continue
+            except Exception as e:
+                logger.error(f"Error charging daily tasks: {e}")
+                return None
+        return None
+    
     async def get_daily_task_count(self, user_id):
         """Get the number of tasks used today by a user"""
         today = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -297,6 +465,65 @@ class Database:
         """Get URL data"""
         return await self.urls.find_one({"url_id": url_id})
     
+    async def get_cached_video_info(self, key):
+        """Get a cached video info document"""
+        return await self.video_info.find_one({"key": key})
+
+    async def store_cached_video_info(self, key, info, expires_at):
+        """Store a video info document until expires_at (UTC)"""
+        doc = dict(info)
+        doc["key"] = key
+        doc["expires_at"] = expires_at
+        await self.video_info.update_one(
+            {"key": key},
+            {"$set": doc},
+            upsert=True
+        )
+
+    async def get_delivery(self, key):
+        """Get Telegram file_ids of a previous delivery"""
+        return await self.deliveries.find_one({"key": key})
+
+    async def store_delivery(self, key, delivery):
+        """Store Telegram file_ids of a completed delivery"""
+        doc = dict(delivery)
+        doc["key"] = key
+        doc["timestamp"] = datetime.datetime.now()
+        try:
+            await self.deliveries.update_one(
+                {"key": key},
+                {"$set": doc, "$setOnInsert": {"hits": 0}},
+                upsert=True
+            )
+            logger.info(f"Delivery {key} cached")
+            return True
+        except Exception as e:
+            logger.error(f"Error storing delivery: {e}")
+            return False
+
+    async def record_delivery_hit(self, key):
+        """Count a delivery served from cache"""
+        await self.deliveries.update_one({"key": key}, {"$inc": {"hits": 1}})
+
+    async def delete_delivery(self, key):
+        """Invalidate a cached delivery"""
+        try:
+            await self.deliveries.delete_one({"key": key})
+            logger.info(f"Delivery {key} invalidated")
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting delivery: {e}")
+            return False
+
+    async def get_delivery_stats(self):
+        """Get number of cached deliveries and total cache hits"""
+        result = await self.deliveries.aggregate([
+            {"$group": {"_id": None, "count": {"$sum": 1}, "hits": {"$sum": "$hits"}}}
+        ]).to_list(length=1)
+        if result:
+            return {"count": result[0]["count"], "hits": result[0]["hits"]}
+        return {"count": 0, "hits": 0}
+
     async def close(self):
         """Close database connection"""
         self.client.close()
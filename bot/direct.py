@@ -0,0 +1,372 @@
+import os
+import re
+import ssl
+import json
+import time
+import asyncio
+import logging
+from urllib.parse import urlsplit, urljoin, unquote
+from bot.config import (
+    DIRECT_DOWNLOAD_SEGMENTS, DIRECT_MIN_SEGMENT_SIZE, DIRECT_SEGMENT_RETRIES, DIRECT_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+MEDIA_EXTENSIONS = ('.mp4', '.mkv', '.webm', '.mov', '.m4v', '.avi', '.flv', '.ts', '.mp3', '.m4a', '.flac', '.ogg', '.opus', '.wav')
+GENERIC_BINARY_TYPES = ('application/octet-stream', 'binary/octet-stream', 'application/force-download')
+# Manifests look like media by extension/type but need yt-dlp
+MANIFEST_TYPES = ('application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl', 'application/dash+xml')
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+READ_SIZE = 256 * 1024
+# Received data is written to the file in batches of this size, in a worker thread
+WRITE_BATCH_SIZE = 4 * 1024 * 1024
+MAX_REDIRECTS = 5
+# Segment progress is checkpointed to the sidecar file every this many bytes
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+
+_ssl_context = None
+
+
+class DirectDownloadError(Exception):
+    """A direct download failed and should fall back to yt-dlp"""
+
+
+class DirectDownloadCancelled(DirectDownloadError):
+    """A direct download was stopped by its cancel event"""
+
+
+def _get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+async def _send(method, url, headers=None):
+    """Send one HTTP/1.1 request. Returns (status, headers, reader, writer)."""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise DirectDownloadError(f"Unsupported URL: {url}")
+
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(
+            parts.hostname, port,
+            ssl=_get_ssl_context() if https else None,
+            server_hostname=parts.hostname if https else None
+        ),
+        DIRECT_TIMEOUT
+    )
+
+    path = parts.path or '/'
+    if parts.query:
+        path = f"{path}?{parts.query}"
+    host = parts.hostname if not parts.port else f"{parts.hostname}:{parts.port}"
+    lines = [
+        f"{method} {path} HTTP/1.1",
+        f"Host: {host}",
+        f"User-Agent: {USER_AGENT}",
+        "Accept: */*",
+        "Accept-Encoding: identity",
+        "Connection: close",
+    ]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+
+    try:
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        await writer.drain()
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), DIRECT_TIMEOUT)
+    except BaseException:
+        writer.close()
+        raise
+
+    status_line, *header_lines = head.decode('latin-1').split("\r\n")
+    try:
+        status = int(status_line.split(" ", 2)[1])
+    except (IndexError, ValueError):
+        writer.close()
+        raise DirectDownloadError(f"Malformed status line: {status_line!r}")
+
+    response_headers = {}
+    for line in header_lines:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            response_headers[name.strip().lower()] = value.strip()
+    return status, response_headers, reader, writer
+
+
+async def _request(method, url, headers=None):
+    """Send a request, following redirects. Returns (final url, status, headers, reader, writer)."""
+    for _ in range(MAX_REDIRECTS + 1):
+        status, response_headers, reader, writer = await _send(method, url, headers)
+        if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+            writer.close()
+            url = urljoin(url, response_headers['location'])
+            continue
+        return url, status, response_headers, reader, writer
+    raise DirectDownloadError("Too many redirects")
+
+
+def _filename_from(url, headers):
+    disposition = headers.get('content-disposition', '')
+    match = re.search(r"filename\*=(?:UTF-8'')?([^;]+)|filename=\"?([^\";]+)\"?", disposition, re.IGNORECASE)
+    if match:
+        return unquote((match.group(1) or match.group(2)).strip())
+    return unquote(os.path.basename(urlsplit(url).path)) or 'file'
+
+
+def _is_media(content_type, filename):
+    if content_type in MANIFEST_TYPES:
+        return False
+    if content_type.startswith(('video/', 'audio/')):
+        return True
+    return content_type in GENERIC_BINARY_TYPES and filename.lower().endswith(MEDIA_EXTENSIONS)
+
+
+async def probe_direct(url):
+    """Check whether a URL serves a media file directly.
+
+    Returns a dict with the final url, size, filename, content type and
+    whether byte ranges are supported, or None for anything else (web pages,
+    manifests, unknown sizes).
+    """
+    try:
+        final_url, status, headers, _, writer = await _request('HEAD', url)
+        writer.close()
+        ranges = headers.get('accept-ranges', '').lower() == 'bytes'
+        size = int(headers.get('content-length') or 0)
+
+        if status in (403, 405, 501) or (status == 200 and not size):
+            # HEAD not allowed (or not informative): ask for the first byte instead
+            final_url, status, headers, _, writer = await _request('GET', url, {'Range': 'bytes=0-0'})
+            writer.close()
+            match = re.match(r'bytes 0-0/(\d+)', headers.get('content-range', ''))
+            ranges = status == 206 and bool(match)
+            size = int(match.group(1)) if match else 0
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, DirectDownloadError) as e:
+        logger.debug(f"Direct probe of {url} failed: {e}")
+        return None
+
+    if status not in (200, 206) or not size:
+        return None
+
+    content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+    filename = _filename_from(final_url, headers)
+    if not _is_media(content_type, filename):
+        return None
+
+    return {
+        'url': final_url,
+        'size': size,
+        'filename': filename,
+        'content_type': content_type,
+        'ranges': ranges
+    }
+
+
+def plan_segments(size, ranges, segments=DIRECT_DOWNLOAD_SEGMENTS, min_segment_size=DIRECT_MIN_SEGMENT_SIZE):
+    """Split [0, size) into contiguous byte ranges"""
+    count = 1 if not ranges else max(1, min(segments, size // min_segment_size))
+    step = -(-size // count)
+    return [
+        {'start': start, 'end': min(start + step, size) - 1, 'done': 0}
+        for start in range(0, size, step)
+    ]
+
+
+def _load_checkpoint(output_path, size):
+    """Segment progress of an earlier attempt at the same file, if it is still valid"""
+    try:
+        with open(f"{output_path}.segments") as f:
+            state = json.load(f)
+        if state['size'] == size and os.path.getsize(output_path) == size:
+            return state['segments']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def _save_checkpoint(output_path, size, segments):
+    try:
+        with open(f"{output_path}.segments", "w") as f:
+            json.dump({'size': size, 'segments': segments}, f)
+    except OSError as e:
+        logger.error(f"Error saving download checkpoint: {e}")
+
+
+async def _run_file_io(func, *args):
+    """Run blocking file I/O in the default executor.
+
+    A cancelled caller still waits for the call to finish, so the file
+    descriptor is never closed (and reused) under a running write.
+    """
+    future = asyncio.get_running_loop().run_in_executor(None, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+def _check_body(status, headers, start, end, size):
+    """Make sure a response body is exactly bytes start..end of the file, sent as is"""
+    encoding = headers.get('transfer-encoding', 'identity').lower()
+    if encoding != 'identity':
+        raise DirectDownloadError(f"Unsupported transfer encoding {encoding!r}")
+    if status == 206:
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', headers.get('content-range', ''))
+        if not match or int(match.group(1)) != start or int(match.group(2)) != end:
+            raise DirectDownloadError(
+                f"Server sent range {headers.get('content-range')!r} for requested bytes {start}-{end}"
+            )
+        if match.group(3) != '*' and int(match.group(3)) != size:
+            raise DirectDownloadError(f"File size changed from {size} to {match.group(3)} bytes")
+    length = headers.get('content-length')
+    if length is not None and (not length.isdigit() or int(length) != end - start + 1):
+        raise DirectDownloadError(f"Content-Length {length} does not match requested bytes {start}-{end}")
+
+
+async def _download_segment(url, fd, segment, size, on_progress, checkpoint):
+    """Fetch one byte range into the file, resuming from where it stopped after errors"""
+    length = segment['end'] - segment['start'] + 1
+    failures = 0
+    since_checkpoint = 0
+    # Received bytes not yet written, flushed in batches off the event loop
+    pending = bytearray()
+
+    async def flush():
+        nonlocal since_checkpoint
+        if not pending:
+            return
+        data = bytes(pending)
+        pending.clear()
+        await _run_file_io(os.pwrite, fd, data, segment['start'] + segment['done'])
+        segment['done'] += len(data)
+        on_progress(len(data))
+
+        since_checkpoint += len(data)
+        if since_checkpoint >= CHECKPOINT_BYTES:
+            since_checkpoint = 0
+            checkpoint()
+
+    while segment['done'] < length:
+        attempt_start = segment['done']
+        offset = segment['start'] + segment['done']
+        headers = {'Range': f"bytes={offset}-{segment['end']}"} if size > length or offset else {}
+        try:
+            _, status, response_headers, reader, writer = await _request('GET', url, headers)
+            try:
+                if status != 206 and not (status == 200 and not headers):
+                    raise DirectDownloadError(f"Unexpected HTTP status {status} for bytes {offset}-{segment['end']}")
+                # A chunked or misplaced body would be written verbatim and still add up to the right size
+                _check_body(status, response_headers, offset, segment['end'], size)
+
+                while segment['done'] + len(pending) < length:
+                    remaining = length - segment['done'] - len(pending)
+                    chunk = await asyncio.wait_for(reader.read(min(READ_SIZE, remaining)), DIRECT_TIMEOUT)
+                    if not chunk:
+                        raise ConnectionError("Connection closed before the segment was complete")
+                    pending += chunk
+                    if len(pending) >= WRITE_BATCH_SIZE:
+                        await flush()
+            finally:
+                writer.close()
+                # Keep what arrived before an interruption, the retry resumes after it
+                await flush()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            # Only attempts that made no progress count towards the retry limit
+            failures = failures + 1 if segment['done'] == attempt_start else 1
+            if failures > DIRECT_SEGMENT_RETRIES:
+                raise DirectDownloadError(f"Segment at {segment['start']} failed {failures} times: {e}")
+            logger.warning(f"Segment at {segment['start']} interrupted at {segment['done']}/{length} bytes, resuming: {e}")
+            checkpoint()
+            await asyncio.sleep(min(0.5 * 2 ** (failures - 1), 10))
+
+
+async def download_direct(media, output_path, on_progress=None, cancel_event=None):
+    """Download a probed direct media file with concurrent Range requests.
+
+    The file is preallocated and every segment writes at its own offset, so
+    segments finish in any order and resume independently. Progress is
+    checkpointed next to the file so a later attempt at the same output path
+    continues where this one stopped. Returns the output path.
+    """
+    size = media['size']
+    segments = _load_checkpoint(output_path, size) or plan_segments(size, media['ranges'])
+    resumed = sum(segment['done'] for segment in segments)
+    if resumed and on_progress:
+        on_progress(resumed)
+
+    fd = os.open(output_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != size:
+            # Without native preallocation glibc writes zeros, keep that off the event loop
+            if hasattr(os, 'posix_fallocate'):
+                await _run_file_io(os.posix_fallocate, fd, 0, size)
+            else:
+                await _run_file_io(os.ftruncate, fd, size)
+
+        checkpoint = lambda: _save_checkpoint(output_path, size, segments)  # noqa: E731
+        tasks = [
+            asyncio.ensure_future(_download_segment(media['url'], fd, segment, size, on_progress or (lambda n: None), checkpoint))
+            for segment in segments if segment['done'] < segment['end'] - segment['start'] + 1
+        ]
+        waiters = list(tasks)
+        cancel_waiter = None
+        if cancel_event is not None:
+            cancel_waiter = asyncio.ensure_future(cancel_event.wait())
+            waiters.append(cancel_waiter)
+
+        try:
+            pending = set(tasks)
+            while pending:
+                done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                if cancel_waiter is not None and cancel_waiter in done:
+                    raise DirectDownloadCancelled("Download cancelled by user")
+                for task in done:
+                    task.result()
+                pending -= done
+                waiters = [w for w in waiters if not w.done()]
+        finally:
+            for task in tasks:
+                task.cancel()
+            if cancel_waiter is not None:
+                cancel_waiter.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    except BaseException:
+        os.close(fd)
+        _save_checkpoint(output_path, size, segments)
+        raise
+
+    try:
+        written = sum(segment['done'] for segment in segments)
+        actual = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+    if written != size or actual != size:
+        raise DirectDownloadError(f"Size mismatch: expected {size} bytes, wrote {written}, file has {actual}")
+
+    try:
+        os.remove(f"{output_path}.segments")
+    except OSError:
+        pass
+    return output_path
+
+
+def progress_snapshot(downloaded, size, started, status='downloading'):
+    """Progress snapshot in the same shape as progress.snapshot_from_hook"""
+    elapsed = time.time() - started
+    speed = downloaded / elapsed if elapsed > 0 else 0
+    return {
+        'status': status,
+        'downloaded_bytes': downloaded,
+        'total_bytes': size,
+        'speed': speed,
+        'eta': (size - downloaded) / speed if speed else None,
+        'fragment_index': None,
+        'fragment_count': None,
+        'time': time.time()
+    }
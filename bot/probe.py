@@ -0,0 +1,247 @@
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hachoir.parser import createParser
+from hachoir.metadata import extractMetadata
+from bot.config import METADATA_TIMEOUT, METADATA_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# Probe results kept in memory, one per file version
+PROBE_CACHE_SIZE = 256
+
+
+async def run_process(cmd):
+    """Run a command in a subprocess, killing it if the awaiting task is cancelled"""
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+            logger.info(f"Killed {cmd[0]} (pid {process.pid}) of a cancelled job")
+        raise
+
+    return process.returncode, stdout, stderr
+
+
+def _number(value, cast=float):
+    try:
+        return cast(value) if value not in (None, '', 'N/A') else None
+    except (TypeError, ValueError):
+        return None
+
+
+class MediaInfo:
+    """Compact probe result of one media file"""
+
+    __slots__ = ('duration', 'width', 'height', 'vcodec', 'acodec', 'bit_rate', 'frame_rate', 'size')
+
+    def __init__(self, duration=0.0, width=None, height=None, vcodec=None, acodec=None,
+                 bit_rate=None, frame_rate=None, size=None):
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.vcodec = vcodec
+        self.acodec = acodec
+        self.bit_rate = bit_rate
+        self.frame_rate = frame_rate
+        self.size = size
+
+    @classmethod
+    def from_ffprobe(cls, data, size=None):
+        """Build from ffprobe -show_format -show_streams JSON"""
+        streams = data.get('streams', [])
+        fmt = data.get('format', {})
+        video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+        audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+
+        info = cls(size=size or _number(fmt.get('size'), int))
+        info.duration = _number(fmt.get('duration')) or _number((video or {}).get('duration')) or 0.0
+        info.bit_rate = _number(fmt.get('bit_rate'), int)
+        info.acodec = audio.get('codec_name') if audio else None
+        if video:
+            info.vcodec = video.get('codec_name')
+            info.width = _number(video.get('width'), int)
+            info.height = _number(video.get('height'), int)
+            try:
+                num, den = video.get('avg_frame_rate', '0/0').split('/')
+                info.frame_rate = float(num) / float(den) if float(den) > 0 else None
+            except ValueError:
+                info.frame_rate = None
+        return info
+
+    @property
+    def has_video(self):
+        return self.vcodec is not None
+
+    def derive(self, **changes):
+        """Copy with some fields replaced, e.g. for a part cut from this file"""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return MediaInfo(**fields)
+
+    def upload_metadata(self):
+        """width/height/duration as passed to a video upload"""
+        return {"width": self.width, "height": self.height, "duration": int(self.duration or 0)}
+
+
+class MediaProbe:
+    """One ffprobe per file version, shared by every stage of a job.
+
+    Results are memoized by (path, size, mtime), so a file rewritten in place
+    is probed again. Concurrent requests for the same file share one ffprobe
+    run, and stages that already know a file's metadata (a split part from
+    its plan, a download yt-dlp described) remember it instead of probing.
+    """
+
+    def __init__(self, max_entries=PROBE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._pending = {}
+        self.probes = 0
+        self.hits = 0
+
+    @staticmethod
+    def _key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    def _store(self, key, info):
+        self._entries[key] = info
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def remember(self, path, info):
+        """Record known metadata of a file as if it had been probed"""
+        try:
+            key = self._key(path)
+        except OSError:
+            return
+        if info.size is None:
+            info.size = key[1]
+        self._store(key, info)
+
+    def peek(self, path):
+        """Memoized metadata of a file, without probing it"""
+        try:
+            return self._entries.get(self._key(path))
+        except OSError:
+            return None
+
+    async def probe(self, path):
+        """MediaInfo of a file, or None if it can't be probed"""
+        try:
+            key = self._key(path)
+        except OSError:
+            return None
+
+        info = self._entries.get(key)
+        if info is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return info
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            info = await self._run(path, key[1])
+        except BaseException:
+            future.set_result(None)
+            raise
+        finally:
+            self._pending.pop(key, None)
+        future.set_result(info)
+        if info is not None:
+            self._store(key, info)
+        return info
+
+    async def _run(self, path, size):
+        self.probes += 1
+        cmd = ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json', path]
+        returncode, stdout, stderr = await run_process(cmd)
+        if returncode != 0:
+            logger.error(f"ffprobe failed for {path}: {stderr.decode(errors='replace')}")
+            return None
+        try:
+            return MediaInfo.from_ffprobe(json.loads(stdout.decode('utf-8')), size)
+        except ValueError as e:
+            logger.error(f"Unreadable ffprobe output for {path}: {e}")
+            return None
+
+    def stats(self):
+        return {'entries': len(self._entries), 'probes': self.probes, 'hits': self.hits}
+
+
+media_probe = MediaProbe()
+
+_metadata_executor = None
+
+
+def _get_metadata_executor():
+    global _metadata_executor
+    if _metadata_executor is None:
+        # Bounded, so parsers stuck on huge files can't pile up threads
+        _metadata_executor = ThreadPoolExecutor(max_workers=METADATA_WORKERS, thread_name_prefix="metadata")
+    return _metadata_executor
+
+
+def _hachoir_metadata(file_path):
+    """Blocking Hachoir parse of width/height/duration, run in the metadata executor"""
+    width = height = None
+    duration = 0
+    parser = createParser(file_path)
+    if parser:
+        with parser:
+            metadata = extractMetadata(parser)
+            if metadata:
+                if metadata.has("width"):
+                    width = metadata.get("width")
+                if metadata.has("height"):
+                    height = metadata.get("height")
+                if metadata.has("duration"):
+                    duration = metadata.get("duration").seconds
+    return {"width": width, "height": height, "duration": duration}
+
+
+async def video_metadata(file_path, fallback=None, timeout=METADATA_TIMEOUT):
+    """width/height/duration of a video without blocking the event loop.
+
+    The shared ffprobe result is used when there is one. Otherwise Hachoir
+    parses the file in a bounded thread pool for at most timeout seconds,
+    and anything still missing is taken from fallback (e.g. what yt-dlp
+    reported for the download).
+    """
+    result = {"width": None, "height": None, "duration": 0}
+    info = await media_probe.probe(file_path)
+    if info is not None and info.duration:
+        result = info.upload_metadata()
+    else:
+        future = asyncio.get_running_loop().run_in_executor(_get_metadata_executor(), _hachoir_metadata, file_path)
+        try:
+            result = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # The parse keeps its worker until it finishes, the job moves on
+            logger.warning(f"Metadata of {file_path} took over {timeout}s, using fallback values")
+        except Exception as e:
+            logger.error(f"Error extracting video metadata: {e}")
+
+    for name in ("width", "height", "duration"):
+        if not result.get(name) and fallback and fallback.get(name):
+            result[name] = int(fallback[name]) if name == "duration" else fallback[name]
+    return result
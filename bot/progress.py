@@ -0,0 +1,120 @@
+import time
+import asyncio
+import logging
+from bot.config import (
+    PROGRESS_MIN_INTERVAL, PROGRESS_MAX_INTERVAL, PROGRESS_EDITS_PER_SECOND, PROGRESS_MAX_SAMPLES
+)
+
+logger = logging.getLogger(__name__)
+
+# Download progress watchers currently rendering, they share the edit budget
+_active_watchers = 0
+
+
+class ProgressSlot:
+    """Latest-value-wins mailbox between a yt-dlp worker and the event loop.
+
+    The worker thread replaces the snapshot with a single reference
+    assignment and the loop reads whatever is newest, so there is no lock and
+    no queue to back up when the loop is busy. In process mode the snapshot
+    lives in a manager dict so the worker process can publish it.
+    """
+
+    __slots__ = ('snapshot', 'shared')
+
+    def __init__(self, shared=None):
+        self.snapshot = None
+        self.shared = shared
+
+    def publish(self, snapshot):
+        if self.shared is not None:
+            self.shared['snapshot'] = snapshot
+        else:
+            self.snapshot = snapshot
+
+    def latest(self):
+        if self.shared is not None:
+            return self.shared.get('snapshot')
+        return self.snapshot
+
+
+def snapshot_from_hook(d):
+    """Compact a yt-dlp progress hook dict"""
+    return {
+        'status': d.get('status'),
+        'downloaded_bytes': d.get('downloaded_bytes') or 0,
+        'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate') or 0,
+        'speed': d.get('speed') or 0,
+        'eta': d.get('eta'),
+        'fragment_index': d.get('fragment_index'),
+        'fragment_count': d.get('fragment_count'),
+        'time': time.time()
+    }
+
+
+def make_progress_hook(slot, min_interval=0.25):
+    """yt-dlp progress hook publishing into a ProgressSlot at most every min_interval seconds"""
+    last_publish = 0
+
+    def hook(d):
+        nonlocal last_publish
+        now = time.monotonic()
+        if d.get('status') == 'downloading' and now - last_publish < min_interval:
+            return
+        last_publish = now
+        slot.publish(snapshot_from_hook(d))
+
+    return hook
+
+
+async def watch_progress(slot, render, stop_event):
+    """Render the newest snapshot of a slot until stop_event is set.
+
+    The interval between edits grows with the number of jobs being watched,
+    so the whole bot stays within PROGRESS_EDITS_PER_SECOND, and backs off
+    further while the download is not moving. render may return a number of
+    seconds to wait before the next edit (e.g. after a FloodWait).
+
+    Returns the throughput samples (seconds since start, bytes, speed) taken
+    at every tick.
+    """
+    global _active_watchers
+    _active_watchers += 1
+    start = time.time()
+    samples = []
+    last_rendered = None
+    idle_ticks = 0
+
+    try:
+        while not stop_event.is_set():
+            interval = max(PROGRESS_MIN_INTERVAL, _active_watchers / PROGRESS_EDITS_PER_SECOND)
+            interval = min(PROGRESS_MAX_INTERVAL, interval * (2 ** min(idle_ticks, 3)))
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+
+            snapshot = slot.latest()
+            if snapshot is None or snapshot is last_rendered or snapshot == last_rendered:
+                idle_ticks += 1
+                continue
+
+            if len(samples) < PROGRESS_MAX_SAMPLES:
+                samples.append((round(snapshot['time'] - start, 2), snapshot['downloaded_bytes'], snapshot['speed']))
+
+            moved = last_rendered is None or snapshot['downloaded_bytes'] != last_rendered['downloaded_bytes']
+            idle_ticks = 0 if moved else idle_ticks + 1
+            last_rendered = snapshot
+
+            try:
+                delay = await render(snapshot)
+            except Exception as e:
+                logger.error(f"Error rendering download progress: {e}")
+                delay = None
+            if delay:
+                await asyncio.sleep(delay)
+    finally:
+        _active_watchers -= 1
+
+    return samples
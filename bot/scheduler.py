@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from bot.config import STAGE_LIMITS, TIER_WEIGHTS
+
+logger = logging.getLogger(__name__)
+
+
+class _Stage:
+    """Concurrency budget and wait queues of one pipeline stage"""
+
+    def __init__(self, name, limit, tier_weights):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.tier_weights = tier_weights
+        # tier -> OrderedDict(user_id -> deque of waiting futures)
+        self.waiting = {tier: OrderedDict() for tier in tier_weights}
+        # Smooth weighted round-robin state per tier
+        self.credits = {tier: 0 for tier in tier_weights}
+
+    def waiting_count(self, tier=None):
+        tiers = [tier] if tier else self.waiting
+        return sum(len(queue) for t in tiers for queue in self.waiting[t].values())
+
+    def enqueue(self, user_id, tier, future):
+        self.waiting[tier].setdefault(user_id, deque()).append(future)
+
+    def remove(self, user_id, tier, future):
+        users = self.waiting[tier]
+        queue = users.get(user_id)
+        if queue and future in queue:
+            queue.remove(future)
+            if not queue:
+                del users[user_id]
+
+    def _pick_tier(self):
+        ready = [tier for tier, users in self.waiting.items() if users]
+        if not ready:
+            return None
+
+        total = sum(self.tier_weights[tier] for tier in ready)
+        for tier in ready:
+            self.credits[tier] += self.tier_weights[tier]
+        chosen = max(ready, key=lambda tier: self.credits[tier])
+        self.credits[chosen] -= total
+        return chosen
+
+    def _pop_next(self):
+        """Next waiter: weighted across tiers, round-robin across users in a tier"""
+        while True:
+            tier = self._pick_tier()
+            if tier is None:
+                return None
+
+            users = self.waiting[tier]
+            user_id, queue = next(iter(users.items()))
+            future = queue.popleft()
+            if queue:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+
+            if not future.done():
+                return future
+
+    def dispatch(self):
+        while self.active < self.limit:
+            future = self._pop_next()
+            if future is None:
+                return
+            self.active += 1
+            future.set_result(None)
+
+
+class StageScheduler:
+    """Admits jobs into the extract, download, post-process and upload stages.
+
+    Every stage has its own concurrency budget. When a stage is full, waiters
+    are served by weighted priority between tiers (admin, paid, free) and
+    round-robin between users of the same tier, so one user with many jobs
+    can't starve everyone else.
+    """
+
+    def __init__(self, limits=STAGE_LIMITS, tier_weights=TIER_WEIGHTS):
+        self.tier_weights = dict(tier_weights)
+        self.stages = {name: _Stage(name, limit, self.tier_weights) for name, limit in limits.items()}
+
+    def is_full(self, stage):
+        """Check whether a job entering the stage now would have to wait"""
+        state = self.stages[stage]
+        return state.active >= state.limit or state.waiting_count() > 0
+
+    async def acquire(self, stage, user_id, tier):
+        state = self.stages[stage]
+        if tier not in self.tier_weights:
+            tier = min(self.tier_weights, key=self.tier_weights.get)
+
+        if state.active < state.limit and state.waiting_count() == 0:
+            state.active += 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        state.enqueue(user_id, tier, future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just as we got cancelled: hand it on
+                self.release(stage)
+            else:
+                state.remove(user_id, tier, future)
+            raise
+
+    def release(self, stage):
+        state = self.stages[stage]
+        state.active -= 1
+        state.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, stage, user_id, tier):
+        """Hold one slot of a stage for the duration of the block"""
+        await self.acquire(stage, user_id, tier)
+        try:
+            yield
+        finally:
+            self.release(stage)
+
+    def queue_depth(self):
+        """Active and waiting jobs per stage"""
+        return {
+            name: {
+                'active': state.active,
+                'limit': state.limit,
+                'waiting': {tier: state.waiting_count(tier) for tier in self.tier_weights}
+            }
+            for name, state in self.stages.items()
+        }
+
+
+scheduler = StageScheduler()
@@ -0,0 +1,204 @@
+import re
+import time
+import logging
+from urllib.parse import urlsplit
+from bot.config import (
+    TUNING_INITIAL_FRAGMENTS, TUNING_MAX_FRAGMENTS, TUNING_INITIAL_CHUNK_SIZE,
+    TUNING_MIN_CHUNK_SIZE, TUNING_MAX_CHUNK_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+HTTP_ERROR_PATTERN = re.compile(r'HTTP Error (429|5\d\d)')
+
+# Weight of the newest throughput measurement in a host's moving average
+THROUGHPUT_EWMA_WEIGHT = 0.3
+
+
+class TransferMonitor:
+    """yt-dlp logger and progress hook measuring one download.
+
+    It counts 429 and 5xx responses reported by yt-dlp (retries are logged as
+    warnings) and the bytes and time spent transferring. It is created inside
+    the worker, and summary() is sent back with the download result.
+    """
+
+    def __init__(self):
+        self.throttled = 0
+        self.server_errors = 0
+        self.fragmented = False
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+        self._current = 0
+
+    def _scan(self, msg):
+        match = HTTP_ERROR_PATTERN.search(msg)
+        if match:
+            if match.group(1) == '429':
+                self.throttled += 1
+            else:
+                self.server_errors += 1
+
+    def debug(self, msg):
+        self._scan(msg)
+        logger.debug(msg)
+
+    def info(self, msg):
+        self._scan(msg)
+        logger.debug(msg)
+
+    def warning(self, msg):
+        self._scan(msg)
+        logger.warning(msg)
+
+    def error(self, msg):
+        self._scan(msg)
+        logger.error(msg)
+
+    def hook(self, d):
+        now = time.monotonic()
+        if d.get('status') == 'downloading':
+            if self.started is None:
+                self.started = now
+            if d.get('fragment_count'):
+                self.fragmented = True
+            self._current = d.get('downloaded_bytes') or 0
+        elif d.get('status') == 'finished':
+            # Video and audio are downloaded one after the other
+            self.bytes += d.get('downloaded_bytes') or d.get('total_bytes') or self._current
+            self._current = 0
+            self.finished = now
+
+    def summary(self):
+        elapsed = (self.finished - self.started) if self.started and self.finished else 0
+        return {
+            'bytes': self.bytes,
+            'elapsed': elapsed,
+            'throughput': self.bytes / elapsed if elapsed > 0 else 0,
+            'throttled': self.throttled,
+            'server_errors': self.server_errors,
+            'fragmented': self.fragmented
+        }
+
+
+class HostTuner:
+    """Learns concurrent_fragment_downloads and http_chunk_size per host.
+
+    Settings follow additive-increase/multiplicative-decrease: a clean
+    download that was at least as fast as the host's average earns one more
+    concurrent fragment (or a doubled chunk size for unfragmented downloads),
+    any 429 or repeated 5xx halves them, and a clear slowdown after an
+    increase steps back. Learned settings are persisted per host.
+    """
+
+    def __init__(self, initial_fragments=TUNING_INITIAL_FRAGMENTS, max_fragments=TUNING_MAX_FRAGMENTS,
+                 initial_chunk_size=TUNING_INITIAL_CHUNK_SIZE, min_chunk_size=TUNING_MIN_CHUNK_SIZE,
+                 max_chunk_size=TUNING_MAX_CHUNK_SIZE):
+        self.initial_fragments = initial_fragments
+        self.max_fragments = max_fragments
+        self.initial_chunk_size = initial_chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.store = None
+        self._hosts = {}
+
+    def attach(self, store):
+        """Persist learned settings through a Database instance"""
+        self.store = store
+
+    @staticmethod
+    def host_of(url):
+        host = (urlsplit(url).hostname or '').lower()
+        return host[4:] if host.startswith('www.') else host
+
+    def _default_state(self, host):
+        return {
+            'host': host,
+            'fragments': self.initial_fragments,
+            'chunk_size': self.initial_chunk_size,
+            'throughput': 0,
+            'downloads': 0,
+            'errors': 0,
+            'increased': False
+        }
+
+    async def _state(self, host):
+        state = self._hosts.get(host)
+        if state is not None:
+            return state
+
+        state = self._default_state(host)
+        if self.store is not None:
+            doc = await self.store.get_host_tuning(host)
+            if doc:
+                state.update({k: v for k, v in doc.items() if k in state})
+        self._hosts[host] = state
+        return state
+
+    async def settings_for(self, url):
+        """yt-dlp options to use for the next download from the URL's host"""
+        state = await self._state(self.host_of(url))
+        return {
+            'concurrent_fragment_downloads': state['fragments'],
+            'http_chunk_size': state['chunk_size']
+        }
+
+    async def record(self, url, transfer):
+        """Adapt a host's settings to the outcome of a download (a TransferMonitor summary)"""
+        host = self.host_of(url)
+        state = await self._state(host)
+        throughput = transfer['throughput']
+        state['downloads'] += 1
+
+        if transfer['throttled'] or transfer['server_errors'] >= 3:
+            # Multiplicative decrease
+            state['errors'] += 1
+            if transfer['fragmented']:
+                state['fragments'] = max(1, state['fragments'] // 2)
+            else:
+                state['chunk_size'] = max(self.min_chunk_size, state['chunk_size'] // 2)
+            state['increased'] = False
+        elif throughput > 0:
+            average = state['throughput']
+            if average and state['increased'] and throughput < average * 0.8:
+                # The last increase made things worse: step back
+                if transfer['fragmented']:
+                    state['fragments'] = max(1, state['fragments'] - 1)
+                else:
+                    state['chunk_size'] = max(self.min_chunk_size, state['chunk_size'] // 2)
+                state['increased'] = False
+            elif not average or throughput >= average * 0.95:
+                # Additive increase
+                if transfer['fragmented']:
+                    state['fragments'] = min(self.max_fragments, state['fragments'] + 1)
+                else:
+                    state['chunk_size'] = min(self.max_chunk_size, state['chunk_size'] * 2)
+                state['increased'] = True
+            else:
+                state['increased'] = False
+
+            state['throughput'] = (
+                throughput if not average
+                else average * (1 - THROUGHPUT_EWMA_WEIGHT) + throughput * THROUGHPUT_EWMA_WEIGHT
+            )
+        else:
+            return
+
+        logger.info(
+            f"Tuning for {host}: {state['fragments']} fragments, chunk {state['chunk_size']} "
+            f"after {throughput / 1024 / 1024:.2f} MB/s, {transfer['throttled']} throttled, "
+            f"{transfer['server_errors']} server errors"
+        )
+        if self.store is not None:
+            await self.store.store_host_tuning(host, state)
+
+    def stats(self):
+        """Learned settings of the hosts seen by this process"""
+        return {
+            host: {'fragments': state['fragments'], 'chunk_size': state['chunk_size'], 'throughput': state['throughput']}
+            for host, state in self._hosts.items()
+        }
+
+
+host_tuner = HostTuner()
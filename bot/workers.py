@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from bot.config import YTDL_EXECUTOR, YTDL_PROCESS_WORKERS, YTDL_WORKER_MAX_TASKS
+from bot.progress import ProgressSlot
+
+logger = logging.getLogger(__name__)
+
+_process_pool = None
+_manager = None
+
+
+def uses_process_pool():
+    """Check whether yt-dlp work runs in worker processes"""
+    return YTDL_EXECUTOR == "process"
+
+
+def get_executor():
+    """Get the executor for yt-dlp work (None means the loop's default thread pool)"""
+    global _process_pool
+    if not uses_process_pool():
+        return None
+
+    if _process_pool is None:
+        # spawn keeps workers free of the event loop, Mongo and Pyrogram
+        # threads of the parent, and is required for max_tasks_per_child
+        _process_pool = ProcessPoolExecutor(
+            max_workers=YTDL_PROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=YTDL_WORKER_MAX_TASKS
+        )
+        logger.info(
+            f"Started yt-dlp process pool with {YTDL_PROCESS_WORKERS} workers "
+            f"(recycled after {YTDL_WORKER_MAX_TASKS} tasks)"
+        )
+    return _process_pool
+
+
+def make_cancel_flag():
+    """Event a running yt-dlp call can poll to stop early.
+
+    Worker processes can't see asyncio or threading events of the parent, so
+    in process mode the flag is an Event proxy served by a manager process.
+    """
+    if not uses_process_pool():
+        return threading.Event()
+    return _get_manager().Event()
+
+
+def make_progress_slot():
+    """ProgressSlot a running yt-dlp call can publish progress into"""
+    if not uses_process_pool():
+        return ProgressSlot()
+    return ProgressSlot(_get_manager().dict())
+
+
+def _get_manager():
+    global _manager
+    if _manager is None:
+        _manager = multiprocessing.get_context("spawn").Manager()
+    return _manager
+
+
+async def run_ytdl(func, *args):
+    """Run a blocking yt-dlp function in the configured executor.
+
+    In process mode func and its arguments must be picklable and the result
+    should be a compacted dict rather than a full info dict.
+    """
+    global _process_pool
+    try:
+        return await asyncio.get_event_loop().run_in_executor(get_executor(), partial(func, *args))
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM killed), start a fresh pool next time
+        logger.error("yt-dlp process pool is broken, recreating it")
+        _process_pool = None
+        raise
+
+
+def shutdown():
+    """Stop the worker processes"""
+    global _process_pool, _manager
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    if _manager is not None:
+        _manager.shutdown()
+        _manager = None
@@ -0,0 +1,120 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from yt_dlp import YoutubeDL
+from bot.config import YDL_POOL_IDLE_PER_KEY, YDL_POOL_MAX_KEYS
+
+logger = logging.getLogger(__name__)
+
+# Options that change on every call and are applied on checkout instead of
+# being part of the pool key
+PER_CALL_OPTIONS = ('outtmpl', 'progress_hooks')
+
+_MISSING = object()
+
+
+class YDLPool:
+    """Pool of long-lived YoutubeDL instances keyed by site and options.
+
+    A YoutubeDL instance is not thread-safe, so each one is lent to a single
+    executor thread at a time. Reusing instances keeps initialized extractors,
+    the HTTP handlers (and their keep-alive connections) and the cookie jar.
+    """
+
+    def __init__(self, idle_per_key=YDL_POOL_IDLE_PER_KEY, max_keys=YDL_POOL_MAX_KEYS):
+        self.idle_per_key = idle_per_key
+        self.max_keys = max_keys
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    @staticmethod
+    def make_key(site, ydl_opts):
+        opts = {k: v for k, v in ydl_opts.items() if k not in PER_CALL_OPTIONS}
+        return site, json.dumps(opts, sort_keys=True, default=repr)
+
+    def _take(self, key):
+        with self._lock:
+            instances = self._idle.get(key)
+            if instances:
+                self._idle.move_to_end(key)
+                self.reused += 1
+                return instances.pop()
+        return None
+
+    def _give_back(self, key, ydl):
+        evicted = []
+        with self._lock:
+            instances = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+            if len(instances) < self.idle_per_key:
+                instances.append(ydl)
+            else:
+                evicted.append(ydl)
+
+            while len(self._idle) > self.max_keys:
+                _, old = self._idle.popitem(last=False)
+                evicted.extend(old)
+
+        for old_ydl in evicted:
+            _close(old_ydl)
+
+    @contextmanager
+    def borrow(self, ydl_opts, site=None, outtmpl=None, progress_hooks=None, overrides=None):
+        """Lend a YoutubeDL instance configured with ydl_opts.
+
+        overrides are params that only apply to this checkout, such as tuned
+        download settings or a per-call logger.
+        """
+        key = self.make_key(site, ydl_opts)
+        ydl = self._take(key)
+        if ydl is None:
+            base_opts = {k: v for k, v in ydl_opts.items() if k not in PER_CALL_OPTIONS}
+            ydl = YoutubeDL(base_opts)
+            self.created += 1
+
+        default_outtmpl = ydl.params['outtmpl'].get('default')
+        if outtmpl is not None:
+            ydl.params['outtmpl']['default'] = outtmpl
+        for hook in progress_hooks or []:
+            ydl.add_progress_hook(hook)
+        saved_params = {name: ydl.params.get(name, _MISSING) for name in overrides or {}}
+        ydl.params.update(overrides or {})
+
+        try:
+            yield ydl
+        finally:
+            ydl._progress_hooks = []
+            ydl.params['outtmpl']['default'] = default_outtmpl
+            for name, value in saved_params.items():
+                if value is _MISSING:
+                    ydl.params.pop(name, None)
+                else:
+                    ydl.params[name] = value
+            self._give_back(key, ydl)
+
+    def close(self):
+        """Close every idle instance"""
+        with self._lock:
+            instances = [ydl for group in self._idle.values() for ydl in group]
+            self._idle.clear()
+        for ydl in instances:
+            _close(ydl)
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(group) for group in self._idle.values())
+        return {'created': self.created, 'reused': self.reused, 'idle': idle, 'keys': len(self._idle)}
+
+
+def _close(ydl):
+    try:
+        ydl.close()
+    except Exception as e:
+        logger.debug(f"Error closing YoutubeDL instance: {e}")
+
+
+ydl_pool = YDLPool()
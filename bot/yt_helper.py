@@ -1,15 +1,30 @@
+import io
 import os
 import re
+import math
 import uuid
-import json
 import time
+import bisect
+import signal
+import struct
 import asyncio
 import logging
+from array import array
 from datetime import datetime
-from yt_dlp import YoutubeDL
-from yt_dlp.utils import DownloadError
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from yt_dlp.extractor import gen_extractor_classes
+from yt_dlp.utils import DownloadError, DownloadCancelled, download_range_func
 import ffmpeg
-from bot.config import DOWNLOAD_PATH, MAX_FILE_SIZE
+import numpy as np
+from bot.config import DOWNLOAD_PATH, MAX_FILE_SIZE, DIRECT_DOWNLOAD_ENABLED, RANGED_PART_MARGIN, SPLIT_MODE
+from bot.cache import info_cache
+from bot.ydl_pool import ydl_pool
+from bot.workers import run_ytdl, make_cancel_flag, make_progress_slot
+from bot.progress import ProgressSlot, make_progress_hook, watch_progress
+from bot.direct import probe_direct, download_direct, progress_snapshot, DirectDownloadError, DirectDownloadCancelled
+from bot.tuning import TransferMonitor, host_tuner
+from bot.admission import format_size_estimate
+from bot.probe import run_process, media_probe, MediaInfo
 import subprocess
 import tempfile
 import shutil
@@ -18,104 +33,322 @@ import base64
 
 logger = logging.getLogger(__name__)
 
+# Codecs Telegram plays in an MP4 without any remux
+UPLOAD_READY_VCODECS = ('avc1', 'h264')
+UPLOAD_READY_ACODECS = ('mp4a', 'aac')
+
+# Container bytes a stream-copy cut adds per packet (sample tables) and per file (headers)
+SPLIT_PACKET_OVERHEAD = 24
+SPLIT_FILE_OVERHEAD = 1024 * 1024
+# Offset keeping -ss/-t cuts on the intended side of a keyframe, in seconds
+SPLIT_SEEK_EPSILON = 0.001
+# Containers whose subtitle streams are kept by the segment muxer
+SEGMENT_SUBTITLE_CONTAINERS = ('.mkv',)
+# Minimum seconds between split progress reports
+SPLIT_PROGRESS_INTERVAL = 3
+
+# Bytes read from a streaming subprocess at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+# Keyframe index saved next to a video: size and mtime of the video, then float64 times
+KEYFRAME_INDEX_SUFFIX = '.keyframes'
+KEYFRAME_INDEX_HEADER = struct.Struct('<qd')
+# What follows a job's video_id in the names of its files (<id>.mp4, <id>.mp4.segments, <id>_part1.mp4, ...)
+JOB_FILE_SUFFIXES = ('.', '_part', '_thumb', '_screenshot_', '_sample')
+
 # Create download directory if it doesn't exist
 os.makedirs(DOWNLOAD_PATH, exist_ok=True)
 
 # Regex pattern for YT-DLP supported URLs
 URL_PATTERN = r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+'
 
+# Query parameters that never change which video a URL points to
+TRACKING_PARAMS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'fbclid', 'gclid', 'si', 'feature')
+
+_extractor_classes = None
+
+# Quality choices applied to every entry of a playlist or batch (code -> label, format)
+PLAYLIST_FORMATS = {
+    'best': ('Best Quality', 'bestvideo+bestaudio/best'),
+    '1080': ('1080p', 'bestvideo[height<=1080]+bestaudio/best[height<=1080]'),
+    '720': ('720p', 'bestvideo[height<=720]+bestaudio/best[height<=720]'),
+    '480': ('480p', 'bestvideo[height<=480]+bestaudio/best[height<=480]'),
+    '360': ('360p', 'bestvideo[height<=360]+bestaudio/best[height<=360]'),
+}
+
+# In-flight extractions by (extractor key, video id), shared by concurrent callers
+_inflight_extractions = {}
+extraction_stats = {'started': 0, 'coalesced': 0}
+
 def is_valid_url(url):
     """Check if URL is valid for YT-DLP"""
     return bool(re.match(URL_PATTERN, url))
 
+def extract_urls(text):
+    """Find every valid URL in a text, deduplicated in order.
+
+    Returns the URLs and the number of duplicates that were dropped.
+    """
+    urls = []
+    seen = set()
+    duplicates = 0
+    for match in re.findall(r'https?://\S+', text or ''):
+        url = match.rstrip('.,;:!?)]}>\'"')
+        if not is_valid_url(url):
+            continue
+        key = normalize_url(url)
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+        urls.append(url)
+    return urls, duplicates
+
+def normalize_url(url):
+    """Normalize a URL for use as a cache key"""
+    parts = urlsplit(url.strip())
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in TRACKING_PARAMS]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', urlencode(sorted(query)), ''))
+
+def get_url_key(url):
+    """Get (extractor key, video id) for a URL without touching the network"""
+    global _extractor_classes
+    if _extractor_classes is None:
+        _extractor_classes = [ie for ie in gen_extractor_classes() if ie.ie_key() != 'Generic']
+
+    for ie in _extractor_classes:
+        try:
+            if not ie.suitable(url):
+                continue
+            video_id = ie.get_temp_id(url)
+        except Exception:
+            continue
+        if video_id:
+            return ie.ie_key(), str(video_id)
+        break
+
+    return 'Generic', normalize_url(url)
+
 async def get_video_info(url):
+    """Get video information, using the info cache when possible.
+
+    Concurrent calls for the same video share one extraction.
+    """
+    extractor, key_id = get_url_key(url)
+
+    cached = await info_cache.get(extractor, key_id)
+    if cached is not None:
+        return dict(cached, video_id=str(uuid.uuid4()))
+
+    key = (extractor, key_id)
+    task = _inflight_extractions.get(key)
+    if task is None:
+        extraction_stats['started'] += 1
+        task = asyncio.ensure_future(_extract_and_cache(url, extractor, key_id))
+        _inflight_extractions[key] = task
+        task.add_done_callback(lambda _: _inflight_extractions.pop(key, None))
+    else:
+        extraction_stats['coalesced'] += 1
+
+    # Shield so one caller going away doesn't cancel the extraction for the others
+    info = await asyncio.shield(task)
+    return dict(info, video_id=str(uuid.uuid4())) if info is not None else None
+
+async def _extract_and_cache(url, extractor, key_id):
+    info = await extract_video_info(url)
+    if info is not None:
+        await info_cache.put(extractor, key_id, info)
+    return info
+
+async def extract_video_info(url):
     """Get video information using YT-DLP"""
     ydl_opts = {
         'quiet': True,
         'no_warnings': True,
         'skip_download': True,
         'format': 'best',
-        'writeinfojson': True,
         'noplaylist': True,
+        'extract_flat': 'in_playlist',  # List playlist entries without resolving each one
     }
     
-    video_id = str(uuid.uuid4())
-    info_json = os.path.join(DOWNLOAD_PATH, f"{video_id}.info.json")
-    
     try:
+        extractor = get_url_key(url)[0]
+        
+        # Direct file links don't need the generic extractor
+        if DIRECT_DOWNLOAD_ENABLED and extractor == 'Generic':
+            media = await probe_direct(url)
+            if media:
+                info = direct_media_info(media)
+                info['video_id'] = str(uuid.uuid4())
+                return info
+        
         # Run in executor to prevent blocking
-        def extract_info():
-            with YoutubeDL(ydl_opts) as ydl:
-                return ydl.extract_info(url, download=False)
-        
-        info = await asyncio.get_event_loop().run_in_executor(None, extract_info)
-        
-        with open(info_json, 'w') as f:
-            json.dump(info, f)
-        
-        # Get available formats
-        formats = []
-        for f in info.get('formats', []):
-            if f.get('resolution') != 'audio only':
-                format_id = f.get('format_id')
-                resolution = f.get('resolution', 'Unknown')
-                ext = f.get('ext', 'mp4')
-                filesize = f.get('filesize')
-                
-                if filesize:
-                    filesize_mb = round(filesize / (1024 * 1024), 2)
-                    size_str = f"{filesize_mb} MB"
-                else:
-                    size_str = "Unknown"
-                
-                formats.append({
-                    'format_id': format_id,
-                    'resolution': resolution,
-                    'ext': ext,
-                    'filesize': filesize,
-                    'size_str': size_str,
-                    'format_note': f.get('format_note', '')
-                })
-        
-        # Add best format option
-        formats.append({
-            'format_id': 'bestvideo+bestaudio/best',  # Changed this to include fallback to 'best'
-            'resolution': 'Best Quality',
-            'ext': 'mp4',
-            'filesize': None,
-            'size_str': 'Variable',
-            'format_note': 'Best quality'
-        })
-            
-        return {
-            'video_id': video_id,
-            'title': info.get('title', 'Unknown Title'),
-            'uploader': info.get('uploader', 'Unknown Uploader'),
-            'duration': info.get('duration'),
-            'formats': formats,
-            'thumbnail': info.get('thumbnail'),
-            'description': info.get('description', '')
-        }
+        info = await run_ytdl(_extract_compact_info, url, ydl_opts, extractor)
+        info['video_id'] = str(uuid.uuid4())
+        return info
     except DownloadError as e:
         logger.error(f"Error getting video info: {e}")
         return None
     except Exception as e:
         logger.error(f"Unexpected error in get_video_info: {e}")
         return None
-    finally:
-        # Cleanup info json
-        if os.path.exists(info_json):
-            os.remove(info_json)
 
-async def download_video(url, format_id, progress_callback=None, cancel_event=None):
-    """Download video using YT-DLP with non-blocking progress updates"""
-    video_id = str(uuid.uuid4())
+def _extract_compact_info(url, ydl_opts, site):
+    """Extract info and compact it (runs in a worker thread or process)"""
+    with ydl_pool.borrow(ydl_opts, site=site) as ydl:
+        info = ydl.extract_info(url, download=False)
+    return compact_info(info)
+
+def compact_info(info):
+    """Reduce a full yt-dlp info dict to the small, picklable subset the bot uses"""
+    if info.get('_type') == 'playlist':
+        return compact_playlist_info(info)
+
+    duration = info.get('duration')
+    all_formats = info.get('formats') or []
+    
+    # Video-only formats are offered merged with the best audio track
+    audio_formats = [f for f in all_formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    best_audio = max(audio_formats, key=lambda f: f.get('abr') or f.get('tbr') or 0, default=None)
+    audio_size = format_size_estimate(best_audio, duration) if best_audio else None
+    
+    # Get available formats
+    formats = []
+    for f in all_formats:
+        if f.get('resolution') != 'audio only':
+            format_id = f.get('format_id')
+            resolution = f.get('resolution', 'Unknown')
+            ext = f.get('ext', 'mp4')
+            filesize = f.get('filesize')
+            filesize_approx = f.get('filesize_approx')
+            tbr = f.get('tbr')
+            estimate = format_size_estimate(f, duration)
+            
+            if best_audio and f.get('acodec') == 'none' and f.get('vcodec') != 'none':
+                format_id = f"{format_id}+{best_audio['format_id']}"
+                estimate = estimate + (audio_size or 0) if estimate else None
+                filesize, filesize_approx = None, estimate
+                if tbr and best_audio.get('tbr'):
+                    tbr += best_audio['tbr']
+            
+            formats.append({
+                'format_id': format_id,
+                'resolution': resolution,
+                'ext': ext,
+                'filesize': filesize,
+                'size_str': size_label(estimate, exact=bool(filesize)),
+                'format_note': f.get('format_note', ''),
+                'filesize_approx': filesize_approx,
+                'tbr': tbr,
+                'fits': bool(estimate) and estimate <= MAX_FILE_SIZE
+            })
+    
+    # Add best format option, as large as the largest format
+    best_size = max((format_size_estimate(f, duration) or 0 for f in formats), default=0) or None
+    formats.append({
+        'format_id': 'bestvideo+bestaudio/best',  # Changed this to include fallback to 'best'
+        'resolution': 'Best Quality',
+        'ext': 'mp4',
+        'filesize': None,
+        'size_str': size_label(best_size, exact=False) if best_size else 'Variable',
+        'format_note': 'Best quality',
+        'filesize_approx': best_size,
+        'fits': bool(best_size) and best_size <= MAX_FILE_SIZE
+    })
+        
+    return {
+        'title': info.get('title', 'Unknown Title'),
+        'uploader': info.get('uploader', 'Unknown Uploader'),
+        'duration': info.get('duration'),
+        'formats': formats,
+        'thumbnail': info.get('thumbnail'),
+        'description': info.get('description', '')
+    }
+
+def size_label(size, exact=True):
+    """Menu label of a format size; estimates are marked with ~"""
+    if not size:
+        return "Unknown"
+    return f"{'' if exact else '~'}{round(size / (1024 * 1024), 2)} MB"
+
+def pick_format_under(info, max_size=MAX_FILE_SIZE):
+    """Highest quality format of a compact info expected to fit in max_size, or None.
+
+    yt-dlp lists formats from worst to best, so this is the last one whose
+    size estimate is known and small enough.
+    """
+    duration = info.get('duration')
+    fitting = None
+    for fmt in info.get('formats', []):
+        if fmt['format_id'] == 'bestvideo+bestaudio/best':
+            continue
+        size = format_size_estimate(fmt, duration)
+        if size and size <= max_size:
+            fitting = fmt
+    return fitting
+
+def direct_media_info(media):
+    """Info dict for a direct media link, in the shape of compact_info"""
+    title, ext = os.path.splitext(media['filename'])
+    return {
+        'title': title or media['filename'],
+        'uploader': urlsplit(media['url']).hostname or 'Unknown Uploader',
+        'duration': None,
+        'formats': [{
+            'format_id': 'direct',
+            'resolution': 'Original file',
+            'ext': ext.lstrip('.') or 'mp4',
+            'filesize': media['size'],
+            'size_str': size_label(media['size']),
+            'format_note': 'Direct download',
+            'fits': media['size'] <= MAX_FILE_SIZE
+        }],
+        'thumbnail': None,
+        'description': ''
+    }
+
+def compact_playlist_info(info):
+    """Compact a flat-extracted playlist into its entry URLs"""
+    entries = []
+    for entry in info.get('entries') or []:
+        if not entry:
+            continue
+        entry_url = entry.get('url') or entry.get('webpage_url')
+        if entry_url and is_valid_url(entry_url):
+            entries.append({'url': entry_url, 'title': entry.get('title')})
+
+    return {
+        'is_playlist': True,
+        'title': info.get('title', 'Unknown Playlist'),
+        'uploader': info.get('uploader', 'Unknown Uploader'),
+        'duration': None,
+        'entries': entries,
+        'formats': [],
+        'thumbnail': None,
+        'description': info.get('description', '')
+    }
+
+def get_playlist_format(code):
+    """Get the yt-dlp format string for a playlist quality code"""
+    return PLAYLIST_FORMATS.get(code, PLAYLIST_FORMATS['best'])[1]
+
+async def download_video(url, format_id, progress_callback=None, cancel_event=None, video_id=None, time_range=None):
+    """Download video using YT-DLP with non-blocking progress updates.
+
+    progress_callback is awaited with the latest progress snapshot at an
+    adaptive interval (see progress.watch_progress). Passing the video_id of
+    an interrupted attempt continues its partial download. With a
+    (start, end) time_range in seconds only that section is downloaded.
+    """
+    video_id = video_id or str(uuid.uuid4())
     output_path = os.path.join(DOWNLOAD_PATH, f"{video_id}.%(ext)s")
     
     async def _download():
         # If format is the best format option, use a more robust format string
         if format_id == 'bestvideo+bestaudio':
             format_id_to_use = 'bestvideo+bestaudio/best'
+        elif format_id == 'direct':
+            # Picked from a direct link menu, yt-dlp only runs as the fallback
+            format_id_to_use = 'best'
         else:
             format_id_to_use = format_id
             
@@ -134,18 +367,51 @@ async def download_video(url, format_id, progress_callback=None, cancel_event=No
         }
         
         try:
-            def do_download():
-                with YoutubeDL(ydl_opts) as ydl:
-                    if cancel_event and cancel_event.is_set():
-                        raise Exception("Download cancelled by user")
-                    info = ydl.extract_info(url, download=True)
-                    return info
+            site = get_url_key(url)[0]
+
+            if cancel_event and cancel_event.is_set():
+                return cancelled_result(video_id, {})
             
-            # Run the blocking download in a thread pool
-            info = await asyncio.get_event_loop().run_in_executor(None, do_download)
+            # Direct file links are fetched with concurrent Range requests,
+            # yt-dlp stays the fallback for everything else
+            if DIRECT_DOWNLOAD_ENABLED and site == 'Generic' and time_range is None:
+                result = await _try_direct_download(url, video_id, progress_callback, cancel_event)
+                if result is not None:
+                    return result
+
+            # The worker polls a thread/process-safe flag from its progress
+            # hook, mirrored from the job's asyncio cancel event
+            cancel_flag = make_cancel_flag()
+            watcher = asyncio.create_task(_mirror_cancel(cancel_event, cancel_flag)) if cancel_event else None
+            
+            # Fragment concurrency and chunk size learned for this host
+            tuned_opts = await host_tuner.settings_for(url)
+            
+            # Hook events reach the loop through a latest-value slot
+            progress_slot = make_progress_slot()
+            progress_done = asyncio.Event()
+            progress_watcher = None
+            if progress_callback:
+                progress_watcher = asyncio.create_task(watch_progress(progress_slot, progress_callback, progress_done))
+            try:
+                info, file_path = await run_ytdl(
+                    _download_sync, url, ydl_opts, site, output_path, cancel_flag, progress_slot, tuned_opts, time_range
+                )
+            finally:
+                if watcher:
+                    watcher.cancel()
+                if cancel_event and cancel_event.is_set():
+                    # The awaiting task may have been cancelled before the watcher ran
+                    cancel_flag.set()
+                progress_done.set()
+            throughput_samples = await progress_watcher if progress_watcher else []
             
+            if info and info.get('cancelled'):
+                return cancelled_result(video_id, info)
+            if info and info.get('transfer'):
+                await host_tuner.record(url, info['transfer'])
             if cancel_event and cancel_event.is_set():
-                raise Exception("Download cancelled by user")
+                return cancelled_result(video_id, {})
             
             # Handle the case where info is None
             if info is None:
@@ -153,7 +419,7 @@ async def download_video(url, format_id, progress_callback=None, cancel_event=No
                 # Try to find the file that was created
                 possible_files = [
                     f for f in os.listdir(DOWNLOAD_PATH) 
-                    if f.startswith(video_id) and os.path.isfile(os.path.join(DOWNLOAD_PATH, f))
+                    if os.path.splitext(f)[0] == video_id and os.path.isfile(os.path.join(DOWNLOAD_PATH, f))
                 ]
                 
                 if possible_files:
@@ -167,38 +433,24 @@ async def download_video(url, format_id, progress_callback=None, cancel_event=No
                         'duration': None,
                         'format': format_id_to_use,
                         'filesize': os.path.getsize(file_path),
-                        'video_id': video_id
+                        'video_id': video_id,
+                        'throughput_samples': throughput_samples
                     }
                 else:
                     return {'success': False, 'error': 'Failed to download video (info is None)'}
             
-            try:
-                file_path = YoutubeDL(ydl_opts).prepare_filename(info)
-                
-                # Sometimes the extension is not properly determined for merged formats
-                if not os.path.exists(file_path):
-                    # Try to find the actual file with the video_id prefix
-                    possible_files = [
-                        f for f in os.listdir(DOWNLOAD_PATH) 
-                        if f.startswith(video_id) and os.path.isfile(os.path.join(DOWNLOAD_PATH, f))
-                    ]
-                    if possible_files:
-                        file_path = os.path.join(DOWNLOAD_PATH, possible_files[0])
-                        logger.info(f"Using alternative file path: {file_path}")
-                
-            except Exception as e:
-                logger.error(f"Error preparing filename: {e}")
-                # Try to find the file that was created
+            # Sometimes the extension is not properly determined for merged formats
+            if file_path is None or not os.path.exists(file_path):
+                # Try to find the actual file with the video_id prefix
                 possible_files = [
                     f for f in os.listdir(DOWNLOAD_PATH) 
-                    if f.startswith(video_id) and os.path.isfile(os.path.join(DOWNLOAD_PATH, f))
+                    if os.path.splitext(f)[0] == video_id and os.path.isfile(os.path.join(DOWNLOAD_PATH, f))
                 ]
-                
                 if possible_files:
                     file_path = os.path.join(DOWNLOAD_PATH, possible_files[0])
-                    logger.info(f"Found file despite filename preparation error: {file_path}")
-                else:
-                    return {'success': False, 'error': f'Error preparing filename: {e}'}
+                    logger.info(f"Using alternative file path: {file_path}")
+                elif file_path is None:
+                    return {'success': False, 'error': 'Error preparing filename'}
             
             if os.path.exists(file_path):
                 return {
@@ -208,8 +460,13 @@ async def download_video(url, format_id, progress_callback=None, cancel_event=No
                     'uploader': info.get('uploader', 'Unknown Uploader'),
                     'duration': info.get('duration'),
                     'format': info.get('format'),
+                    'vcodec': info.get('vcodec'),
+                    'acodec': info.get('acodec'),
+                    'width': info.get('width'),
+                    'height': info.get('height'),
                     'filesize': os.path.getsize(file_path),
-                    'video_id': video_id
+                    'video_id': video_id,
+                    'throughput_samples': throughput_samples
                 }
             else:
                 return {'success': False, 'error': 'File not found after download'}
@@ -220,134 +477,716 @@ async def download_video(url, format_id, progress_callback=None, cancel_event=No
     
     return await _download()
 
-async def split_file(file_path, max_size=MAX_FILE_SIZE):
-    """Split file into chunks of max_size"""
+def upload_ready_metadata(result):
+    """Metadata of a download that can be uploaded exactly as it is, or None.
+
+    An MP4 with H.264 video and AAC (or no) audio plays in Telegram as is, and
+    yt-dlp already reported its duration and dimensions, so the file needs
+    neither a remux nor another probe.
+    """
+    file_path = result.get('file_path') or ''
+    vcodec = result.get('vcodec') or ''
+    acodec = result.get('acodec') or ''
+    if not file_path.lower().endswith('.mp4'):
+        return None
+    if not vcodec.startswith(UPLOAD_READY_VCODECS):
+        return None
+    if acodec != 'none' and not acodec.startswith(UPLOAD_READY_ACODECS):
+        return None
+    if not (result.get('duration') and result.get('width') and result.get('height')):
+        return None
+    return {"width": result['width'], "height": result['height'], "duration": int(result['duration'])}
+
+async def _try_direct_download(url, video_id, progress_callback, cancel_event):
+    """Segmented download of a direct media link. Returns None to fall back to yt-dlp."""
+    media = await probe_direct(url)
+    if media is None:
+        return None
+    
+    ext = os.path.splitext(media['filename'])[1] or '.mp4'
+    file_path = os.path.join(DOWNLOAD_PATH, f"{video_id}{ext}")
+    
+    progress_slot = ProgressSlot()
+    started = time.time()
+    downloaded = 0
+    last_publish = 0
+    
+    def on_progress(count):
+        nonlocal downloaded, last_publish
+        downloaded += count
+        now = time.monotonic()
+        if now - last_publish >= 0.25 or downloaded == media['size']:
+            last_publish = now
+            progress_slot.publish(progress_snapshot(downloaded, media['size'], started))
+    
+    progress_done = asyncio.Event()
+    progress_watcher = None
+    if progress_callback:
+        progress_watcher = asyncio.create_task(watch_progress(progress_slot, progress_callback, progress_done))
+    
+    logger.info(f"Direct download of {media['url']} ({format_size(media['size'])}, ranges: {media['ranges']})")
     try:
-        # Check if file exists and is not None
-        if file_path is None or not os.path.exists(file_path):
-            logger.error(f"File does not exist: {file_path}")
-            return []
-            
-        file_size = os.path.getsize(file_path)
-        if file_size <= max_size:
-            return [file_path]
-        
-        file_name, ext = os.path.splitext(file_path)
-        num_parts = (file_size // max_size) + (1 if file_size % max_size else 0)
-        
+        await download_direct(media, file_path, on_progress, cancel_event)
+    except DirectDownloadCancelled:
+        return cancelled_result(video_id, {'downloaded_bytes': downloaded, 'total_bytes': media['size']})
+    except (DirectDownloadError, OSError) as e:
+        logger.warning(f"Direct download of {url} failed, falling back to yt-dlp: {e}")
+        cleanup_job_files(video_id)
+        return None
+    finally:
+        progress_done.set()
+    throughput_samples = await progress_watcher if progress_watcher else []
+    
+    return {
+        'success': True,
+        'file_path': file_path,
+        'title': direct_media_info(media)['title'],
+        'uploader': urlsplit(media['url']).hostname or 'Unknown Uploader',
+        'duration': None,
+        'format': 'direct',
+        'filesize': media['size'],
+        'video_id': video_id,
+        'throughput_samples': throughput_samples
+    }
+
+def _download_sync(url, ydl_opts, site, output_path, cancel_flag=None, progress_slot=None, tuned_opts=None, time_range=None):
+    """Download with a pooled YoutubeDL (runs in a worker thread or process)"""
+    transfer = {}
+    
+    def cancel_hook(d):
+        transfer['downloaded_bytes'] = d.get('downloaded_bytes')
+        transfer['total_bytes'] = d.get('total_bytes') or d.get('total_bytes_estimate')
+        if cancel_flag is not None and cancel_flag.is_set():
+            raise DownloadCancelled("Download cancelled by user")
+    
+    monitor = TransferMonitor()
+    hooks = [cancel_hook, monitor.hook]
+    if progress_slot is not None:
+        hooks.append(make_progress_hook(progress_slot))
+    overrides = dict(tuned_opts or {}, logger=monitor)
+    if time_range is not None:
+        # Cut at the nearest keyframes instead of re-encoding around them
+        overrides['download_ranges'] = download_range_func(None, [time_range])
+        overrides['force_keyframes_at_cuts'] = False
+    
+    with ydl_pool.borrow(ydl_opts, site=site, outtmpl=output_path, progress_hooks=hooks, overrides=overrides) as ydl:
         try:
-            # Run ffprobe in executor
-            probe = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: ffmpeg.probe(file_path)
-            )
-            
-            duration = float(probe['format']['duration'])
+            if cancel_flag is not None and cancel_flag.is_set():
+                raise DownloadCancelled("Download cancelled by user")
+            info = ydl.extract_info(url, download=True)
+        except DownloadCancelled:
+            return {'cancelled': True, **transfer}, None
+        if info is None:
+            return None, None
+        try:
+            file_path = ydl.prepare_filename(info)
         except Exception as e:
-            logger.error(f"Error probing file with ffmpeg, falling back to file-based split: {e}")
-            # If ffprobe fails, we can't split by duration, just return the original file
-            return [file_path]
-            
-        part_duration = duration / num_parts
-        split_files = []
+            logger.error(f"Error preparing filename: {e}")
+            file_path = None
+
+    return {
+        'title': info.get('title', 'Unknown Title'),
+        'uploader': info.get('uploader', 'Unknown Uploader'),
+        'duration': info.get('duration'),
+        'format': info.get('format'),
+        'vcodec': info.get('vcodec'),
+        'acodec': info.get('acodec'),
+        'width': info.get('width'),
+        'height': info.get('height'),
+        'transfer': monitor.summary()
+    }, file_path
+
+async def _mirror_cancel(cancel_event, cancel_flag):
+    await cancel_event.wait()
+    cancel_flag.set()
+
+def cancelled_result(video_id, transfer):
+    """Download result of a cancelled job, after removing its partial files"""
+    return {
+        'success': False,
+        'cancelled': True,
+        'error': 'Download cancelled by user',
+        'downloaded_bytes': transfer.get('downloaded_bytes') or 0,
+        'total_bytes': transfer.get('total_bytes') or 0,
+        'removed_bytes': cleanup_job_files(video_id)
+    }
+
+async def run_ffmpeg(stream):
+    """Run an ffmpeg-python stream graph as a killable subprocess"""
+    cmd = stream.compile()
+    returncode, stdout, stderr = await run_process(cmd)
+    if returncode != 0:
+        raise ffmpeg.Error(cmd[0], stdout, stderr)
+    return stdout, stderr
+
+async def probe_duration(file_path):
+    """Duration of a media file from the shared probe, raising ValueError if it is unknown"""
+    info = await media_probe.probe(file_path)
+    if not info or not info.duration:
+        raise ValueError(f"Unknown duration of {file_path}")
+    return info.duration
+
+def plan_time_ranges(duration, expected_size, max_size=MAX_FILE_SIZE):
+    """Split [0, duration) into equal time ranges expected to stay under max_size each"""
+    count = max(1, math.ceil(expected_size * RANGED_PART_MARGIN / max_size))
+    step = duration / count
+    return [(i * step, min((i + 1) * step, duration)) for i in range(count)]
+
+async def iter_ranged_parts(url, format_id, video_id, time_ranges, cancel_event=None, skip_parts=(), max_size=MAX_FILE_SIZE):
+    """Download a video as time-ranged parts, yielding (index, total, path, duration, key) as each part is ready.
+
+    The full-size file never exists on disk. A part that still comes out
+    larger than max_size (bitrate peaks) is split like a normal download.
+    key is (range,) or (range, *piece key) for the pieces of a split range,
+    and parts whose key is in skip_parts are not fetched again.
+    """
+    total = len(time_ranges)
+    extra = 0
+    
+    for i, time_range in enumerate(time_ranges):
+        # A split range was recorded by its pieces, so it is fetched again
+        if (i,) in skip_parts:
+            continue
         
-        for i in range(num_parts):
-            start_time = i * part_duration
-            output_file = f"{file_name}_part{i+1}{ext}"
-            
-            # Run ffmpeg in executor
-            try:
-                await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: (
-                        ffmpeg
-                        .input(file_path, ss=start_time, t=part_duration)
-                        .output(output_file, c='copy')
-                        .overwrite_output()
-                        .run(quiet=True)
-                    )
-                )
-                
-                if os.path.exists(output_file):
-                    split_files.append(output_file)
-            except Exception as e:
-                logger.error(f"Error splitting file part {i+1}: {e}")
+        result = await download_video(
+            url, format_id, cancel_event=cancel_event,
+            video_id=f"{video_id}_part{i+1}", time_range=time_range
+        )
+        if result.get('cancelled'):
+            raise asyncio.CancelledError()
+        if not result['success']:
+            raise Exception(f"Part {i+1} failed: {result.get('error', 'Unknown error')}")
         
-        # If splitting didn't produce any files, return the original
-        if not split_files:
-            return [file_path]
-            
-        return split_files
-    except Exception as e:
-        logger.error(f"Error splitting file: {e}")
-        return [file_path] if file_path and os.path.exists(file_path) else []
+        part_path = result['file_path']
+        if os.path.getsize(part_path) <= max_size:
+            yield i + extra, total + extra, part_path, None, (i,)
+            continue
+        
+        logger.warning(f"Ranged part {i+1} is over the size limit, splitting it")
+        # Pieces delivered before a restart are not cut again
+        skip_pieces = {key[1:] for key in skip_parts if len(key) > 1 and key[0] == i}
+        first = i + extra
+        kept_whole = False
+        # Pieces are handed on as they are cut, so staging limits still apply
+        pieces = iter_split_parts(part_path, max_size, skip_parts=skip_pieces)
+        try:
+            async for j, piece_total, piece, piece_duration, piece_key in pieces:
+                kept_whole = kept_whole or piece == part_path
+                extra = first - i + piece_total - 1
+                yield first + j, total + extra, piece, piece_duration, (i, *piece_key)
+        finally:
+            await pieces.aclose()
+            if not kept_whole:
+                cleanup_files(part_path)
 
+class FileSlice(io.RawIOBase):
+    """Read-only file object over a byte range of a file, read with os.pread.
 
-async def get_video_metadata(video_path):
-    """Get comprehensive video metadata using direct ffprobe command"""
+    Uploaders read it like a file of its own, so a byte range of a large
+    file is sent without being copied anywhere.
+    """
+    
+    def __init__(self, path, start, length, name):
+        super().__init__()
+        self.path = path
+        self.start = start
+        self.length = length
+        self.name = name
+        self._fd = os.open(path, os.O_RDONLY)
+        self._pos = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._pos
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._pos + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self._pos = position
+        return position
+    
+    def readinto(self, buffer):
+        count = min(len(buffer), self.length - self._pos)
+        if count <= 0:
+            return 0
+        read = os.preadv(self._fd, [memoryview(buffer)[:count]], self.start + self._pos)
+        self._pos += read
+        return read
+    
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+async def iter_byte_range_parts(file_path, max_size=MAX_FILE_SIZE, skip_parts=()):
+    """Cut a file into byte ranges named <file>.partNN, yielding (index, total, FileSlice, None, key).
+
+    Nothing is probed or written: each part is read straight from the
+    original, and the parts join back with a plain concatenation.
+    """
+    file_size = os.path.getsize(file_path)
+    total = -(-file_size // max_size)
+    name = os.path.basename(file_path)
+    
+    for i in range(total):
+        if (i,) in skip_parts:
+            continue
+        start = i * max_size
+        yield i, total, FileSlice(file_path, start, min(max_size, file_size - start), f"{name}.part{i+1:02d}"), None, (i,)
+
+async def split_file(file_path, max_size=MAX_FILE_SIZE):
+    """Split file into chunks of max_size"""
+    return [part_path async for _, _, part_path, _, _ in iter_split_parts(file_path, max_size)]
+
+async def iter_output_lines(cmd):
+    """Run a command and yield batches of its stdout lines as they arrive.
+
+    Output is never buffered whole, and the command is killed if the
+    consumer stops early or is cancelled. Raises on a non-zero exit status.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stderr_reader = asyncio.create_task(process.stderr.read())
+    pending = b''
     try:
-        # Use direct subprocess for more control over ffprobe output
-        cmd = [
-            'ffprobe', 
-            '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height,duration,codec_name,bit_rate,avg_frame_rate:format=duration,bit_rate',
-            '-of', 'json',
-            video_path
-        ]
-        
-        # Run ffprobe asynchronously
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+        while True:
+            chunk = await process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            yield [line.decode('utf-8', 'replace') for line in lines]
+            # A fast producer never makes the read wait, let other tasks run
+            await asyncio.sleep(0)
+        if pending:
+            yield [pending.decode('utf-8', 'replace')]
         
-        stdout, stderr = await process.communicate()
+        await process.wait()
+        stderr = await stderr_reader
         if process.returncode != 0:
-            logger.error(f"ffprobe error: {stderr.decode()}")
-            return None
-        
-        data = json.loads(stdout.decode())
-        return process_ffprobe_data(data)
+            raise Exception(f"{cmd[0]} exited with {process.returncode}: {stderr.decode(errors='replace')[-500:]}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+            logger.info(f"Killed {cmd[0]} (pid {process.pid}) of an abandoned scan")
+        stderr_reader.cancel()
+
+async def read_packet_index(file_path):
+    """Packet index of a media file: (times, sizes, keyframe times, duration) as NumPy arrays, or None.
+
+    The packet list is parsed as ffprobe streams it. The keyframe times are
+    also saved next to the file for get_keyframes_timestamps.
+    """
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'packet=codec_type,pts_time,duration_time,size,flags',
+        '-of', 'csv=p=0',
+        file_path
+    ]
+    times, durations, sizes, keyframes = array('d'), array('d'), array('q'), array('d')
+    try:
+        async for lines in iter_output_lines(cmd):
+            _parse_packet_lines(lines, times, durations, sizes, keyframes)
     except Exception as e:
-        logger.error(f"Error in get_video_metadata: {e}")
+        logger.error(f"ffprobe packet scan failed: {e}")
+        return None
+    
+    if not times or not keyframes:
         return None
+    
+    times = np.frombuffer(times, dtype=np.float64)
+    order = np.argsort(times, kind='stable')
+    duration = float(np.max(times + np.frombuffer(durations, dtype=np.float64)))
+    keyframes = np.unique(np.frombuffer(keyframes, dtype=np.float64))
+    save_keyframe_index(file_path, keyframes)
+    return times[order], np.frombuffer(sizes, dtype=np.int64)[order], keyframes, duration
 
-def process_ffprobe_data(data):
-    """Process ffprobe output into standardized metadata format"""
-    metadata = {'has_video': False, 'duration': 0, 'width': 0, 'height': 0}
+def _parse_packet_lines(lines, times, durations, sizes, keyframes):
+    """Append ffprobe packet CSV lines (codec_type,pts_time,duration_time,size,flags) to the index arrays"""
+    for line in lines:
+        fields = line.split(',')
+        if len(fields) < 5:
+            continue
+        try:
+            time = float(fields[1])
+            size = int(fields[3])
+        except ValueError:
+            # Packets without a timestamp (N/A) can't be placed
+            continue
+        times.append(time)
+        sizes.append(size)
+        durations.append(float(fields[2]) if fields[2] not in ('', 'N/A') else 0.0)
+        if fields[0] == 'video' and 'K' in fields[4]:
+            keyframes.append(time)
+
+def save_keyframe_index(video_path, keyframes):
+    """Save keyframe times (array('d') or float64 ndarray) next to the video"""
+    try:
+        stat = os.stat(video_path)
+        with open(video_path + KEYFRAME_INDEX_SUFFIX, 'wb') as f:
+            f.write(KEYFRAME_INDEX_HEADER.pack(stat.st_size, stat.st_mtime))
+            keyframes.tofile(f)
+    except OSError as e:
+        logger.error(f"Error saving keyframe index: {e}")
+
+def load_keyframe_index(video_path):
+    """Saved keyframe times of a video as array('d'), or None if missing or stale"""
+    try:
+        stat = os.stat(video_path)
+        with open(video_path + KEYFRAME_INDEX_SUFFIX, 'rb') as f:
+            header = f.read(KEYFRAME_INDEX_HEADER.size)
+            if len(header) != KEYFRAME_INDEX_HEADER.size:
+                return None
+            if KEYFRAME_INDEX_HEADER.unpack(header) != (stat.st_size, stat.st_mtime):
+                return None
+            keyframes = array('d')
+            keyframes.frombytes(f.read())
+            return keyframes
+    except (OSError, ValueError):
+        return None
+
+def snap_to_keyframe(video_path, position):
+    """The last keyframe at or before position if the video has a saved index, else position"""
+    keyframes = load_keyframe_index(video_path)
+    if not keyframes:
+        return position
+    i = bisect.bisect_right(keyframes, position) - 1
+    return keyframes[i] if i >= 0 else position
+
+def plan_split(times, sizes, keyframes, duration, max_size=MAX_FILE_SIZE, start=0.0):
+    """Keyframe cut points giving the fewest parts of [start, duration) under max_size each.
+
+    The byte cost of every prefix of the file comes from a cumulative sum of
+    packet sizes (plus container overhead), and each part greedily extends to
+    the last keyframe that keeps it under the limit, which is optimal for
+    the number of parts. A single GOP over the limit becomes a part of its
+    own. Returns a list of (start, end) times.
+    """
+    cost = np.cumsum(sizes + SPLIT_PACKET_OVERHEAD)
+    # Only keyframes after the start can end a part
+    keyframes = keyframes[keyframes > start]
+    # Bytes before each keyframe: all packets with an earlier timestamp
+    before = np.concatenate(([0], cost))[np.searchsorted(times, keyframes, side='left')]
+    budget = max_size - SPLIT_FILE_OVERHEAD
     
-    # Extract video stream information
-    video_stream = next((stream for stream in data.get('streams', []) 
-                        if stream.get('codec_type') == 'video'), None)
+    cuts = []
+    used = 0
+    while cost[-1] - used > budget:
+        last = int(np.searchsorted(before, used + budget, side='right')) - 1
+        following = cuts[-1] + 1 if cuts else 0
+        if last < following:
+            # Not even one GOP fits: cut at the next keyframe anyway
+            last = following
+        if last >= len(keyframes):
+            break
+        cuts.append(last)
+        used = before[last]
     
-    if video_stream:
-        metadata['has_video'] = True
-        metadata['codec_name'] = video_stream.get('codec_name', 'unknown')
-        metadata['width'] = int(video_stream.get('width', 0))
-        metadata['height'] = int(video_stream.get('height', 0))
+    bounds = [start] + [float(keyframes[i]) for i in cuts] + [duration]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _packet_slice(index, start, end):
+    """The part of a packet index within [start, end)"""
+    times, sizes, keyframes, _ = index
+    mask = (times >= start) & (times < end)
+    part_keyframes = keyframes[(keyframes >= start) & (keyframes < end)]
+    return times[mask], sizes[mask], part_keyframes, end
+
+async def _cut_part(file_path, output_file, start, end, last):
+    """Stream-copy [start, end) of a file, starting exactly on the keyframe at start"""
+    # Nudge past the keyframe so rounding can't seek back to the previous one,
+    # and stop just short of the next part's keyframe
+    seek = start + SPLIT_SEEK_EPSILON if start > 0 else 0
+    input_args = {'ss': seek}
+    if not last:
+        input_args['t'] = end - seek - SPLIT_SEEK_EPSILON
+    await run_ffmpeg(
+        ffmpeg
+        .input(file_path, **input_args)
+        .output(output_file, c='copy')
+        .overwrite_output()
+    )
+
+async def iter_split_parts(file_path, max_size=MAX_FILE_SIZE, skip_parts=(), duration=None, progress_callback=None):
+    """Split file into chunks of max_size, yielding (index, total, path, duration, key) as each part is written.
+
+    Cuts land on keyframes chosen from the file's packet index so every part
+    fits with the fewest parts, and each part's exact duration is yielded
+    along with it. In the default segment mode all parts are written by one
+    sequential ffmpeg pass, and progress_callback is awaited with (seconds
+    done, seconds total) as it goes. A part that still comes out too large
+    is re-split on its own. Without a packet index the file is cut evenly
+    by duration (known or probed) and part durations are None.
+
+    index/total number the parts of this run. key identifies a part across
+    runs: (plan part,) or (plan part, piece) for a re-split one. Parts whose
+    key is in skip_parts are not cut.
+    """
+    # Check if file exists and is not None
+    if file_path is None or not os.path.exists(file_path):
+        logger.error(f"File does not exist: {file_path}")
+        return
         
-        # Get duration with fallbacks
-        if 'duration' in video_stream:
-            metadata['duration'] = float(video_stream.get('duration', 0))
-        elif 'format' in data and 'duration' in data['format']:
-            metadata['duration'] = float(data['format'].get('duration', 0))
+    file_size = os.path.getsize(file_path)
+    if file_size <= max_size:
+        yield 0, 1, file_path, duration, (0,)
+        return
+    
+    file_name, ext = os.path.splitext(file_path)
+    
+    try:
+        index = await read_packet_index(file_path)
+    except Exception as e:
+        logger.error(f"Error reading packet index, splitting evenly: {e}")
+        index = None
+    
+    if index is None:
+        async for part in _iter_even_split_parts(file_path, max_size, skip_parts, duration):
+            yield part
+        return
+    
+    plan = plan_split(*index, max_size=max_size)
+    total = len(plan)
+    extra = 0
+    # Parts inherit the source's streams, their durations come from the plan
+    parent = media_probe.peek(file_path) or MediaInfo()
+    
+    def should_cut(i):
+        # A re-split part was recorded by its pieces, so it is cut again
+        return (i,) not in skip_parts
+    
+    # A resumed split only needs some of the parts, cut those one by one
+    if SPLIT_MODE == 'segment' and not skip_parts and total > 1:
+        cuts = _iter_segment_or_seek_cuts(file_path, plan, file_name, ext, should_cut, progress_callback)
+    else:
+        cuts = _iter_seek_cuts(file_path, plan, file_name, ext, should_cut)
+    logger.info(f"Splitting {file_path} into {total} parts at keyframes ({SPLIT_MODE} mode)")
+    
+    try:
+        async for i, output_file in cuts:
+            start, end = plan[i]
+            part_size = os.path.getsize(output_file)
+            if part_size <= max_size:
+                media_probe.remember(output_file, parent.derive(duration=end - start, size=part_size))
+                yield i + extra, total + extra, output_file, end - start, (i,)
+                continue
             
-        # Get frame rate
-        if 'avg_frame_rate' in video_stream:
-            try:
-                num, den = video_stream['avg_frame_rate'].split('/')
-                metadata['frame_rate'] = float(num) / float(den) if float(den) > 0 else 0
-            except (ValueError, ZeroDivisionError):
-                metadata['frame_rate'] = 0
-                
-        # Get bitrate
-        if 'bit_rate' in video_stream:
-            metadata['bit_rate'] = int(video_stream.get('bit_rate', 0))
-        elif 'format' in data and 'bit_rate' in data['format']:
-            metadata['bit_rate'] = int(data['format'].get('bit_rate', 0))
+            # Over the limit after all: re-split just this part with a budget
+            # shrunk by how far the estimate was off
+            sub_index = _packet_slice(index, start, end)
+            scaled_size = int(SPLIT_FILE_OVERHEAD + (max_size - SPLIT_FILE_OVERHEAD) * max_size / part_size)
+            sub_plan = plan_split(*sub_index, max_size=scaled_size, start=start) if len(sub_index[2]) > 1 else []
+            if len(sub_plan) < 2:
+                logger.warning(f"Part {i+1} is {part_size} bytes but can't be cut further")
+                media_probe.remember(output_file, parent.derive(duration=end - start, size=part_size))
+                yield i + extra, total + extra, output_file, end - start, (i,)
+                continue
             
+            logger.warning(f"Part {i+1} came out at {part_size} bytes, re-splitting it into {len(sub_plan)}")
+            cleanup_files(output_file)
+            first = i + extra
+            extra += len(sub_plan) - 1
+            for j, (sub_start, sub_end) in enumerate(sub_plan):
+                if (i, j) in skip_parts:
+                    continue
+                sub_file = f"{file_name}_part{i+1}_{j+1}{ext}"
+                await _cut_part(file_path, sub_file, sub_start, sub_end, i == total - 1 and j == len(sub_plan) - 1)
+                if os.path.exists(sub_file):
+                    media_probe.remember(sub_file, parent.derive(duration=sub_end - sub_start, size=None))
+                    yield first + j, total + extra, sub_file, sub_end - sub_start, (i, j)
+    finally:
+        await cuts.aclose()
+
+async def _iter_seek_cuts(file_path, plan, file_name, ext, should_cut):
+    """Cut the parts of a plan with one seek-and-copy ffmpeg run each, yielding (index, path)"""
+    for i, (start, end) in enumerate(plan):
+        if not should_cut(i):
+            continue
+        output_file = f"{file_name}_part{i+1}{ext}"
+        
+        # Run ffmpeg in a killable subprocess
+        try:
+            await _cut_part(file_path, output_file, start, end, i == len(plan) - 1)
+        except Exception as e:
+            logger.error(f"Error splitting file part {i+1}: {e}")
+            continue
+        if os.path.exists(output_file):
+            yield i, output_file
+
+async def _iter_segment_or_seek_cuts(file_path, plan, file_name, ext, should_cut, progress_callback=None):
+    """Segment-muxer cuts, or seek cuts if the muxer fails before writing the first part"""
+    cuts = _iter_segment_cuts(file_path, plan, file_name, ext, progress_callback)
+    produced = False
+    try:
+        async for item in cuts:
+            produced = True
+            yield item
+        return
+    except Exception as e:
+        if produced:
+            raise
+        logger.warning(f"Segment split of {file_path} failed before the first part, cutting parts one by one: {e}")
+    finally:
+        await cuts.aclose()
+    
+    cuts = _iter_seek_cuts(file_path, plan, file_name, ext, should_cut)
+    try:
+        async for item in cuts:
+            yield item
+    finally:
+        await cuts.aclose()
+
+async def _iter_segment_cuts(file_path, plan, file_name, ext, progress_callback=None):
+    """Cut all parts of a plan in one sequential ffmpeg pass, yielding (index, path) as each is complete.
+
+    The segment muxer reads the input once and starts a new file at every
+    planned keyframe. Finished segments are reported on stdout (the segment
+    list) and progress on stderr. ffmpeg is paused while a finished part
+    waits for the consumer, so parts are still only cut as fast as they are
+    uploaded.
+    """
+    # Cut a hair before each keyframe: the muxer splits at the first keyframe at or after the time
+    segment_times = ",".join(f"{end - SPLIT_SEEK_EPSILON:.6f}" for _, end in plan[:-1])
+    cmd = [
+        'ffmpeg', '-v', 'error', '-nostats', '-y',
+        '-i', file_path,
+        # Data tracks (tmcd) and most subtitle codecs can't go through the segment muxer
+        '-map', '0:v:0?', '-map', '0:a?',
+        *(['-map', '0:s?'] if ext.lower() in SEGMENT_SUBTITLE_CONTAINERS else []),
+        '-c', 'copy',
+        '-f', 'segment', '-segment_times', segment_times,
+        '-segment_start_number', '1', '-reset_timestamps', '1',
+        '-segment_list', 'pipe:1', '-segment_list_type', 'csv',
+        '-progress', 'pipe:2',
+        f"{file_name}_part%d{ext}"
+    ]
+    total_duration = plan[-1][1]
+    errors = []
+    
+    async def read_progress(stream):
+        last_report = 0
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+            if key == 'out_time_us' and value.isdigit():
+                now = time.monotonic()
+                if progress_callback and now - last_report >= SPLIT_PROGRESS_INTERVAL:
+                    last_report = now
+                    try:
+                        await progress_callback(min(int(value) / 1e6, total_duration), total_duration)
+                    except Exception as e:
+                        logger.debug(f"Split progress callback failed: {e}")
+            elif not value:
+                errors.append(key)
+    
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    progress_reader = asyncio.create_task(read_progress(process.stderr))
+    index = 0
+    try:
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            segment_file = line.decode('utf-8', 'replace').strip().split(',')[0]
+            output_file = os.path.join(os.path.dirname(file_path), segment_file)
+            if index >= len(plan):
+                raise Exception(f"ffmpeg wrote more segments than the {len(plan)} planned")
+            if os.path.exists(output_file):
+                # Hold ffmpeg until the consumer asks for the next part
+                process.send_signal(signal.SIGSTOP)
+                try:
+                    yield index, output_file
+                finally:
+                    if process.returncode is None:
+                        process.send_signal(signal.SIGCONT)
+            index += 1
+        
+        await process.wait()
+        await progress_reader
+        if process.returncode != 0:
+            raise Exception(f"ffmpeg segment split failed: {' '.join(errors[-3:])}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+            logger.info(f"Killed ffmpeg (pid {process.pid}) of an unfinished split")
+        progress_reader.cancel()
+
+async def _iter_even_split_parts(file_path, max_size, skip_parts, duration):
+    """Cut a file into equal-duration parts, for files without a usable packet index"""
+    file_size = os.path.getsize(file_path)
+    num_parts = (file_size // max_size) + (1 if file_size % max_size else 0)
+    
+    try:
+        if not duration:
+            duration = await probe_duration(file_path)
+    except Exception as e:
+        logger.error(f"Error probing file with ffmpeg, falling back to file-based split: {e}")
+        # If ffprobe fails, we can't split by duration, just return the original file
+        yield 0, 1, file_path, None, (0,)
+        return
+        
+    file_name, ext = os.path.splitext(file_path)
+    part_duration = duration / num_parts
+    produced = 0
+    
+    for i in range(num_parts):
+        if (i,) in skip_parts:
+            continue
+        start_time = i * part_duration
+        output_file = f"{file_name}_part{i+1}{ext}"
+        
+        # Run ffmpeg in a killable subprocess
+        try:
+            await run_ffmpeg(
+                ffmpeg
+                .input(file_path, ss=start_time, t=part_duration)
+                .output(output_file, c='copy')
+                .overwrite_output()
+            )
+        except Exception as e:
+            logger.error(f"Error splitting file part {i+1}: {e}")
+            continue
+        
+        if os.path.exists(output_file):
+            produced += 1
+            yield i, num_parts, output_file, None, (i,)
+    
+    # If splitting didn't produce any files, return the original
+    if not produced and not skip_parts:
+        yield 0, 1, file_path, None, (0,)
+
+
+async def get_video_metadata(video_path):
+    """Get comprehensive video metadata from the shared media probe"""
+    info = await media_probe.probe(video_path)
+    if info is None:
+        return None
+    
+    metadata = {'has_video': info.has_video, 'duration': info.duration or 0, 'width': info.width or 0, 'height': info.height or 0}
+    if info.has_video:
+        metadata['codec_name'] = info.vcodec
+        metadata['frame_rate'] = info.frame_rate or 0
+        metadata['bit_rate'] = info.bit_rate or 0
     return metadata
 
 async def extract_frame_with_ffmpeg(video_path, output_path, metadata, position_percent, width, quality):
@@ -379,16 +1218,10 @@ async def extract_frame_with_ffmpeg(video_path, output_path, metadata, position_
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
+        returncode, stdout, stderr = await run_process(cmd)
         
         # Check if thumbnail was generated successfully
-        if process.returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 1024:
+        if returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 1024:
             return output_path
             
         # If fast seeking failed, try accurate seeking (slower but more reliable)
@@ -404,15 +1237,9 @@ async def extract_frame_with_ffmpeg(video_path, output_path, metadata, position_
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
+        returncode, stdout, stderr = await run_process(cmd)
         
-        if process.returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 1024:
+        if returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 1024:
             return output_path
         
         # Log error if both attempts failed
@@ -443,15 +1270,9 @@ async def extract_frame_with_scene_detection(video_path, output_path, width, qua
                 output_path
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
+            returncode, stdout, stderr = await run_process(cmd)
             
-            if process.returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 1024:
+            if returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 1024:
                 return output_path
                 
             # If that failed, try with keyframe selection
@@ -466,15 +1287,9 @@ async def extract_frame_with_scene_detection(video_path, output_path, width, qua
                 output_path
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
+            returncode, stdout, stderr = await run_process(cmd)
             
-            if process.returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 1024:
+            if returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 1024:
                 return output_path
                 
             logger.warning(f"Failed to extract frame with scene detection: {stderr.decode()}")
@@ -526,13 +1341,7 @@ async def extract_multiple_frames_and_select_best(video_path, output_path, metad
                     temp_file
                 ]
                 
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                
-                await process.communicate()
+                returncode, stdout, stderr = await run_process(cmd)
                 
                 if os.path.exists(temp_file) and os.path.getsize(temp_file) > 1024:
                     frame_files.append((temp_file, os.path.getsize(temp_file)))
@@ -559,44 +1368,39 @@ async def extract_multiple_frames_and_select_best(video_path, output_path, metad
         return None
 
 async def get_keyframes_timestamps(video_path):
-    """Get timestamps of keyframes in the video"""
-    try:
-        cmd = [
-            'ffprobe',
-            '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'packet=pts_time,flags',
-            '-of', 'json',
-            video_path
-        ]
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        if process.returncode != 0:
-            logger.error(f"ffprobe error when getting keyframes: {stderr.decode()}")
-            return []
-        
-        data = json.loads(stdout.decode())
-        keyframes = []
-        
-        for packet in data.get('packets', []):
-            # Check if this packet contains a keyframe
-            if 'K' in packet.get('flags', ''):
-                if 'pts_time' in packet and packet['pts_time'] != 'N/A':
-                    keyframes.append(float(packet['pts_time']))
-        
+    """Keyframe timestamps of the video as array('d'), from its saved index when there is one"""
+    keyframes = load_keyframe_index(video_path)
+    if keyframes is not None:
         return keyframes
+    
+    # Packet flags mark keyframes without decoding anything; CSV lines are
+    # parsed as they stream in instead of buffering one JSON document
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        video_path
+    ]
+    keyframes = array('d')
+    try:
+        async for lines in iter_output_lines(cmd):
+            for line in lines:
+                pts_time, _, flags = line.partition(',')
+                if 'K' in flags and pts_time not in ('', 'N/A'):
+                    keyframes.append(float(pts_time))
     except Exception as e:
         logger.error(f"Error getting keyframes: {e}")
-        return []
+        return array('d')
+    
+    # Presentation order can differ from packet order
+    keyframes = array('d', sorted(set(keyframes)))
+    save_keyframe_index(video_path, keyframes)
+    return keyframes
 
-async def generate_thumbnail(video_path):
-    """Generate thumbnail from video"""
+async def generate_thumbnail(video_path, duration=None):
+    """Generate thumbnail from video, probing its duration unless it is known"""
     try:
         # Check if video_path is None or doesn't exist
         if video_path is None or not os.path.exists(video_path):
@@ -606,25 +1410,17 @@ async def generate_thumbnail(video_path):
         thumb_path = f"{os.path.splitext(video_path)[0]}_thumb.jpg"
         
         try:
-            # Run ffprobe in executor
-            probe = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: ffmpeg.probe(video_path)
-            )
+            if not duration:
+                duration = await probe_duration(video_path)
+            # A keyframe needs no decoding of the frames before it
+            time = snap_to_keyframe(video_path, duration * 0.6)
             
-            duration = float(probe['format']['duration'])
-            time = duration * 0.6
-            
-            # Run ffmpeg in executor
-            await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: (
-                    ffmpeg
-                    .input(video_path, ss=time)
-                    .output(thumb_path, vframes=1)
-                    .overwrite_output()
-                    .run(quiet=True)
-                )
+            # Run ffmpeg in a killable subprocess
+            await run_ffmpeg(
+                ffmpeg
+                .input(video_path, ss=time)
+                .output(thumb_path, vframes=1)
+                .overwrite_output()
             )
         except Exception as e:
             logger.error(f"Error generating thumbnail with ffmpeg: {e}")
@@ -635,8 +1431,39 @@ async def generate_thumbnail(video_path):
         logger.error(f"Error generating thumbnail: {e}")
         return None
 
-async def generate_screenshots(video_path, count=10):
-    """Generate multiple screenshots from video"""
+async def _screenshot_batch(video_path, times, paths):
+    """All screenshots from one ffmpeg run.
+
+    Every timestamp is its own input seeking straight to the keyframe at or
+    before it and decoding keyframes only, and each output takes the first
+    frame of its input, so no stretch of the file is decoded twice.
+    """
+    cmd = ['ffmpeg', '-v', 'error', '-y']
+    for position in times:
+        cmd += ['-skip_frame', 'nokey', '-noaccurate_seek', '-ss', f"{position:.3f}", '-i', video_path]
+    for i, path in enumerate(paths):
+        cmd += ['-map', f"{i}:v:0", '-frames:v', '1', path]
+    
+    returncode, _, stderr = await run_process(cmd)
+    if returncode != 0:
+        raise ffmpeg.Error(cmd[0], b'', stderr)
+
+async def _screenshot_each(video_path, times, paths):
+    """Screenshots with one ffmpeg run per timestamp"""
+    for i, (position, screenshot_path) in enumerate(zip(times, paths)):
+        try:
+            # Run ffmpeg in a killable subprocess
+            await run_ffmpeg(
+                ffmpeg
+                .input(video_path, ss=position)
+                .output(screenshot_path, vframes=1)
+                .overwrite_output()
+            )
+        except Exception as e:
+            logger.error(f"Error generating screenshot {i+1}: {e}")
+
+async def generate_screenshots(video_path, count=10, duration=None):
+    """Generate multiple screenshots from video in one ffmpeg run, probing its duration unless it is known"""
     try:
         # Check if video_path is None or doesn't exist
         if video_path is None or not os.path.exists(video_path):
@@ -644,49 +1471,29 @@ async def generate_screenshots(video_path, count=10):
             return []
             
         try:
-            # Run ffprobe in executor
-            probe = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: ffmpeg.probe(video_path)
-            )
-            
-            duration = float(probe['format']['duration'])
+            if not duration:
+                duration = await probe_duration(video_path)
         except Exception as e:
             logger.error(f"Error probing file with ffmpeg: {e}")
             return []
             
-        screenshots = []
         base_name = os.path.splitext(video_path)[0]
+        times = [duration * (i + 1) / (count + 1) for i in range(count)]
+        paths = [f"{base_name}_screenshot_{i+1}.jpg" for i in range(count)]
         
-        for i in range(count):
-            time = duration * (i + 1) / (count + 1)
-            screenshot_path = f"{base_name}_screenshot_{i+1}.jpg"
-            
-            try:
-                # Run ffmpeg in executor
-                await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: (
-                        ffmpeg
-                        .input(video_path, ss=time)
-                        .output(screenshot_path, vframes=1)
-                        .overwrite_output()
-                        .run(quiet=True)
-                    )
-                )
-                
-                if os.path.exists(screenshot_path):
-                    screenshots.append(screenshot_path)
-            except Exception as e:
-                logger.error(f"Error generating screenshot {i+1}: {e}")
+        try:
+            await _screenshot_batch(video_path, times, paths)
+        except ffmpeg.Error as e:
+            logger.error(f"Batched screenshots failed, taking them one by one: {e.stderr.decode(errors='replace')}")
+            await _screenshot_each(video_path, times, paths)
         
-        return screenshots
+        return [path for path in paths if os.path.exists(path)]
     except Exception as e:
         logger.error(f"Error generating screenshots: {e}")
         return []
 
-async def generate_sample_video(video_path, duration=20):
-    """Generate a sample video of specified duration"""
+async def generate_sample_video(video_path, duration=20, video_duration=None):
+    """Generate a sample video of specified duration, probing the video's duration unless it is known"""
     try:
         # Check if video_path is None or doesn't exist
         if video_path is None or not os.path.exists(video_path):
@@ -694,13 +1501,8 @@ async def generate_sample_video(video_path, duration=20):
             return None
             
         try:
-            # Run ffprobe in executor
-            probe = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: ffmpeg.probe(video_path)
-            )
-            
-            video_duration = float(probe['format']['duration'])
+            if not video_duration:
+                video_duration = await probe_duration(video_path)
         except Exception as e:
             logger.error(f"Error probing file with ffmpeg: {e}")
             return None
@@ -709,20 +1511,18 @@ async def generate_sample_video(video_path, duration=20):
         
         if start_time + duration > video_duration:
             start_time = max(0, video_duration - duration)
+        # A stream copy starts at a keyframe anyway, start the sample exactly there
+        start_time = snap_to_keyframe(video_path, start_time)
         
         sample_path = f"{os.path.splitext(video_path)[0]}_sample.mp4"
         
         try:
-            # Run ffmpeg in executor
-            await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: (
-                    ffmpeg
-                    .input(video_path, ss=start_time, t=duration)
-                    .output(sample_path, c='copy')
-                    .overwrite_output()
-                    .run(quiet=True)
-                )
+            # Run ffmpeg in a killable subprocess
+            await run_ffmpeg(
+                ffmpeg
+                .input(video_path, ss=start_time, t=duration)
+                .output(sample_path, c='copy')
+                .overwrite_output()
             )
         except Exception as e:
             logger.error(f"Error generating sample video with ffmpeg: {e}")
@@ -743,9 +1543,50 @@ def cleanup_files(file_paths):
             if file_path and os.path.exists(file_path):
                 os.remove(file_path)
                 logger.info(f"Removed file: {file_path}")
+            if file_path and os.path.exists(file_path + KEYFRAME_INDEX_SUFFIX):
+                os.remove(file_path + KEYFRAME_INDEX_SUFFIX)
         except Exception as e:
             logger.error(f"Error removing file {file_path}: {e}")
 
+def is_job_file(name, video_id):
+    """Whether a file in DOWNLOAD_PATH belongs to the job with this video_id.
+
+    The id must be followed by a delimiter: batch entries <id>_1 and <id>_10
+    share a prefix but not each other's files.
+    """
+    return name.startswith(video_id) and name[len(video_id):].startswith(JOB_FILE_SUFFIXES)
+
+def job_disk_usage(video_id):
+    """Bytes the files of a job take on disk, preallocated space included"""
+    used = 0
+    for name in os.listdir(DOWNLOAD_PATH):
+        if is_job_file(name, video_id):
+            try:
+                used += os.stat(os.path.join(DOWNLOAD_PATH, name)).st_blocks * 512
+            except OSError:
+                pass
+    return used
+
+def cleanup_job_files(video_id):
+    """Remove every file of a job (partial downloads, parts, thumbnails, ...). Returns the bytes freed."""
+    removed = 0
+    if not video_id:
+        return removed
+    
+    for name in os.listdir(DOWNLOAD_PATH):
+        if not is_job_file(name, video_id):
+            continue
+        path = os.path.join(DOWNLOAD_PATH, name)
+        try:
+            if os.path.isfile(path):
+                size = os.path.getsize(path)
+                os.remove(path)
+                removed += size
+                logger.info(f"Removed file: {path}")
+        except Exception as e:
+            logger.error(f"Error removing file {path}: {e}")
+    return removed
+
 def format_size(size):
     """Format size in bytes to human readable format"""
     if size is None: